@@ -0,0 +1,211 @@
+"""
+Cliente asyncio de SIGA (httpx.AsyncClient) y el event loop compartido del
+proceso. Comparte con la versión síncrona (client.py) la política de
+reintentos, los timeouts, las cabeceras/tokens y la reautenticación, y
+reutiliza el parser incremental, la proyección de columnas y la escritura en
+streaming. Los servicios de reportes (services.py) corren sobre este cliente.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import threading
+
+import httpx
+
+from .client import (
+    CODIGOS_REINTENTO,
+    REINTENTOS_CONEXION,
+    REINTENTOS_ESTADO,
+    TIMEOUTS_POR_ENDPOINT,
+    _ClienteSigaBase,
+    espera_reintento,
+)
+from .streaming import ERRORES_PARSEO, TAMANO_BLOQUE, escribir_json_stream, iterar_json_array, proyectar
+
+logger = logging.getLogger("siga")
+
+_bucle = None
+_bucle_lock = threading.Lock()
+
+
+def bucle_compartido():
+    """
+    Event loop único del proceso, corriendo en un hilo daemon. Ahí corren los
+    servicios de la API síncrona: todos los hilos (pasos del grafo, option2,
+    option5) comparten un solo pool de conexiones por cliente.
+    """
+    global _bucle
+    with _bucle_lock:
+        if _bucle is None:
+            _bucle = asyncio.new_event_loop()
+            threading.Thread(target=_bucle.run_forever, name="siga-aio", daemon=True).start()
+    return _bucle
+
+
+def ejecutar(corrutina):
+    """Corre la corrutina en bucle_compartido() y bloquea al hilo que llama hasta su resultado."""
+    bucle = bucle_compartido()
+    try:
+        en_bucle = asyncio.get_running_loop() is bucle
+    except RuntimeError:
+        en_bucle = False
+    if en_bucle:
+        corrutina.close()
+        raise RuntimeError("La API síncrona de SIGA no puede llamarse desde su propio event loop; usar await.")
+    futuro = asyncio.run_coroutine_threadsafe(corrutina, bucle)
+    try:
+        return futuro.result()
+    except BaseException:
+        # p.ej. KeyboardInterrupt en el hilo que espera: cancela también la solicitud
+        futuro.cancel()
+        raise
+
+
+def _bloques_desde_loop(abloques, loop):
+    """
+    Iterable síncrono sobre un iterador asíncrono de bloques, para consumirlo
+    desde un hilo: cada bloque se pide al event loop y el hilo espera.
+    """
+    async def _siguiente():
+        return await abloques.__anext__()
+
+    while True:
+        try:
+            yield asyncio.run_coroutine_threadsafe(_siguiente(), loop).result()
+        except StopAsyncIteration:
+            return
+
+
+def _parsear(bloques, columnas):
+    """
+    Parsea el cuerpo por bloques (en un hilo, fuera del event loop). Sin
+    columnas, un objeto JSON de nivel superior se devuelve tal cual, igual
+    que response.json() en el cliente síncrono.
+    """
+    if columnas:
+        return list(proyectar(iterar_json_array(bloques), columnas))
+    bloques = iter(bloques)
+    leidos, inicio = [], b""
+    for bloque in bloques:
+        leidos.append(bloque)
+        inicio = bloque.lstrip(b" \t\r\n\xef\xbb\xbf")
+        if inicio:
+            break
+    if inicio[:1] == b"[":
+        return list(iterar_json_array(itertools.chain(leidos, bloques)))
+    return json.loads(b"".join(leidos + list(bloques)))
+
+
+class AsyncApiSigaClient(_ClienteSigaBase):
+    """
+    Cliente asíncrono con un único pool de conexiones (max_conexiones) compartido
+    por todas las corrutinas. El cuerpo de los reportes se lee por bloques y se
+    parsea a medida que llega. Cancelar la tarea que espera un reporte cancela
+    también la solicitud HTTP en curso.
+    """
+
+    def __init__(self, base_url, auth=None, access_token=None, max_conexiones=10, timeouts=None):
+        self.base_url = base_url.rstrip("/")
+        self.auth = auth
+        self.access_token = access_token
+        self.timeouts = {**TIMEOUTS_POR_ENDPOINT, **(timeouts or {})}
+        limites = httpx.Limits(max_connections=max_conexiones, max_keepalive_connections=max_conexiones)
+        # El transporte de httpx solo reintenta errores de conexión (como connect= en urllib3)
+        self._http = httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(retries=REINTENTOS_CONEXION, limits=limites),
+        )
+
+    @classmethod
+    def desde_cliente(cls, cliente, **kwargs):
+        """Mismo SIGA, tokens y timeouts que un ApiSigaClient (y su proveedor de auth, si tiene)."""
+        return cls(cliente.base_url, auth=cliente.auth, access_token=cliente.access_token,
+                   timeouts=cliente.timeouts, **kwargs)
+
+    @classmethod
+    def desde_proveedor(cls, proveedor, **kwargs):
+        """Crea el cliente sobre un SigaAuthProvider (api_siga.auth)."""
+        return cls.desde_cliente(proveedor.cliente, **kwargs)
+
+    def _timeout(self, endpoint):
+        connect, read = super()._timeout(endpoint)
+        return httpx.Timeout(read, connect=connect)
+
+    async def _tokens(self, rechazado=None):
+        # El proveedor es síncrono (archivo + lock); casi siempre responde desde memoria
+        if rechazado:
+            return await asyncio.to_thread(self.auth.renovar, rechazado)
+        return await asyncio.to_thread(self.auth.tokens)
+
+    async def _enviar(self, url, headers, json_data, timeout):
+        """
+        POST en modo streaming con la política de reintentos común
+        (CODIGOS_REINTENTO, espera_reintento). Quien llama cierra la respuesta.
+        """
+        for intento in range(REINTENTOS_ESTADO + 1):
+            request = self._http.build_request("POST", url, headers=headers, json=json_data, timeout=timeout)
+            response = await self._http.send(request, stream=True)
+            if response.status_code not in CODIGOS_REINTENTO or intento == REINTENTOS_ESTADO:
+                return response
+            await response.aclose()
+            await asyncio.sleep(espera_reintento(intento, response.headers.get("Retry-After")))
+
+    async def _procesar(self, endpoint, json_data, extra_headers, consumir):
+        """
+        POST autenticado (un solo reintento si SIGA rechaza el token) cuyo
+        cuerpo se entrega por bloques a consumir(bloques), que corre en un hilo.
+        Retorna lo que devuelva consumir o None si la solicitud falla.
+        """
+        url, headers = self._preparar_post(endpoint, extra_headers)
+        response = None
+        try:
+            timeout = self._timeout(endpoint)
+            if self.auth is not None:
+                self._aplicar_tokens(headers, *await self._tokens())
+            response = await self._enviar(url, headers, json_data, timeout)
+            rechazado = self._token_rechazado(response.status_code, endpoint, headers)
+            if rechazado:
+                await response.aclose()
+                self._aplicar_tokens(headers, *await self._tokens(rechazado))
+                response = await self._enviar(url, headers, json_data, timeout)
+            response.raise_for_status()
+            # El parseo es CPU: corre en un hilo que va pidiendo bloques al event loop
+            bloques = _bloques_desde_loop(response.aiter_bytes(TAMANO_BLOQUE), asyncio.get_running_loop())
+            return await asyncio.to_thread(consumir, bloques)
+
+        except httpx.HTTPError as e:
+            print(f"❌ Error en POST {endpoint}: {e}")
+            return None
+        except ERRORES_PARSEO as ve:
+            print(f"❌ Respuesta inválida en POST {endpoint}: {ve}")
+            return None
+        finally:
+            if response is not None:
+                await response.aclose()
+
+    async def post(self, endpoint, json_data=None, extra_headers=None, columnas=None):
+        """POST autenticado (reportes). Retorna la respuesta parseada o None si falla."""
+        return await self._procesar(endpoint, json_data, extra_headers, lambda bloques: _parsear(bloques, columnas))
+
+    async def post_stream(self, endpoint, destino, json_data=None, extra_headers=None, columnas=None):
+        """
+        Como ApiSigaClient.post_stream: los registros se escriben en 'destino'
+        a medida que llegan y se devuelve un RegistrosJson sobre ese archivo.
+        'columnas' limita los campos que se guardan. Retorna None si falla.
+        """
+        def _guardar(bloques):
+            return escribir_json_stream(proyectar(iterar_json_array(bloques), columnas), destino)
+
+        registros = await self._procesar(endpoint, json_data, extra_headers, _guardar)
+        if registros is not None:
+            print(f"✅ {endpoint}: {registros.total} registros guardados en {destino}")
+        return registros
+
+    async def aclose(self):
+        await self._http.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
@@ -0,0 +1,235 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+from .client import ApiSigaClient
+
+try:  # bloqueo entre procesos (workers de uvicorn); no existe en Windows
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+logger = logging.getLogger("siga")
+
+TOKEN_STORE_PATH = os.path.join("output", ".siga_tokens.json")
+TTL_POR_DEFECTO = 3600      # si SIGA no informa expires_in / EXPIRA_EN
+MARGEN_RENOVACION = 300     # renovar 5 min antes de expirar (máx. media vida del token)
+ESPERA_MINIMA_RENOVACION = 10   # segundos mínimos entre renovaciones en segundo plano
+INACTIVIDAD_REFRESCO = int(os.getenv("SIGA_AUTH_INACTIVIDAD", "1800"))  # sin tokens() -> se detiene
+
+
+def _segundos_hasta(valor, ahora):
+    """Interpreta expires_in / EXPIRA_EN (segundos o fecha) como segundos restantes."""
+    if valor is None or valor == "":
+        return None
+    try:
+        return float(valor)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return datetime.fromisoformat(str(valor).strip()).timestamp() - ahora
+    except ValueError:
+        return None
+
+
+class SigaAuthProvider:
+    """
+    Único punto de autenticación contra SIGA (obtener_token + autenticar).
+    - Cachea access_token y token_autenticacion con su expiración en un archivo
+      local compartido entre ejecuciones y workers (TOKEN_STORE_PATH).
+    - Renueva en segundo plano antes de que expiren, mientras el proceso siga
+      pidiendo tokens (un worker inactivo deja de renovar).
+    - renovar(rechazado=...) reautentica una sola vez aunque varios hilos o
+      procesos reciban el mismo rechazo.
+    """
+
+    def __init__(self, base_url, client_id, secreto, username, password,
+                 store_path=TOKEN_STORE_PATH, margen=MARGEN_RENOVACION,
+                 refresco_automatico=True):
+        self.cliente = ApiSigaClient(base_url, client_id, secreto)
+        self.cliente.auth = self
+        self.username = username
+        self.password = password
+        self.store_path = store_path
+        self.margen = margen
+        self.refresco_automatico = refresco_automatico
+        self._tokens = None
+        self._lock = threading.RLock()
+        self._hilo = None
+        self._ultimo_uso = time.monotonic()
+
+    @classmethod
+    def desde_env(cls, **kwargs):
+        load_dotenv()
+        base_url = os.getenv("BASE_URL")
+        client_id = os.getenv("CLIENT_ID")
+        secreto = os.getenv("SECRETO")
+        username = os.getenv("USERNAME_PRUEBA")
+        password = os.getenv("PASSWORD_PRUEBA")
+        if not all([base_url, client_id, secreto, username, password]):
+            raise RuntimeError(
+                "Faltan variables de entorno requeridas: "
+                "BASE_URL, CLIENT_ID, SECRETO, USERNAME_PRUEBA, PASSWORD_PRUEBA"
+            )
+        kwargs.setdefault("store_path", os.getenv("SIGA_TOKEN_STORE", TOKEN_STORE_PATH))
+        return cls(base_url, client_id, secreto, username, password, **kwargs)
+
+    # ----------------- API PÚBLICA -----------------
+
+    def tokens(self):
+        """Devuelve (access_token, token_autenticacion) vigentes, autenticando solo si hace falta."""
+        self._ultimo_uso = time.monotonic()
+        t = self._tokens
+        if not self._vigente(t):
+            with self._lock, self._bloqueo_archivo():
+                t = self._tokens
+                if not self._vigente(t):
+                    t = self._leer_store()
+                    if not self._vigente(t):
+                        t = self._autenticar()
+                    self._usar(t)
+        if self.refresco_automatico:
+            self._iniciar_refresco()
+        return t["access_token"], t["token_autenticacion"]
+
+    def renovar(self, rechazado=None):
+        """
+        Fuerza nuevos tokens. Si se indica el access_token rechazado y otro hilo
+        o worker ya lo reemplazó, se reutiliza el nuevo sin volver a autenticar.
+        """
+        with self._lock, self._bloqueo_archivo():
+            for t in (self._tokens, self._leer_store()):
+                if rechazado and t and t["access_token"] != rechazado and self._vigente(t):
+                    self._usar(t)
+                    return t["access_token"], t["token_autenticacion"]
+            t = self._autenticar()
+            self._usar(t)
+        return t["access_token"], t["token_autenticacion"]
+
+    # ----------------- INTERNOS -----------------
+
+    def _vigente(self, t, margen=0):
+        return bool(t) and t.get("expira", 0) - margen > time.time()
+
+    def _margen(self, t):
+        """Margen de renovación: nunca más de la mitad de la vida del token."""
+        vida = t["expira"] - t.get("emitido", t["expira"] - TTL_POR_DEFECTO)
+        return min(self.margen, max(vida, 0) / 2)
+
+    def _usar(self, t):
+        self._tokens = t
+        self.cliente.access_token = t["access_token"]
+
+    def _autenticar(self):
+        logger.info("Auth: generando access_token…")
+        ahora = time.time()
+        access_token = self.cliente.generar_token()
+        if not access_token:
+            raise RuntimeError("No se pudo obtener el token de acceso.")
+
+        logger.info("Auth: autenticando en SIGA…")
+        auth_response = self.cliente.autenticar(self.username, self.password)
+        if auth_response.get("RESPUESTA") != "1":
+            raise RuntimeError(f"Error al autenticar: {auth_response}")
+
+        # Expira el primero de los dos tokens
+        vidas = [
+            v for v in (
+                _segundos_hasta(self.cliente.token_expira_en, ahora),
+                _segundos_hasta(auth_response.get("EXPIRA_EN"), ahora),
+            ) if v and v > 0
+        ]
+        t = {
+            "access_token": access_token,
+            "token_autenticacion": auth_response.get("TOKEN"),
+            "emitido": ahora,
+            "expira": ahora + (min(vidas) if vidas else TTL_POR_DEFECTO),
+        }
+        self._escribir_store(t)
+        logger.info("Auth OK")
+        return t
+
+    def _leer_store(self):
+        try:
+            with open(self.store_path, "r", encoding="utf-8") as f:
+                t = json.load(f)
+            if isinstance(t, dict) and t.get("access_token") and t.get("token_autenticacion"):
+                return t
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def _escribir_store(self, t):
+        try:
+            os.makedirs(os.path.dirname(self.store_path) or ".", exist_ok=True)
+            tmp = f"{self.store_path}.{os.getpid()}.tmp"
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(t, f)
+            os.replace(tmp, self.store_path)
+        except OSError as e:
+            logger.warning(f"Auth: no se pudo persistir el token de SIGA: {e}")
+
+    @contextmanager
+    def _bloqueo_archivo(self):
+        """Evita que varios workers autentiquen a la vez (solo si hay fcntl)."""
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(os.path.dirname(self.store_path) or ".", exist_ok=True)
+        with open(f"{self.store_path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _iniciar_refresco(self):
+        if self._hilo is not None and self._hilo.is_alive():
+            return
+        with self._lock:
+            if self._hilo is None or not self._hilo.is_alive():
+                self._hilo = threading.Thread(target=self._bucle_refresco, name="siga-auth-refresh", daemon=True)
+                self._hilo.start()
+
+    def _bucle_refresco(self):
+        ultima = float("-inf")
+        while True:
+            if time.monotonic() - self._ultimo_uso > INACTIVIDAD_REFRESCO:
+                # El próximo tokens() vuelve a arrancar el hilo
+                logger.info("Auth: sin uso reciente; se detiene la renovación en segundo plano.")
+                return
+            t = self._tokens
+            espera = (t["expira"] - self._margen(t) - time.time()) if t else 0
+            # Aunque SIGA dé vidas muy cortas, nunca se renueva en bucle cerrado
+            espera = max(espera, ultima + ESPERA_MINIMA_RENOVACION - time.monotonic())
+            if espera > 0:
+                time.sleep(min(espera, 60))
+                continue
+            try:
+                actual = t["access_token"] if t else None
+                ultima = time.monotonic()
+                self.renovar(rechazado=actual)
+            except Exception as e:
+                logger.warning(f"Auth: renovación en segundo plano falló: {e}")
+                time.sleep(30)
+
+
+_proveedor = None
+_proveedor_lock = threading.Lock()
+
+
+def obtener_proveedor_auth() -> SigaAuthProvider:
+    """Instancia única por proceso del proveedor de autenticación."""
+    global _proveedor
+    if _proveedor is None:
+        with _proveedor_lock:
+            if _proveedor is None:
+                _proveedor = SigaAuthProvider.desde_env()
+    return _proveedor
@@ -0,0 +1,91 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+# Periodos del 992 ya cerrados: sus registros no cambian, se sirven desde disco.
+# Se puede sobrescribir con PERIODOS_992_CERRADOS="cod1,cod2,..." en el .env
+PERIODOS_992_CERRADOS = {
+    "2025011112",  # 2025-1
+    "2024101510",  # 2024-4
+    "2024100708",  # 2024-3
+    "2024091608",  # 2024-2
+    "2024090208",  # 2024-1
+}
+
+CACHE_992_DIR = os.path.join("output", "cache_992")
+
+
+class Cache992:
+    """
+    Caché permanente en disco del reporte 992 por periodo.
+    Clave: (cod_periodo_academico, solo_pendientes_matricula[, proyección de columnas]).
+    Solo los periodos cerrados se leen/escriben aquí; los abiertos siempre van a SIGA.
+    """
+
+    def __init__(self, directorio: str = CACHE_992_DIR, periodos_cerrados=None):
+        self.directorio = Path(directorio)
+        if periodos_cerrados is None:
+            env = os.getenv("PERIODOS_992_CERRADOS")
+            if env is not None:
+                periodos_cerrados = [c.strip() for c in env.split(",") if c.strip()]
+            else:
+                periodos_cerrados = PERIODOS_992_CERRADOS
+        self.periodos_cerrados = {str(c) for c in periodos_cerrados}
+
+    def es_cerrado(self, cod_periodo) -> bool:
+        return str(cod_periodo) in self.periodos_cerrados
+
+    def _ruta(self, cod_periodo, solo_pendientes_matricula, columnas=None) -> Path:
+        sufijo = "pendientes" if solo_pendientes_matricula else "todos"
+        if columnas:
+            # Una proyección distinta no puede reutilizar registros recortados
+            sufijo += "_" + hashlib.sha1(",".join(columnas).encode()).hexdigest()[:8]
+        return self.directorio / f"992_{cod_periodo}_{sufijo}.json"
+
+    def obtener(self, cod_periodo, solo_pendientes_matricula=False, columnas=None):
+        """Devuelve la lista cacheada o None si no hay (o el periodo no está cerrado)."""
+        if not self.es_cerrado(cod_periodo):
+            return None
+        ruta = self._ruta(cod_periodo, solo_pendientes_matricula, columnas)
+        try:
+            with ruta.open("r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Caché 992 ilegible para {cod_periodo}, se descarta: {e}")
+            return None
+        return data if isinstance(data, list) else None
+
+    def guardar(self, cod_periodo, registros, solo_pendientes_matricula=False, columnas=None) -> bool:
+        """Persiste los registros de un periodo cerrado (escritura atómica)."""
+        if not self.es_cerrado(cod_periodo) or not isinstance(registros, list):
+            return False
+        ruta = self._ruta(cod_periodo, solo_pendientes_matricula, columnas)
+        ruta.parent.mkdir(parents=True, exist_ok=True)
+        tmp = ruta.with_suffix(f".{os.getpid()}.tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            json.dump(registros, f, ensure_ascii=False)
+        os.replace(tmp, ruta)
+        return True
+
+    def invalidar(self, periodos=None) -> int:
+        """Borra la caché de los periodos indicados (o toda). Devuelve cuántos archivos se eliminaron."""
+        if not self.directorio.exists():
+            return 0
+        objetivos = {str(p) for p in periodos} if periodos else None
+        eliminados = 0
+        for ruta in self.directorio.glob("992_*.json"):
+            cod = ruta.stem.split("_")[1]
+            if objetivos is None or cod in objetivos:
+                ruta.unlink(missing_ok=True)
+                eliminados += 1
+        return eliminados
+
+
+def invalidar_cache_992(periodos=None) -> int:
+    """Atajo para tasks.py / app.py: invalida la caché del 992."""
+    eliminados = Cache992().invalidar(periodos)
+    print(f"🧹 Caché 992 invalidada: {eliminados} archivo(s) eliminado(s).")
+    return eliminados
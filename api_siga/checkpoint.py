@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from .streaming import RegistrosJson
+
+CHECKPOINT_DIR = os.path.join("output", "checkpoint_option2")
+# Una descarga del 1003 más vieja que esto no se reutiliza al reanudar
+CHECKPOINT_TTL = int(os.getenv("CHECKPOINT_TTL_SEGUNDOS", str(12 * 3600)))
+
+
+def huella_datos(datos) -> str:
+    """
+    Huella de la entrada de una etapa. Para RegistrosJson se usa el archivo
+    (ruta, tamaño, mtime) y así no se relee el reporte completo.
+    """
+    h = hashlib.sha1()
+    if isinstance(datos, RegistrosJson):
+        st = os.stat(datos.ruta)
+        h.update(f"{datos.ruta}|{st.st_size}|{st.st_mtime_ns}".encode())
+    else:
+        h.update(json.dumps(datos, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8"))
+    return h.hexdigest()
+
+
+class DiarioCheckpoint:
+    """
+    Diario local de una corrida de option2: qué etapas terminaron (con la huella
+    de su entrada y dónde quedó su salida) y cuántos registros se llevan en las
+    etapas por registro. Si la entrada de una etapa cambió, su checkpoint (y el
+    progreso asociado) se descarta solo. Se borra al terminar la corrida.
+    """
+
+    def __init__(self, directorio: str = CHECKPOINT_DIR, ttl: int = CHECKPOINT_TTL):
+        self.directorio = directorio
+        self.ttl = ttl
+        self.ruta = os.path.join(directorio, "diario.json")
+        self._estado = self._cargar()
+
+    def _cargar(self) -> dict:
+        try:
+            with open(self.ruta, "r", encoding="utf-8") as f:
+                estado = json.load(f)
+        except FileNotFoundError:
+            return self._nuevo()
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Diario de checkpoint ilegible, se empieza de cero: {e}")
+            return self._nuevo()
+        if not isinstance(estado, dict) or time.time() - estado.get("creado", 0) > self.ttl:
+            print("ℹ️ Checkpoint de option2 vencido, se empieza de cero.")
+            return self._nuevo()
+        return estado
+
+    @staticmethod
+    def _nuevo() -> dict:
+        return {"creado": time.time(), "etapas": {}, "progreso": {}}
+
+    def _guardar(self):
+        os.makedirs(self.directorio, exist_ok=True)
+        tmp = f"{self.ruta}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self._estado, f, ensure_ascii=False)
+        os.replace(tmp, self.ruta)
+
+    def _valida(self, nombre, huella):
+        etapa = self._estado["etapas"].get(nombre)
+        if not etapa or etapa.get("entrada") != huella or not os.path.exists(etapa.get("salida", "")):
+            return None
+        return etapa
+
+    def etapa(self, nombre, entrada, fn):
+        """
+        Ejecuta fn() o, si la etapa ya terminó con la misma entrada, devuelve su
+        salida guardada. Las salidas RegistrosJson se registran por su ruta
+        (sin copiarlas); las listas se guardan en el directorio del diario.
+        """
+        huella = huella_datos(entrada)
+        guardada = self._valida(nombre, huella)
+        if guardada is not None:
+            print(f"⏩ Etapa '{nombre}' recuperada del checkpoint.")
+            if guardada.get("perezosa"):
+                return RegistrosJson(guardada["salida"], total=guardada.get("total"))
+            with open(guardada["salida"], "r", encoding="utf-8") as f:
+                return json.load(f)
+
+        salida = fn()
+        if salida is None:
+            return None
+        if isinstance(salida, RegistrosJson):
+            registro = {"entrada": huella, "salida": salida.ruta, "perezosa": True, "total": salida.total}
+        else:
+            os.makedirs(self.directorio, exist_ok=True)
+            ruta = os.path.join(self.directorio, f"{nombre}.json")
+            with open(ruta, "w", encoding="utf-8") as f:
+                json.dump(salida, f, ensure_ascii=False, default=str)
+            registro = {"entrada": huella, "salida": ruta}
+        self._estado["etapas"][nombre] = registro
+        self._guardar()
+        return salida
+
+    def progreso(self, nombre, entrada) -> int:
+        """Registros ya procesados de una etapa por registro (0 si la entrada cambió)."""
+        huella = huella_datos(entrada)
+        prog = self._estado["progreso"].get(nombre)
+        if not prog or prog.get("entrada") != huella:
+            self._estado["progreso"][nombre] = {"entrada": huella, "hechos": 0}
+            return 0
+        return int(prog.get("hechos", 0))
+
+    def avanzar(self, nombre, hechos: int):
+        """Marca 'hechos' registros como procesados y persiste el diario."""
+        self._estado["progreso"][nombre]["hechos"] = hechos
+        self._guardar()
+
+    def limpiar(self):
+        """Borra el diario y las salidas intermedias (corrida terminada)."""
+        shutil.rmtree(self.directorio, ignore_errors=True)
+        self._estado = self._nuevo()
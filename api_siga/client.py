@@ -1,11 +1,120 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-class ApiSigaClient:
-    def __init__(self, base_url, client_id, secreto):
+from .streaming import ERRORES_PARSEO, TAMANO_BLOQUE, escribir_json_stream, iterar_json_array, proyectar
+
+# Timeouts (connect, read) en segundos. Los reportes grandes tardan en
+# generarse del lado de SIGA, por eso su lectura tiene más margen.
+TIMEOUT_POR_DEFECTO = (10, 120)
+TIMEOUTS_POR_ENDPOINT = {
+    "obtener_token": (10, 30),
+    "talentotech2/autenticar": (10, 120),
+    "talentotech2/informacion_reporte_1003": (10, 600),
+    "talentotech2/informacion_reporte_992": (10, 300),
+    "talentotech2/informacion_reporte_622": (10, 300),
+    "talentotech2/informacion_reporte_775": (10, 300),
+    "talentotech2/informacion_reporte_997": (10, 300),
+}
+
+# Respuestas con las que SIGA rechaza un token vencido o inválido
+CODIGOS_RECHAZO_AUTH = (401, 403)
+
+# Política de reintentos común al cliente síncrono (urllib3) y al asíncrono
+# (aio.py): errores de conexión y 429/502/503/504 con backoff exponencial.
+# Un timeout de lectura no se reintenta: los reportes son POST costosos y así
+# el peor caso queda acotado a un solo timeout de lectura.
+REINTENTOS_CONEXION = 5
+REINTENTOS_ESTADO = 3
+BACKOFF = 1.0
+CODIGOS_REINTENTO = (429, 502, 503, 504)
+
+
+def espera_reintento(intento: int, retry_after=None) -> float:
+    """Segundos antes del reintento número 'intento' (respeta Retry-After)."""
+    espera = BACKOFF * (2 ** intento)
+    if retry_after and str(retry_after).isdigit():
+        espera = max(espera, int(retry_after))
+    return espera
+
+
+def politica_reintentos() -> Retry:
+    return Retry(
+        total=REINTENTOS_CONEXION,
+        connect=REINTENTOS_CONEXION,
+        read=0,
+        status=REINTENTOS_ESTADO,
+        backoff_factor=BACKOFF,
+        status_forcelist=CODIGOS_REINTENTO,
+        allowed_methods=frozenset(["GET", "POST"]),
+        raise_on_status=False,
+    )
+
+
+def crear_sesion(pool_maxsize: int = 10) -> requests.Session:
+    """Sesión HTTP con keep-alive, pool de conexiones y politica_reintentos()."""
+    s = requests.Session()
+    adapter = HTTPAdapter(max_retries=politica_reintentos(), pool_connections=pool_maxsize, pool_maxsize=pool_maxsize)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    return s
+
+
+class _ClienteSigaBase:
+    """
+    Reglas comunes a ApiSigaClient y AsyncApiSigaClient (aio.py): URL y
+    cabeceras de un POST autenticado, timeouts por endpoint, tokens vigentes
+    del proveedor de auth y cuándo reautenticar ante un rechazo.
+    """
+
+    def _timeout(self, endpoint):
+        return self.timeouts.get(endpoint.strip("/"), TIMEOUT_POR_DEFECTO)
+
+    def _preparar_post(self, endpoint, extra_headers=None):
+        if not self.access_token and self.auth is None:
+            raise ValueError("Debe generar un token antes de hacer solicitudes.")
+
+        url = f"{self.base_url}/{endpoint.lstrip('/')}"
+        headers = {
+            'Authorization': f'Bearer {self.access_token}',
+            'Content-Type': 'application/json'
+        }
+        if extra_headers:
+            headers.update(extra_headers)
+        return url, headers
+
+    def _aplicar_tokens(self, headers, access_token, token_autenticacion):
+        """Sustituye en las cabeceras los tokens vigentes del proveedor de auth."""
+        self.access_token = access_token
+        headers['Authorization'] = f'Bearer {access_token}'
+        if 'token' in headers:
+            headers['token'] = access_token
+        if 'token_autenticacion' in headers:
+            headers['token_autenticacion'] = token_autenticacion
+
+    def _token_rechazado(self, status_code, endpoint, headers):
+        """
+        access_token rechazado si SIGA respondió 401/403 y hay proveedor de auth
+        (se reautentica una sola vez y se reintenta); None si no corresponde.
+        """
+        if status_code not in CODIGOS_RECHAZO_AUTH or self.auth is None:
+            return None
+        print(f"🔑 {endpoint} rechazó el token ({status_code}); reautenticando…")
+        return headers['Authorization'].split(' ', 1)[1]
+
+
+class ApiSigaClient(_ClienteSigaBase):
+    def __init__(self, base_url, client_id, secreto, timeouts=None, session=None):
         self.base_url = base_url.rstrip("/")
         self.client_id = client_id
         self.secreto = secreto
         self.access_token = None
+        self.token_expira_en = None
+        # Proveedor de autenticación (api_siga.auth.SigaAuthProvider), opcional
+        self.auth = None
+        self.timeouts = {**TIMEOUTS_POR_ENDPOINT, **(timeouts or {})}
+        # Una sola sesión por cliente: reutiliza conexiones TCP/TLS entre reportes
+        self.session = session or crear_sesion()
 
     def generar_token(self):
         """Obtiene el token de autenticación"""
@@ -16,10 +125,11 @@ class ApiSigaClient:
         }
 
         try:
-            response = requests.post(url, data=data)
+            response = self.session.post(url, data=data, timeout=self._timeout("obtener_token"))
             response.raise_for_status()
             resultado = response.json()
             self.access_token = resultado.get("access_token")
+            self.token_expira_en = resultado.get("expires_in")
             if not self.access_token:
                 raise ValueError("No se recibió access_token en la respuesta.")
             print(f"✅ Token generado: {self.access_token}")
@@ -32,6 +142,29 @@ class ApiSigaClient:
             print(f"❌ Error en la respuesta de token: {ve}")
             return None
 
+    def autenticar(self, username, password):
+        """
+        Autentica el usuario API (multipart) y devuelve la respuesta completa
+        de SIGA (RESPUESTA, TOKEN, EXPIRA_EN, ...).
+        """
+        if not self.access_token:
+            raise ValueError("Debe generar un token antes de autenticar.")
+
+        from requests_toolbelt.multipart.encoder import MultipartEncoder
+
+        endpoint = "talentotech2/autenticar"
+        data = MultipartEncoder(fields={"username": username, "password": password})
+        headers = {"auth_token": self.access_token, "Content-Type": data.content_type}
+
+        response = self.session.post(
+            f"{self.base_url}/{endpoint}",
+            headers=headers,
+            data=data,
+            timeout=self._timeout(endpoint),
+        )
+        response.raise_for_status()
+        return response.json()
+
     def get(self, endpoint, params=None):
         """Realiza solicitudes GET autenticadas"""
         if not self.access_token:
@@ -41,7 +174,7 @@ class ApiSigaClient:
         headers = {'Authorization': f'Bearer {self.access_token}'}
 
         try:
-            response = requests.get(url, headers=headers, params=params)
+            response = self.session.get(url, headers=headers, params=params, timeout=self._timeout(endpoint))
             response.raise_for_status()
             return response.json()
 
@@ -49,25 +182,64 @@ class ApiSigaClient:
             print(f"❌ Error en GET {endpoint}: {e}")
             return None
 
-    def post(self, endpoint, json_data=None, extra_headers=None):
-        """Realiza solicitudes POST autenticadas (reportes)"""
-        if not self.access_token:
-            raise ValueError("Debe generar un token antes de hacer solicitudes.")
+    def _post_autenticado(self, endpoint, json_data=None, extra_headers=None, stream=False):
+        """POST con tokens vigentes y un único reintento si SIGA rechaza el token."""
+        url, headers = self._preparar_post(endpoint, extra_headers)
+        if self.auth is not None:
+            self._aplicar_tokens(headers, *self.auth.tokens())
+        kwargs = dict(headers=headers, json=json_data, timeout=self._timeout(endpoint), stream=stream)
+        response = self.session.post(url, **kwargs)
+        rechazado = self._token_rechazado(response.status_code, endpoint, headers)
+        if rechazado:
+            response.close()
+            self._aplicar_tokens(headers, *self.auth.renovar(rechazado=rechazado))
+            response = self.session.post(url, **kwargs)
+        response.raise_for_status()
+        return response
 
-        url = f"{self.base_url}/{endpoint.lstrip('/')}"
-        headers = {
-            'Authorization': f'Bearer {self.access_token}',
-            'Content-Type': 'application/json'
-        }
+    def post(self, endpoint, json_data=None, extra_headers=None, columnas=None):
+        """
+        Realiza solicitudes POST autenticadas (reportes).
+        Con 'columnas' la proyección se aplica mientras se parsea la respuesta:
+        los campos no pedidos nunca llegan a la lista devuelta.
+        """
+        try:
+            if not columnas:
+                response = self._post_autenticado(endpoint, json_data, extra_headers)
+                return response.json()
+            with self._post_autenticado(endpoint, json_data, extra_headers, stream=True) as response:
+                bloques = response.iter_content(chunk_size=TAMANO_BLOQUE)
+                return list(proyectar(iterar_json_array(bloques), columnas))
 
-        if extra_headers:
-            headers.update(extra_headers)
+        except requests.RequestException as e:
+            print(f"❌ Error en POST {endpoint}: {e}")
+            return None
+        except ERRORES_PARSEO as ve:
+            # Solo errores del cuerpo: la falta de token (ValueError) se propaga
+            print(f"❌ Respuesta inválida en POST {endpoint}: {ve}")
+            return None
 
+    def post_stream(self, endpoint, destino, json_data=None, extra_headers=None, columnas=None):
+        """
+        POST de reporte leído por partes: los registros se escriben en 'destino'
+        a medida que llegan (sin json() ni indent) y se devuelve un iterador
+        perezoso (RegistrosJson) sobre ese archivo en lugar de una lista.
+        'columnas' limita los campos que se guardan de cada registro.
+        Retorna None si la solicitud falla.
+        """
         try:
-            response = requests.post(url, headers=headers, json=json_data)
-            response.raise_for_status()
-            return response.json()
+            with self._post_autenticado(endpoint, json_data, extra_headers, stream=True) as response:
+                bloques = response.iter_content(chunk_size=TAMANO_BLOQUE)
+                registros = escribir_json_stream(proyectar(iterar_json_array(bloques), columnas), destino)
+            print(f"✅ {endpoint}: {registros.total} registros guardados en {destino}")
+            return registros
 
         except requests.RequestException as e:
             print(f"❌ Error en POST {endpoint}: {e}")
             return None
+        except ERRORES_PARSEO as ve:
+            print(f"❌ Respuesta inválida en POST {endpoint}: {ve}")
+            return None
+
+    def close(self):
+        self.session.close()
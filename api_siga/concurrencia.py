@@ -0,0 +1,64 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .client import CODIGOS_REINTENTO, REINTENTOS_ESTADO, espera_reintento
+
+# Valores por defecto para las llamadas a Moodle (se pueden ajustar en el .env)
+MOODLE_HILOS = int(os.getenv("MOODLE_HILOS", "8"))
+MOODLE_TASA = float(os.getenv("MOODLE_TASA", "10"))  # solicitudes por segundo
+
+
+class LimitadorTasa:
+    """
+    Token bucket compartido entre hilos: como máximo 'tasa' solicitudes por
+    segundo en promedio, con ráfagas de hasta 'capacidad'. tasa <= 0 desactiva
+    el límite.
+    """
+
+    def __init__(self, tasa: float = MOODLE_TASA, capacidad: int | None = None):
+        self.tasa = float(tasa)
+        self.capacidad = float(capacidad or max(1, int(self.tasa)))
+        self._fichas = self.capacidad
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def adquirir(self):
+        if self.tasa <= 0:
+            return
+        while True:
+            with self._lock:
+                ahora = time.monotonic()
+                self._fichas = min(self.capacidad, self._fichas + (ahora - self._ultimo) * self.tasa)
+                self._ultimo = ahora
+                if self._fichas >= 1:
+                    self._fichas -= 1
+                    return
+                espera = (1 - self._fichas) / self.tasa
+            time.sleep(espera)
+
+
+def con_reintentos(enviar, limitador=None, intentos: int = REINTENTOS_ESTADO):
+    """
+    Ejecuta enviar() (que devuelve un requests.Response) respetando el limitador
+    y con la misma política de reintentos que el cliente de SIGA (client.py):
+    CODIGOS_REINTENTO con espera_reintento (backoff exponencial y Retry-After).
+    Devuelve la última respuesta aunque siga siendo un error.
+    """
+    for intento in range(intentos + 1):
+        if limitador is not None:
+            limitador.adquirir()
+        response = enviar()
+        if response.status_code not in CODIGOS_REINTENTO or intento == intentos:
+            return response
+        time.sleep(espera_reintento(intento, response.headers.get("Retry-After")))
+
+
+def mapa_concurrente(fn, items, max_workers: int = MOODLE_HILOS):
+    """Aplica fn a cada item en un pool de hilos; el resultado conserva el orden de entrada."""
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [fn(x) for x in items]
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="siga-moodle") as pool:
+        return list(pool.map(fn, items))
@@ -0,0 +1,134 @@
+import re
+import sys
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+# Documento "numérico canónico": sin ceros a la izquierda y que cabe en int64.
+# "00123" sigue siendo texto para no confundirlo con 123.
+_PATRON_NUMERICO = r"0|[1-9]\d{0,17}"
+_RE_NUMERICO = re.compile(_PATRON_NUMERICO)
+
+
+def _texto_documento(x):
+    """Texto normalizado del documento (sin espacios, comas ni '.0' final) o None."""
+    if x is None or (pd.api.types.is_scalar(x) and pd.isna(x)):
+        return None
+    s = str(x).strip().replace(",", "")
+    if s.endswith(".0"):
+        s = s[:-2]
+    return s or None
+
+
+def clave_documento(x, minusculas: bool = False):
+    """
+    Clave canónica de un documento (escalar): int si es numérico ("123", 123,
+    "123.0", "1,234"), str internado si no (pasaportes, ceros a la izquierda),
+    None si está vacío. minusculas=True para comparar contra usernames de
+    Moodle. Para columnas enteras usar claves_documento / ConjuntoDocumentos.
+    """
+    s = _texto_documento(x)
+    if s is None:
+        return None
+    if _RE_NUMERICO.fullmatch(s):
+        return int(s)
+    return sys.intern(s.lower() if minusculas else s)
+
+
+def texto_clave(clave) -> str:
+    """Clave canónica como texto (username/idnumber); '' si no hay documento."""
+    return "" if clave is None else str(clave)
+
+
+def _normalizar(valores):
+    """(Serie original, Serie str normalizada solo de los no vacíos, indexada por posición)."""
+    serie = valores if isinstance(valores, pd.Series) else pd.Series(list(valores), dtype=object)
+    arr = serie.to_numpy(dtype=object)
+    pos = np.flatnonzero(~pd.isna(arr))
+    texto = (
+        pd.Series(arr[pos], index=pos, dtype=object).astype(str).str.strip()
+        .str.replace(",", "", regex=False)
+        .str.replace(r"\.0$", "", regex=True)
+    )
+    return serie, texto[texto != ""]
+
+
+class ClavesDocumento(NamedTuple):
+    """
+    Claves canónicas de una columna, en dos partes con el índice original:
+    'numero' (Int64: int64 + máscara, NA donde no es numérico) y 'texto'
+    (object: str internado solo donde no es numérico, None en el resto).
+    """
+    numero: pd.Series
+    texto: pd.Series
+
+    def escalares(self) -> list:
+        """Las mismas claves que clave_documento, una por fila (para lógica fila a fila)."""
+        numeros = self.numero.to_numpy(dtype=object, na_value=None)
+        return [t if n is None else int(n) for n, t in zip(numeros, self.texto.to_numpy())]
+
+
+def claves_documento(valores, minusculas: bool = False) -> ClavesDocumento:
+    """Versión vectorizada de clave_documento sobre una Serie (o iterable)."""
+    serie, texto = _normalizar(valores)
+    n = len(serie)
+    numerico = texto.str.fullmatch(_PATRON_NUMERICO).to_numpy(dtype=bool)
+
+    numeros = np.zeros(n, dtype=np.int64)
+    sin_numero = np.ones(n, dtype=bool)
+    if numerico.any():
+        numeros[texto.index[numerico]] = texto[numerico].astype(np.int64).to_numpy()
+        sin_numero[texto.index[numerico]] = False
+
+    textos = np.full(n, None, dtype=object)
+    resto = texto[~numerico]
+    if minusculas:
+        resto = resto.str.lower()
+    textos[resto.index] = [sys.intern(s) for s in resto]
+
+    return ClavesDocumento(
+        pd.Series(pd.arrays.IntegerArray(numeros, sin_numero), index=serie.index),
+        pd.Series(textos, index=serie.index, dtype=object),
+    )
+
+
+def textos_documento(valores, minusculas: bool = False) -> pd.Series:
+    """Clave canónica como texto para toda una columna ('' si no hay documento)."""
+    serie, texto = _normalizar(valores)
+    if minusculas:
+        texto = texto.str.lower()
+    textos = np.full(len(serie), "", dtype=object)
+    textos[texto.index] = texto.to_numpy()
+    return pd.Series(textos, index=serie.index, dtype=object)
+
+
+class ConjuntoDocumentos:
+    """
+    Conjunto compacto de documentos para pruebas de pertenencia: los numéricos
+    en un ndarray int64 ordenado (8 bytes por clave, búsqueda binaria) y el
+    resto en un frozenset de str internados.
+    """
+
+    def __init__(self, valores=(), minusculas: bool = False):
+        claves = claves_documento(valores, minusculas)
+        self._numeros = np.unique(claves.numero.dropna().to_numpy(dtype=np.int64))
+        self._textos = frozenset(claves.texto.dropna())
+
+    def __len__(self):
+        return len(self._numeros) + len(self._textos)
+
+    def __contains__(self, clave):
+        """clave: resultado de clave_documento (int, str o None)."""
+        if isinstance(clave, int):
+            i = np.searchsorted(self._numeros, clave)
+            return bool(i < len(self._numeros) and self._numeros[i] == clave)
+        return clave is not None and clave in self._textos
+
+    def contiene(self, claves: ClavesDocumento) -> np.ndarray:
+        """Máscara bool, fila por fila, de las claves que están en el conjunto."""
+        numero = claves.numero
+        con_numero = numero.notna().to_numpy()
+        dentro = np.zeros(len(numero), dtype=bool)
+        dentro[con_numero] = np.isin(numero[con_numero].to_numpy(dtype=np.int64), self._numeros)
+        return dentro | claves.texto.isin(self._textos).to_numpy()
@@ -0,0 +1,82 @@
+import hashlib
+import json
+import os
+
+from .documentos import clave_documento
+
+INDICE_1003_PATH = os.path.join("output", "indice_1003.json")
+
+
+def huella_fila(fila: dict) -> str:
+    """Hash estable de una fila (independiente del orden de las claves)."""
+    contenido = json.dumps(fila, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(contenido.encode("utf-8")).hexdigest()[:16]
+
+
+class IndiceSnapshot1003:
+    """
+    Índice compacto {clave_documento: hash} de la última corrida de option2 que
+    terminó bien. Permite pasar por comparación/verificación/matrícula solo
+    los documentos nuevos o cuyos datos cambiaron.
+
+    El índice nuevo queda pendiente en memoria y solo se persiste con
+    confirmar(): si la corrida falla, la siguiente vuelve a ver los cambios.
+    Los documentos que no terminaron bien se pasan en 'descartar' para que
+    la próxima corrida los vuelva a procesar.
+    """
+
+    def __init__(self, ruta: str = INDICE_1003_PATH, clave: str = "idnumber"):
+        self.ruta = ruta
+        self.clave = clave
+        self._pendiente = None
+
+    def cargar(self) -> dict:
+        try:
+            with open(self.ruta, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Índice 1003 ilegible, se hará corrida completa: {e}")
+            return {}
+        if not isinstance(data, dict):
+            return {}
+        # JSON solo guarda claves de texto: se vuelven a la clave canónica
+        return {clave_documento(doc): huella for doc, huella in data.items()}
+
+    def filtrar_cambios(self, filas, completo: bool = False) -> list:
+        """
+        Devuelve las filas nuevas o modificadas respecto al índice anterior
+        (todas si completo=True o no hay índice) y deja listo el índice nuevo.
+        """
+        anterior = {} if completo else self.cargar()
+        nuevo = {}
+        cambios = []
+        for fila in filas:
+            doc = clave_documento(fila.get(self.clave))
+            if doc is None:
+                continue
+            huella = huella_fila(fila)
+            nuevo[doc] = huella
+            if anterior.get(doc) != huella:
+                cambios.append(fila)
+        self._pendiente = nuevo
+        print(f"🔎 Snapshot 1003: {len(cambios)} de {len(nuevo)} documentos nuevos o modificados.")
+        return cambios
+
+    def confirmar(self, descartar=()) -> bool:
+        """
+        Persiste el índice calculado en filtrar_cambios (escritura atómica),
+        sin los documentos de 'descartar' (quedan como nuevos para la próxima).
+        """
+        if self._pendiente is None:
+            return False
+        for doc in descartar:
+            self._pendiente.pop(clave_documento(doc), None)
+        os.makedirs(os.path.dirname(self.ruta) or ".", exist_ok=True)
+        tmp = f"{self.ruta}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self._pendiente, f, separators=(",", ":"))
+        os.replace(tmp, self.ruta)
+        self._pendiente = None
+        return True
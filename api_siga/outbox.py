@@ -0,0 +1,199 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import requests
+
+from .sheets import SHEETS_INTERVALO, SHEETS_TAMANO_LOTE, enviar_lote_sheets
+
+OUTBOX_PATH = os.getenv("SIGA_OUTBOX_PATH", os.path.join("output", "outbox.sqlite3"))
+
+# Destinos de la bandeja
+DESTINO_SHEETS = "sheets"
+DESTINO_DB = "db"
+
+
+class BandejaSalida:
+    """
+    Bandeja de salida local (SQLite en modo WAL, solo agregar/borrar).
+    El bucle de matrícula solo inserta aquí; un drenador aparte entrega los
+    registros a Sheets y a Postgres. Lo no entregado sobrevive a reinicios.
+    """
+
+    def __init__(self, ruta: str = OUTBOX_PATH):
+        self.ruta = ruta
+        os.makedirs(os.path.dirname(ruta) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(ruta, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute("PRAGMA synchronous=NORMAL;")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pendientes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                destino TEXT NOT NULL,
+                tipo TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                intentos INTEGER NOT NULL DEFAULT 0,
+                creado REAL NOT NULL
+            );
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_pendientes_destino ON pendientes (destino, id);")
+
+    def agregar(self, destino, tipo, payload):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO pendientes (destino, tipo, payload, creado) VALUES (?, ?, ?, ?);",
+                (destino, tipo, json.dumps(payload, ensure_ascii=False, default=str), time.time()),
+            )
+
+    def tomar(self, destino, limite):
+        """Hasta 'limite' registros más antiguos del destino: [(id, tipo, payload)]."""
+        with self._lock:
+            filas = self._conn.execute(
+                "SELECT id, tipo, payload FROM pendientes WHERE destino = ? ORDER BY id LIMIT ?;",
+                (destino, limite),
+            ).fetchall()
+        return [(i, tipo, json.loads(payload)) for i, tipo, payload in filas]
+
+    def confirmar(self, ids):
+        """Borra los registros ya entregados."""
+        if not ids:
+            return
+        with self._lock:
+            self._conn.executemany("DELETE FROM pendientes WHERE id = ?;", [(i,) for i in ids])
+
+    def fallo(self, ids):
+        if not ids:
+            return
+        with self._lock:
+            self._conn.executemany("UPDATE pendientes SET intentos = intentos + 1 WHERE id = ?;", [(i,) for i in ids])
+
+    def pendientes(self, destino=None) -> int:
+        with self._lock:
+            if destino is None:
+                return self._conn.execute("SELECT COUNT(*) FROM pendientes;").fetchone()[0]
+            return self._conn.execute("SELECT COUNT(*) FROM pendientes WHERE destino = ?;", (destino,)).fetchone()[0]
+
+    def cerrar(self):
+        with self._lock:
+            self._conn.close()
+
+
+class DrenadorBandeja:
+    """
+    Hilo que vacía la BandejaSalida: filas de Sheets agrupadas por tipo y
+    usernames para usuarios_nivelacion/historial_nivelacion en lote. Si un
+    destino falla, sus registros quedan en la bandeja y se reintentan con
+    espera creciente (también en la próxima corrida).
+    """
+
+    def __init__(self, bandeja, sheets_url=None, sheet_id=None, db=None,
+                 tamano_lote=SHEETS_TAMANO_LOTE, intervalo=SHEETS_INTERVALO, espera_maxima=300):
+        self.bandeja = bandeja
+        self.sheets_url = sheets_url
+        self.sheet_id = sheet_id
+        self.db = db
+        self.tamano_lote = max(1, int(tamano_lote))
+        self.intervalo = max(0.1, float(intervalo))
+        self.espera_maxima = espera_maxima
+        self._session = requests.Session()
+        self._parar = threading.Event()
+        self._espera = {DESTINO_SHEETS: 0.0, DESTINO_DB: 0.0}
+        self._proximo = {DESTINO_SHEETS: 0.0, DESTINO_DB: 0.0}
+        self._hilo = threading.Thread(target=self._bucle, name="siga-outbox", daemon=True)
+        self._hilo.start()
+
+    def _registrar_resultado(self, destino, ok):
+        if ok:
+            self._espera[destino] = 0.0
+            self._proximo[destino] = 0.0
+        else:
+            self._espera[destino] = min(self.espera_maxima, (self._espera[destino] or self.intervalo) * 2)
+            self._proximo[destino] = time.monotonic() + self._espera[destino]
+
+    def _drenar_sheets(self):
+        if not self.sheets_url:
+            return False
+        registros = self.bandeja.tomar(DESTINO_SHEETS, self.tamano_lote * 10)
+        if not registros:
+            return False
+        por_tipo = {}
+        for i, tipo, datos in registros:
+            por_tipo.setdefault(tipo, []).append((i, datos))
+        for tipo, items in por_tipo.items():
+            for inicio in range(0, len(items), self.tamano_lote):
+                lote = items[inicio:inicio + self.tamano_lote]
+                ids = [i for i, _ in lote]
+                ok, error = enviar_lote_sheets(
+                    self._session, self.sheets_url, self.sheet_id, tipo, [d for _, d in lote], self.tamano_lote
+                )
+                if not ok:
+                    print(f"⚠️ Sheets no disponible ({error}); {len(ids)} fila(s) quedan en la bandeja")
+                    self.bandeja.fallo(ids)
+                    self._registrar_resultado(DESTINO_SHEETS, False)
+                    return False
+                self.bandeja.confirmar(ids)
+                print(f"📝 {len(ids)} fila(s) registradas en hoja de {tipo}")
+        self._registrar_resultado(DESTINO_SHEETS, True)
+        return True
+
+    def _drenar_db(self):
+        if self.db is None:
+            return False
+        registros = self.bandeja.tomar(DESTINO_DB, 1000)
+        if not registros:
+            return False
+        por_estado = {}
+        for i, estado, datos in registros:
+            por_estado.setdefault(estado, []).append((i, datos.get("username")))
+        for estado, items in por_estado.items():
+            ids = [i for i, _ in items]
+            if not self.db.agregar_usuarios_lote([u for _, u in items], estado):
+                self.bandeja.fallo(ids)
+                self._registrar_resultado(DESTINO_DB, False)
+                return False
+            self.bandeja.confirmar(ids)
+            print(f"✅ {len(ids)} usuario(s) registrados en BD como {estado}")
+        self._registrar_resultado(DESTINO_DB, True)
+        return True
+
+    def drenar(self, forzar=False):
+        """Una pasada por cada destino (respetando la espera tras un fallo salvo forzar)."""
+        ahora = time.monotonic()
+        hubo = False
+        if forzar or ahora >= self._proximo[DESTINO_SHEETS]:
+            hubo |= self._drenar_sheets()
+        if forzar or ahora >= self._proximo[DESTINO_DB]:
+            hubo |= self._drenar_db()
+        return hubo
+
+    def _bucle(self):
+        while not self._parar.is_set():
+            try:
+                # Mientras haya trabajo se sigue drenando sin esperar
+                if self.drenar():
+                    continue
+            except Exception as e:
+                print(f"⚠️ Error drenando bandeja de salida: {e}")
+            self._parar.wait(self.intervalo)
+
+    def cerrar(self, intentos=3):
+        """Detiene el hilo y hace unas últimas pasadas; lo que no salga queda en la bandeja."""
+        self._parar.set()
+        self._hilo.join()
+        for _ in range(intentos):
+            try:
+                while self.drenar(forzar=True):
+                    pass
+            except Exception as e:
+                print(f"⚠️ Error drenando bandeja de salida: {e}")
+            if not self.bandeja.pendientes():
+                break
+            time.sleep(2)
+        restantes = self.bandeja.pendientes()
+        if restantes:
+            print(f"📦 {restantes} registro(s) siguen en la bandeja de salida; se entregarán en la próxima corrida")
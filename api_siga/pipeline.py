@@ -0,0 +1,119 @@
+import json
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+logger = logging.getLogger("siga")
+
+
+class Paso:
+    """
+    Nodo del grafo de ejecución.
+    - fn: callable sin argumentos (lee/escribe sus propios insumos).
+    - depende_de: nombres de pasos que deben terminar antes.
+    - critico: si falla un paso no crítico se registra y el grafo sigue.
+    """
+
+    def __init__(self, nombre, fn, depende_de=(), critico=True):
+        self.nombre = nombre
+        self.fn = fn
+        self.depende_de = tuple(depende_de)
+        self.critico = critico
+
+
+def ejecutar_grafo(pasos, max_workers=4):
+    """
+    Ejecuta los pasos en cuanto sus dependencias terminan; los independientes
+    corren en paralelo. Devuelve (resultados, tiempos) con los segundos de cada
+    paso. Si un paso crítico falla, no se lanzan más pasos y se relanza el error.
+    """
+    por_nombre = {p.nombre: p for p in pasos}
+    for p in pasos:
+        faltan = [d for d in p.depende_de if d not in por_nombre]
+        if faltan:
+            raise ValueError(f"Paso '{p.nombre}' depende de pasos inexistentes: {faltan}")
+
+    resultados, tiempos = {}, {}
+    pendientes = dict(por_nombre)
+    terminados = set()
+    en_curso = {}
+    error = None
+
+    def _medir(paso):
+        inicio = time.perf_counter()
+        try:
+            return paso.fn()
+        finally:
+            tiempos[paso.nombre] = round(time.perf_counter() - inicio, 3)
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="siga-paso") as pool:
+        while pendientes or en_curso:
+            if error is None:
+                listos = [p for p in pendientes.values() if set(p.depende_de) <= terminados]
+                for p in listos:
+                    del pendientes[p.nombre]
+                    en_curso[pool.submit(_medir, p)] = p
+            if not en_curso:
+                if pendientes and error is None:
+                    raise ValueError(f"Dependencias circulares entre: {sorted(pendientes)}")
+                break
+
+            hechos, _ = wait(en_curso, return_when=FIRST_COMPLETED)
+            for futuro in hechos:
+                paso = en_curso.pop(futuro)
+                try:
+                    resultados[paso.nombre] = futuro.result()
+                    logger.info(f"Paso '{paso.nombre}' OK en {tiempos[paso.nombre]}s")
+                except Exception as e:
+                    if paso.critico:
+                        logger.error(f"Paso '{paso.nombre}' falló en {tiempos.get(paso.nombre)}s: {e}")
+                        error = error or e
+                    else:
+                        logger.warning(f"Paso '{paso.nombre}' (no crítico) falló: {e}")
+                        resultados[paso.nombre] = None
+                terminados.add(paso.nombre)
+
+    if error is not None:
+        raise error
+    return resultados, tiempos
+
+
+class EscritorArtefactos:
+    """
+    Escribe en segundo plano (un solo hilo, en orden) los JSON intermedios que
+    antes se usaban para pasar datos entre etapas. Las etapas siguen con las
+    filas en memoria; los archivos quedan como auditoría.
+    """
+
+    def __init__(self, activo=True):
+        self.activo = activo
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="siga-artefactos") if activo else None
+        self._pendientes = []
+
+    @staticmethod
+    def _escribir(ruta, filas):
+        os.makedirs(os.path.dirname(ruta) or ".", exist_ok=True)
+        tmp = f"{ruta}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(filas, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, ruta)
+
+    def programar(self, ruta, filas):
+        """Encola la escritura de 'filas' en 'ruta' (no hace nada si está inactivo)."""
+        if self._pool is None or filas is None:
+            return
+        self._pendientes.append((ruta, self._pool.submit(self._escribir, ruta, list(filas))))
+
+    def cerrar(self):
+        """Espera a que terminen las escrituras; los fallos solo se registran."""
+        if self._pool is None:
+            return
+        for ruta, futuro in self._pendientes:
+            try:
+                futuro.result()
+            except Exception as e:
+                logger.warning(f"No se pudo escribir el artefacto {ruta}: {e}")
+        self._pendientes.clear()
+        self._pool.shutdown(wait=True)
+        self._pool = None
@@ -1,154 +1,293 @@
+import asyncio
+import functools
 import json
+import logging
+import os
+import tempfile
+import threading
 from datetime import datetime
 from pathlib import Path
 
+from .aio import AsyncApiSigaClient, ejecutar
 
+logger = logging.getLogger("siga")
 
-class SigaServices:
-    def __init__(self, client):
+# Columnas que realmente usa el pipeline (generar_csv_con_informacionj,
+# extraer_columnas_reporte_1003 y combinar_reportes). Pasarlas como
+# proyección evita parsear/guardar el resto de campos de cada estudiante.
+COLUMNAS_1003_PIPELINE = (
+    'documento_numero', 'nombres', 'apellidos', 'telefono_celular',
+    'correo_electronico', 'departamento', 'municipio',
+    'modalidad_formacion', 'programa_interes', 'inscripcion_aprobada',
+)
+COLUMNAS_992_PIPELINE = (
+    'documento_estudiante', 'estado_en_ciclo', 'grupo', 'cod_periodo_academico',
+)
+PROYECCIONES_PIPELINE = {
+    "1003": COLUMNAS_1003_PIPELINE,
+    "992": COLUMNAS_992_PIPELINE,
+}
+
+
+# Código de periodo SIGA -> etiqueta que se escribe en 'cod_periodo_academico'
+MAPEO_PERIODOS_992 = {
+    "2025012710": "2025-5",
+    "2025011112": "2025-1",
+    "2024101510": "2024-4",
+    "2024100708": "2024-3",
+    "2024091608": "2024-2",
+    "2024090208": "2024-1",
+}
+
+
+def _normalizar_payload_992(resp):
+    """Respuesta cruda del 992 -> lista de dicts (o RuntimeError si no sirve)."""
+    if resp is None:
+        raise RuntimeError("SIGA no devolvió respuesta")
+
+    payload = resp
+    if isinstance(resp, dict):
+        payload = (
+            resp.get("data")
+            or resp.get("resultado")
+            or resp.get("items")
+            or resp.get("registros")
+            or resp
+        )
+
+    if isinstance(payload, dict):
+        payload = [payload]
+    elif not isinstance(payload, list):
+        raise RuntimeError(f"Respuesta inesperada ({type(payload).__name__})")
+    return payload
+
+
+def _etiquetar_periodo_992(payload, cod_str):
+    """Reescribe 'cod_periodo_academico' con el valor mapeado (ej: 2025-5)."""
+    periodo_mapeado = MAPEO_PERIODOS_992.get(cod_str, cod_str)
+    for item in payload:
+        if isinstance(item, dict):
+            item["cod_periodo_academico"] = periodo_mapeado
+    return payload
+
+
+def _escribir_992_completo(consolidadas, outfile_path=None):
+    """
+    Escribe el 992 consolidado en un temporal propio y lo renombra: quien lea
+    outfile_path (combinar_reportes) nunca ve un archivo a medias ni mezclado
+    con el de otra corrida simultánea.
+    """
+    if outfile_path is None:
+        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+        outfile_path = f"reporte_992_completo_{ts}.json"
+
+    outfile = Path(outfile_path)
+    outfile.parent.mkdir(parents=True, exist_ok=True)
+    f = tempfile.NamedTemporaryFile(
+        "w", encoding="utf-8", dir=outfile.parent, prefix=f"{outfile.name}.", suffix=".tmp", delete=False
+    )
+    try:
+        with f:
+            json.dump(consolidadas, f, ensure_ascii=False, indent=2)
+        os.replace(f.name, outfile)
+    finally:
+        if os.path.exists(f.name):
+            os.remove(f.name)
+    return str(outfile)
+
+
+class PeriodoFallidoError(RuntimeError):
+    """Uno o más periodos del 992 no pudieron descargarse. `fallos` = {cod_periodo: detalle}."""
+
+    def __init__(self, fallos):
+        self.fallos = fallos
+        detalle = ", ".join(f"{cod}: {msg}" for cod, msg in fallos.items())
+        super().__init__(f"Fallaron {len(fallos)} periodo(s) del reporte 992 -> {detalle}")
+
+
+class AsyncSigaServices:
+    """
+    Implementación única de los reportes de SIGA sobre AsyncApiSigaClient.
+    SigaServices es la versión síncrona de esta misma clase.
+    """
+
+    def __init__(self, client, cache_992=None, proyecciones=None):
         self.client = client
+        # Cache992 opcional: periodos cerrados del 992 se sirven desde disco
+        self.cache_992 = cache_992
+        # Proyección de columnas por reporte, p.ej. {"1003": COLUMNAS_1003_PIPELINE}
+        self.proyecciones = dict(proyecciones or {})
 
-    def consultar_reporte_622(self, token, token_autenticacion, periodo, soloactivos=True, solo_matriculados=True):
-        endpoint = "talentotech2/informacion_reporte_622"
-        headers = {
-            'token': token,
-            'token_autenticacion': token_autenticacion
-        }
+    async def _consultar(self, endpoint, body, token, token_autenticacion, destino=None, reporte=None):
+        """
+        Sin 'destino' devuelve la lista completa (como siempre). Con 'destino'
+        el cuerpo se procesa en streaming directo a ese archivo y se devuelve
+        un iterador perezoso de registros (ver api_siga/streaming.py).
+        Si el reporte tiene proyección declarada, se aplica durante el parseo.
+        """
+        headers = {'token': token, 'token_autenticacion': token_autenticacion}
+        columnas = self.proyecciones.get(reporte)
+        if destino:
+            return await self.client.post_stream(
+                endpoint, destino, json_data=body, extra_headers=headers, columnas=columnas
+            )
+        return await self.client.post(endpoint, json_data=body, extra_headers=headers, columnas=columnas)
+
+    async def consultar_reporte_622(self, token, token_autenticacion, periodo, soloactivos=True, solo_matriculados=True, destino=None):
         body = {
             "periodo": periodo,
             "soloactivos": soloactivos,
             "solo_matriculados": solo_matriculados
         }
-        return self.client.post(endpoint, json_data=body, extra_headers=headers)
+        return await self._consultar(
+            "talentotech2/informacion_reporte_622", body, token, token_autenticacion, destino, reporte="622"
+        )
 
-    def consultar_reporte_1003(self, token, token_autenticacion, soloactivos=True):
-        endpoint = "talentotech2/informacion_reporte_1003"
-        headers = {
-            'token': token,
-            'token_autenticacion': token_autenticacion
-        }
+    async def consultar_reporte_1003(self, token, token_autenticacion, soloactivos=True, destino=None):
         body = {
             "soloactivos": soloactivos
         }
-        return self.client.post(endpoint, json_data=body, extra_headers=headers)
+        return await self._consultar(
+            "talentotech2/informacion_reporte_1003", body, token, token_autenticacion, destino, reporte="1003"
+        )
 
-    def consultar_reporte_775(self, token, token_autenticacion, periodo, soloactivos=True):
-        endpoint = "talentotech2/informacion_reporte_775"
-        headers = {
-            'token': token,
-            'token_autenticacion': token_autenticacion
-        }
+    async def consultar_reporte_775(self, token, token_autenticacion, periodo, soloactivos=True, destino=None):
         body = {
             "periodo": periodo,
             "soloactivos": soloactivos
         }
-        return self.client.post(endpoint, json_data=body, extra_headers=headers)
+        return await self._consultar(
+            "talentotech2/informacion_reporte_775", body, token, token_autenticacion, destino, reporte="775"
+        )
 
-    def consultar_reporte_997(self, token, token_autenticacion, ano_periodo, soloactivos=False):
-        endpoint = "talentotech2/informacion_reporte_997"
-        headers = {
-            'token': token,
-            'token_autenticacion': token_autenticacion
-        }
+    async def consultar_reporte_997(self, token, token_autenticacion, ano_periodo, soloactivos=False, destino=None):
         body = {
             "ano_periodo": ano_periodo,
             "soloactivos": soloactivos
         }
-        return self.client.post(endpoint, json_data=body, extra_headers=headers)
-
-    def consultar_reporte_992(self, token, token_autenticacion, cod_periodo_academico, solo_pendientes_matricula=False):
-        endpoint = "talentotech2/informacion_reporte_992"
-        headers = {
-            'token': token,
-            'token_autenticacion': token_autenticacion
-        }
-        body = {
-            "cod_periodo_academico": cod_periodo_academico,
-            "solo_pendientes_matricula": solo_pendientes_matricula
-        }
-        return self.client.post(endpoint, json_data=body, extra_headers=headers)
+        return await self._consultar(
+            "talentotech2/informacion_reporte_997", body, token, token_autenticacion, destino, reporte="997"
+        )
 
-    def consultar_reporte_992(self, token, token_autenticacion, cod_periodo_academico, solo_pendientes_matricula=False):
-        endpoint = "talentotech2/informacion_reporte_992"
-        headers = {'token': token, 'token_autenticacion': token_autenticacion}
+    async def consultar_reporte_992(self, token, token_autenticacion, cod_periodo_academico, solo_pendientes_matricula=False):
         body = {
             "cod_periodo_academico": cod_periodo_academico,
             "solo_pendientes_matricula": solo_pendientes_matricula
         }
-        return self.client.post(endpoint, json_data=body, extra_headers=headers)
+        return await self._consultar(
+            "talentotech2/informacion_reporte_992", body, token, token_autenticacion, reporte="992"
+        )
 
-    def consultar_reporte_992_completo(
+    async def consultar_reporte_992_completo(
         self,
         token: str,
         token_autenticacion: str,
         cod_periodos: list,
         solo_pendientes_matricula: bool = False,
-        outfile_path: str | None = None
+        outfile_path: str | None = None,
+        max_concurrencia: int = 6,
+        permitir_fallos: bool = False,
+        guardar: bool = True,
     ):
         """
         Consolida EXACTAMENTE 6 periodos del reporte 992 en un solo JSON.
         Reescribe 'cod_periodo_academico' con el formato requerido (ej: 2025-5).
-        Retorna (ruta_archivo, lista_registros).
+        Los periodos se consultan a la vez en el mismo event loop (como máximo
+        max_concurrencia) y se consolidan en el mismo orden de 'cod_periodos'.
+        Si algún periodo falla se lanza PeriodoFallidoError, salvo que
+        permitir_fallos=True (en ese caso se omite y se registra en el log).
+        Con self.cache_992 los periodos cerrados se leen de disco y solo los
+        abiertos se vuelven a consultar en SIGA.
+        Retorna (ruta_archivo, lista_registros); con guardar=False no se
+        escribe ningún archivo y la ruta es None.
         """
         # Validar longitud
         if not isinstance(cod_periodos, (list, tuple)) or len(cod_periodos) != 6:
             raise ValueError("Debes enviar exactamente 6 cod_periodo_academico en 'cod_periodos'.")
 
-        # Mapeo solicitado
-        mapping = {
-            "2025012710": "2025-5",
-            "2025011112": "2025-1",
-            "2024101510": "2024-4",
-            "2024100708": "2024-3",
-            "2024091608": "2024-2",
-            "2024090208": "2024-1",
-        }
+        columnas_992 = self.proyecciones.get("992")
+        semaforo = asyncio.Semaphore(max(1, max_concurrencia))
 
+        async def _consultar_periodo(cod_str):
+            # Periodos cerrados: se sirven desde la caché si ya se descargaron
+            payload = None
+            if self.cache_992 is not None:
+                payload = await asyncio.to_thread(
+                    self.cache_992.obtener, cod_str, solo_pendientes_matricula, columnas_992
+                )
+                if payload is not None:
+                    logger.info(f"Reporte 992: periodo {cod_str} desde caché ({len(payload)} registros)")
+            if payload is None:
+                async with semaforo:
+                    resp = await self.consultar_reporte_992(
+                        token, token_autenticacion, cod_str, solo_pendientes_matricula
+                    )
+                payload = _normalizar_payload_992(resp)
+                if self.cache_992 is not None:
+                    await asyncio.to_thread(
+                        self.cache_992.guardar, cod_str, payload, solo_pendientes_matricula, columnas_992
+                    )
+            return _etiquetar_periodo_992(payload, cod_str)
+
+        cods = [str(cod) for cod in cod_periodos]
+        resultados = await asyncio.gather(*(_consultar_periodo(c) for c in cods), return_exceptions=True)
+
+        # Consolidar en el orden original de los periodos
         consolidadas = []
+        fallos = {}
+        for cod, res in zip(cods, resultados):
+            if isinstance(res, BaseException):
+                if isinstance(res, asyncio.CancelledError):
+                    raise res
+                logger.warning(f"Reporte 992: periodo {cod} falló: {res}")
+                fallos[cod] = str(res)
+            else:
+                consolidadas.extend(res)
 
-        for cod in cod_periodos:
-            cod_str = str(cod)
+        if fallos and not permitir_fallos:
+            raise PeriodoFallidoError(fallos)
 
-            # Llamada al servicio base
-            resp = self.consultar_reporte_992(
-                token=token,
-                token_autenticacion=token_autenticacion,
-                cod_periodo_academico=cod_str,
-                solo_pendientes_matricula=solo_pendientes_matricula
-            )
+        if not guardar:
+            return None, consolidadas
+        ruta = await asyncio.to_thread(_escribir_992_completo, consolidadas, outfile_path)
+        return ruta, consolidadas
 
-            # Normalizar payload -> lista de dicts
-            payload = resp
-            if isinstance(resp, dict):
-                payload = (
-                    resp.get("data")
-                    or resp.get("resultado")
-                    or resp.get("items")
-                    or resp.get("registros")
-                    or resp
-                )
 
-            if isinstance(payload, dict):
-                payload = [payload]
-            elif not isinstance(payload, list):
-                payload = []
+_clientes_async_lock = threading.Lock()
 
-            # Reescribir el campo con el valor mapeado
-            periodo_mapeado = mapping.get(cod_str, cod_str)
-            for item in payload:
-                if isinstance(item, dict):
-                    item["cod_periodo_academico"] = periodo_mapeado
 
-            consolidadas.extend(payload)
+def _cliente_async(client):
+    """Un AsyncApiSigaClient por ApiSigaClient: todos los SigaServices sobre él comparten pool."""
+    with _clientes_async_lock:
+        aio = getattr(client, "_cliente_async", None)
+        if aio is None:
+            aio = client._cliente_async = AsyncApiSigaClient.desde_cliente(client)
+    return aio
 
-        # Escribir archivo
-        if outfile_path is None:
-            ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-            outfile_path = f"reporte_992_completo_{ts}.json"
 
-        outfile = Path(outfile_path)
-        outfile.parent.mkdir(parents=True, exist_ok=True)
-        with outfile.open("w", encoding="utf-8") as f:
-            json.dump(consolidadas, f, ensure_ascii=False, indent=2)
+def _sincrono(metodo):
+    """Versión bloqueante de un método de AsyncSigaServices (corre en aio.ejecutar)."""
+    @functools.wraps(metodo)
+    def envoltura(self, *args, **kwargs):
+        return ejecutar(metodo(self.aio, *args, **kwargs))
+    return envoltura
+
+
+class SigaServices:
+    """
+    API síncrona de los reportes: cada método corre el de AsyncSigaServices
+    en el event loop compartido del proceso (aio.bucle_compartido), así los
+    hilos que la usan (runners, pasos del grafo) comparten un solo pool de
+    conexiones y el 992 consulta sus periodos a la vez.
+    """
+
+    def __init__(self, client, cache_992=None, proyecciones=None):
+        self.client = client
+        self.aio = AsyncSigaServices(_cliente_async(client), cache_992=cache_992, proyecciones=proyecciones)
 
-        return str(outfile), consolidadas
+    consultar_reporte_622 = _sincrono(AsyncSigaServices.consultar_reporte_622)
+    consultar_reporte_1003 = _sincrono(AsyncSigaServices.consultar_reporte_1003)
+    consultar_reporte_775 = _sincrono(AsyncSigaServices.consultar_reporte_775)
+    consultar_reporte_997 = _sincrono(AsyncSigaServices.consultar_reporte_997)
+    consultar_reporte_992 = _sincrono(AsyncSigaServices.consultar_reporte_992)
+    consultar_reporte_992_completo = _sincrono(AsyncSigaServices.consultar_reporte_992_completo)
@@ -0,0 +1,124 @@
+import atexit
+import os
+import queue
+import threading
+import time
+
+import requests
+
+# Filas por POST al Apps Script. Con más de 1, "datos" es una lista de filas
+# y el script debe aceptarla; SHEETS_TAMANO_LOTE=1 vuelve al payload clásico
+# ({"datos": {...}}, una solicitud por fila) para un script sin actualizar.
+SHEETS_TAMANO_LOTE = int(os.getenv("SHEETS_TAMANO_LOTE", "50"))
+SHEETS_INTERVALO = float(os.getenv("SHEETS_INTERVALO", "5"))
+
+
+def enviar_lote_sheets(session, url, sheet_id, tipo, filas, tamano_lote=SHEETS_TAMANO_LOTE, timeout=30):
+    """
+    Un intento de POST al Apps Script con las filas de un tipo ("datos" es la
+    lista de filas). Con tamano_lote=1 se usa el payload clásico (una fila en
+    "datos"). Retorna (ok, detalle_error).
+    """
+    datos = filas[0] if tamano_lote == 1 else filas
+    payload = {"sheet_id": sheet_id, "tipo": tipo, "datos": datos}
+    try:
+        response = session.post(url, json=payload, headers={'Content-Type': 'application/json'}, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        return False, f"Error de conexión: {str(e)}"
+    if response.status_code == 200:
+        return True, None
+    return False, response.text[:300]
+
+
+class ReporteroSheets:
+    """
+    Envía a Google Sheets en segundo plano: las filas se acumulan por 'tipo'
+    y salen en bloques de hasta tamano_lote (SHEETS_TAMANO_LOTE, 50 por
+    defecto) cuando el bloque se llena o pasan 'intervalo' segundos. Antes de
+    enviar se toma todo lo que ya esté en la cola, así las filas encoladas
+    mientras un envío estaba en curso salen juntas. Los reintentos (con
+    espera) ocurren en el hilo del reportero, nunca en el bucle de matrícula.
+    cerrar() vacía todo lo pendiente.
+    """
+
+    def __init__(self, url, sheet_id, tamano_lote=SHEETS_TAMANO_LOTE, intervalo=SHEETS_INTERVALO,
+                 max_reintentos=3, timeout=30):
+        self.url = url
+        self.sheet_id = sheet_id
+        self.tamano_lote = max(1, int(tamano_lote))
+        self.intervalo = max(0.1, float(intervalo))
+        self.max_reintentos = max_reintentos
+        self.timeout = timeout
+        self.enviadas = 0
+        self.fallidas = 0
+        self._cola = queue.Queue()
+        self._session = requests.Session()
+        self._hilo = threading.Thread(target=self._bucle, name="siga-sheets", daemon=True)
+        self._hilo.start()
+        atexit.register(self.cerrar)
+
+    def encolar(self, tipo, datos):
+        """Agrega una fila (dict con las columnas de la hoja) para la hoja 'tipo'."""
+        self._cola.put((tipo, datos))
+
+    def _enviar(self, tipo, filas):
+        for intento in range(self.max_reintentos):
+            ok, error = enviar_lote_sheets(
+                self._session, self.url, self.sheet_id, tipo, filas, self.tamano_lote, self.timeout
+            )
+            if ok:
+                self.enviadas += len(filas)
+                print(f"📝 {len(filas)} fila(s) registradas en hoja de {tipo} (Intento {intento + 1})")
+                return True
+            print(f"⚠️ Error al registrar en hoja de {tipo} (Intento {intento + 1}): {error}")
+            if intento < self.max_reintentos - 1:
+                time.sleep(2 * (2 ** intento))
+        self.fallidas += len(filas)
+        print(f"❌ No se pudieron registrar {len(filas)} fila(s) de {tipo} después de {self.max_reintentos} intentos")
+        return False
+
+    def _vaciar(self, buffers, solo_llenos=False):
+        for tipo, filas in buffers.items():
+            while filas and (not solo_llenos or len(filas) >= self.tamano_lote):
+                lote, filas[:] = filas[:self.tamano_lote], filas[self.tamano_lote:]
+                self._enviar(tipo, lote)
+
+    def _tomar_encolados(self, buffers, item):
+        """Agrupa 'item' y todo lo que ya espera en la cola. True si llegó la señal de cierre."""
+        while True:
+            if item is None:
+                self._cola.task_done()
+                return True
+            if item:
+                tipo, datos = item
+                buffers.setdefault(tipo, []).append(datos)
+                self._cola.task_done()
+            try:
+                item = self._cola.get_nowait()
+            except queue.Empty:
+                return False
+
+    def _bucle(self):
+        buffers = {}
+        ultimo_envio = time.monotonic()
+        while True:
+            try:
+                item = self._cola.get(timeout=self.intervalo)
+            except queue.Empty:
+                item = ()
+            if self._tomar_encolados(buffers, item):
+                self._vaciar(buffers)
+                return
+            self._vaciar(buffers, solo_llenos=True)
+            if time.monotonic() - ultimo_envio >= self.intervalo:
+                self._vaciar(buffers)
+                ultimo_envio = time.monotonic()
+
+    def cerrar(self, timeout=None):
+        """Envía lo pendiente y detiene el hilo (idempotente)."""
+        if not self._hilo.is_alive():
+            return
+        self._cola.put(None)
+        self._hilo.join(timeout)
+        if self.enviadas or self.fallidas:
+            print(f"📊 Sheets: {self.enviadas} fila(s) registradas, {self.fallidas} sin registrar")
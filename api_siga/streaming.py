@@ -0,0 +1,166 @@
+import codecs
+import json
+import os
+import tempfile
+
+TAMANO_BLOQUE = 64 * 1024
+_ESPACIOS = " \t\r\n"
+_CLAVES_LISTA = ("data", "resultado", "items", "registros", "rows")
+
+
+class JsonInvalidoError(ValueError):
+    """El cuerpo no es la lista JSON esperada (truncado, mal formado u otro tipo)."""
+
+
+# Todo lo que puede lanzar el parseo de un cuerpo: se trata como respuesta
+# inválida, a diferencia de otros ValueError (p.ej. falta de token)
+ERRORES_PARSEO = (json.JSONDecodeError, UnicodeDecodeError, JsonInvalidoError)
+
+
+def iterar_json_array(bloques):
+    """
+    Parser incremental de un JSON cuyo nivel superior es una lista.
+    Recibe un iterable de bloques (bytes o str) y va entregando cada elemento
+    en cuanto está completo, sin tener el cuerpo entero en memoria.
+    Si el nivel superior es un objeto (p.ej. {"data": [...]} o un error de
+    SIGA) se lee completo y se entrega su lista, o se lanza JsonInvalidoError.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    bloques = iter(bloques)
+    buf = ""
+    pos = 0
+    fin = False
+
+    def _leer():
+        nonlocal buf, pos, fin
+        try:
+            bloque = next(bloques)
+        except StopIteration:
+            fin = True
+            buf = buf[pos:] + utf8.decode(b"", final=True)
+            pos = 0
+            return
+        if isinstance(bloque, bytes):
+            bloque = utf8.decode(bloque)
+        buf = buf[pos:] + bloque
+        pos = 0
+
+    # Inicio del documento (tolerante a BOM)
+    while True:
+        while pos < len(buf) and buf[pos] in _ESPACIOS + "\ufeff":
+            pos += 1
+        if pos < len(buf) or fin:
+            break
+        _leer()
+    if pos >= len(buf):
+        return
+
+    if buf[pos] != "[":
+        while not fin:
+            _leer()
+        data = json.loads(buf[pos:])
+        if isinstance(data, dict):
+            for clave in _CLAVES_LISTA:
+                if isinstance(data.get(clave), list):
+                    yield from data[clave]
+                    return
+        raise JsonInvalidoError(f"Se esperaba una lista JSON y llegó: {str(data)[:300]}")
+    pos += 1
+
+    while True:
+        while pos < len(buf) and buf[pos] in _ESPACIOS + ",":
+            pos += 1
+        if pos >= len(buf):
+            if fin:
+                raise JsonInvalidoError("JSON truncado: falta cerrar la lista")
+            _leer()
+            continue
+        if buf[pos] == "]":
+            return
+        try:
+            registro, nuevo = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if fin:
+                raise
+            _leer()
+            continue
+        # El elemento debe ir seguido de ',' o ']'; si no, puede ser un número
+        # cortado al final del bloque ("1." de "1.5e3"): esperar más datos
+        sig = nuevo
+        while sig < len(buf) and buf[sig] in _ESPACIOS:
+            sig += 1
+        if sig >= len(buf) or buf[sig] not in ",]":
+            if fin:
+                raise JsonInvalidoError(f"JSON inválido cerca de la posición {sig}")
+            _leer()
+            continue
+        pos = nuevo
+        yield registro
+
+
+def proyectar(registros, columnas):
+    """Deja en cada registro solo las columnas pedidas (None = todas), al vuelo."""
+    if not columnas:
+        yield from registros
+        return
+    columnas = tuple(columnas)
+    for r in registros:
+        yield {c: r[c] for c in columnas if c in r} if isinstance(r, dict) else r
+
+
+class RegistrosJson:
+    """
+    Iterador perezoso (y re-iterable) sobre una lista JSON guardada en disco.
+    Cada recorrido vuelve a leer el archivo por bloques: la memoria no crece
+    con el tamaño del reporte.
+    """
+
+    def __init__(self, ruta, total=None):
+        self.ruta = ruta
+        self.total = total
+
+    def __iter__(self):
+        with open(self.ruta, "rb") as f:
+            yield from iterar_json_array(iter(lambda: f.read(TAMANO_BLOQUE), b""))
+
+    def __len__(self):
+        if self.total is None:
+            self.total = sum(1 for _ in self)
+        return self.total
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __repr__(self):
+        return f"RegistrosJson({self.ruta!r}, total={self.total})"
+
+
+def escribir_json_stream(registros, destino):
+    """
+    Escribe registros uno a uno como lista JSON (un registro por línea) en
+    'destino'. Se escribe en un temporal y se renombra al final, así un corte
+    a mitad de descarga no deja un archivo incompleto. Devuelve RegistrosJson.
+    """
+    carpeta = os.path.dirname(destino) or "."
+    os.makedirs(carpeta, exist_ok=True)
+    # Temporal propio de esta escritura: dos hilos del mismo proceso (option2 y
+    # option5 sobre output/reporte_1003.json) nunca comparten archivo
+    f = tempfile.NamedTemporaryFile(
+        "w", encoding="utf-8", dir=carpeta, prefix=f"{os.path.basename(destino)}.", suffix=".tmp", delete=False
+    )
+    tmp = f.name
+    total = 0
+    try:
+        with f:
+            f.write("[")
+            for registro in registros:
+                f.write(",\n" if total else "\n")
+                f.write(json.dumps(registro, ensure_ascii=False))
+                total += 1
+            f.write("\n]\n")
+        os.replace(tmp, destino)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return RegistrosJson(destino, total=total)
@@ -1,14 +1,19 @@
 import os
 from pathlib import Path
 import requests
+import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
 import json
+import threading
 import time
 from datetime import datetime
 from urllib.parse import urljoin
 # ==================== BASE DE DATOS POSTGRES ====================
-import psycopg
+try:  # solo hace falta al conectar; las funciones puras (y benchmarks/) no lo necesitan
+    import psycopg
+except ImportError:  # pragma: no cover
+    psycopg = None
 from zoneinfo import ZoneInfo
 load_dotenv()
 
@@ -20,6 +25,8 @@ class NivelacionDatabase:
         self._init_database()
 
     def _get_conn(self):
+        if psycopg is None:
+            raise RuntimeError("Falta el paquete psycopg para conectarse a Postgres.")
         return psycopg.connect(self.database_url)
 
     def _init_database(self):
@@ -124,8 +131,58 @@ class NivelacionDatabase:
             print(f"❌ Error actualizando usuario {username}: {e}")
             return False
 
+    def agregar_usuarios_lote(self, usernames, estado: str = "pendiente") -> bool:
+        """
+        Igual que agregar_usuario para muchos usernames en una sola transacción
+        (UPSERT + historial). Lo usa el drenador de la bandeja de salida.
+        """
+        usernames = [u for u in dict.fromkeys(usernames) if u]
+        if not usernames:
+            return True
+        try:
+            with self._get_conn() as conn, conn.cursor() as cur:
+                cur.executemany(
+                    """
+                    INSERT INTO usuarios_nivelacion (username, estado)
+                    VALUES (%s, %s)
+                    ON CONFLICT (username) DO NOTHING;
+                    """,
+                    [(u, estado) for u in usernames]
+                )
+                cur.executemany(
+                    """
+                    INSERT INTO historial_nivelacion (username, accion, detalles)
+                    VALUES (%s, %s, %s);
+                    """,
+                    [(u, f"usuario_agregado_{estado}", None) for u in usernames]
+                )
+                conn.commit()
+            return True
+        except Exception as e:
+            print(f"❌ Error agregando {len(usernames)} usuarios en lote: {e}")
+            return False
+
+class _NivelacionDatabasePerezosa:
+    """
+    Instancia global que se crea (y verifica las tablas en Postgres) en el
+    primer uso, no al importar el módulo: importar utils no exige DATABASE_URL.
+    """
+
+    def __init__(self):
+        self._instancia = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, nombre):
+        if self._instancia is None:
+            with self._lock:
+                if self._instancia is None:
+                    self._instancia = NivelacionDatabase()
+        return getattr(self._instancia, nombre)
+
+
 # Instancia global para usar en toda la aplicación
-nivelacion_db = NivelacionDatabase()
+nivelacion_db = _NivelacionDatabasePerezosa()
+
 def migrar_sqlite_a_postgres(sqlite_path: str = None, batch_size: int = 1000, max_retries: int = 3):
     """
     Migración robusta de SQLite -> Postgres con:
@@ -371,13 +428,128 @@ import os
 import json
 import pandas as pd
 
-def generar_csv_con_informacionj(reporte_excel):
+from .streaming import RegistrosJson, escribir_json_stream
+from .documentos import ConjuntoDocumentos, clave_documento, claves_documento, texto_clave, textos_documento
+from .services import MAPEO_PERIODOS_992
+
+# Mapeo de programa_interes -> grupo en Moodle
+MAPA_PROGRAMA = {
+    'INTELIGENCIA ARTIFICIAL': 'Inteligencia Artificial',
+    'ANÁLISIS DE DATOS': 'Analisis_datos',
+    'PROGRAMACIÓN': 'Programacion',
+    'CIBERSEGURIDAD': 'Ciberseguridad1',
+    'ARQUITECTURA EN LA NUBE': 'Arquitectura_Nube',
+    'BLOCKCHAIN': 'Blockchain'
+}
+
+
+COLUMNAS_REQUERIDAS_1003 = [
+    'documento_numero', 'nombres', 'apellidos', 'telefono_celular',
+    'correo_electronico', 'departamento', 'municipio',
+    'modalidad_formacion', 'programa_interes', 'inscripcion_aprobada'
+]
+
+
+def fila_moodle(r: dict) -> dict:
+    """Un registro del 1003 en la estructura para Moodle."""
+    documento = texto_clave(clave_documento(r.get('documento_numero')))
+    programa = r.get('programa_interes')
+    return {
+        'idnumber': documento,
+        'username': documento,
+        'password': documento,
+        'firstname': r.get('nombres'),
+        'lastname': r.get('apellidos'),
+        'phone1': r.get('telefono_celular'),
+        'email': r.get('correo_electronico'),
+        'profile_field_departamento': r.get('departamento'),
+        'profile_field_municipio': r.get('municipio'),
+        'profile_field_modalidad': r.get('modalidad_formacion'),
+        'group1': MAPA_PROGRAMA.get(str(programa).upper(), programa),
+        'course1': 'Prueba de Inicio Talento Tech',
+        'role1': 5
+    }
+
+
+def iterar_filas_moodle(registros):
+    """
+    Generador sin pandas: recorre los registros del 1003 (lista o RegistrosJson),
+    deja solo APROBADO y entrega cada fila Moodle en cuanto está lista.
+    """
+    for r in registros:
+        if isinstance(r, dict) and r.get('inscripcion_aprobada') == 'APROBADO':
+            yield fila_moodle(r)
+
+
+def _faltan_columnas_1003(registros) -> bool:
+    """Revisa las columnas requeridas en el primer registro (sin recorrer el resto)."""
+    primero = next(iter(registros), None)
+    if primero is None:
+        return False
+    return not isinstance(primero, dict) or not all(col in primero for col in COLUMNAS_REQUERIDAS_1003)
+
+
+def construir_filas_moodle(registros):
+    """
+    Núcleo en memoria de generar_csv_con_informacionj.
+    - Entrada: registros del 1003 (list[dict], RegistrosJson o DataFrame).
+    - Retorna: list[dict] con la estructura para Moodle (solo APROBADO),
+      o None si faltan columnas requeridas.
+    Listas y RegistrosJson pasan por el generador (sin DataFrame del 1003).
+    """
+    if not isinstance(registros, pd.DataFrame):
+        if _faltan_columnas_1003(registros):
+            print("⚠️ Algunas columnas necesarias están ausentes en el archivo de entrada.")
+            return None
+        rows = list(iterar_filas_moodle(registros))
+        if not rows:
+            print("⚠️ No hay registros aprobados para exportar.")
+        return rows
+
+    df = registros
+
+    # Verificar columnas requeridas
+    if not all(col in df.columns for col in COLUMNAS_REQUERIDAS_1003):
+        print("⚠️ Algunas columnas necesarias están ausentes en el archivo de entrada.")
+        return None
+
+    # Filtrar aprobados
+    df_aprobados = df[df['inscripcion_aprobada'] == 'APROBADO'].copy()
+    if df_aprobados.empty:
+        print("⚠️ No hay registros aprobados para exportar.")
+        return []
+
+    # Construir estructura de salida (documento en su forma canónica: "123", no "123.0")
+    documento = textos_documento(df_aprobados['documento_numero'])
+    df_nuevo = pd.DataFrame({
+        'idnumber': documento,
+        'username': documento,
+        'password': documento,
+        'firstname': df_aprobados['nombres'],
+        'lastname': df_aprobados['apellidos'],
+        'phone1': df_aprobados['telefono_celular'],
+        'email': df_aprobados['correo_electronico'],
+        'profile_field_departamento': df_aprobados['departamento'],
+        'profile_field_municipio': df_aprobados['municipio'],
+        'profile_field_modalidad': df_aprobados['modalidad_formacion'],
+        'group1': df_aprobados['programa_interes'].astype(str).str.upper().map(MAPA_PROGRAMA).fillna(df_aprobados['programa_interes']),
+        'course1': 'Prueba de Inicio Talento Tech',
+        'role1': 5
+    })
+    return df_nuevo.to_dict(orient="records")
+
+
+def generar_csv_con_informacionj(reporte_excel, streaming=True):
     """
     Nueva versión JSON-first:
     - Entrada: ruta a .xlsx (actual) o .json con las mismas columnas.
     - Salida: output/<base>_modificado.json con la estructura para Moodle.
     - Retorna: (ruta_json_salida, rows_en_memoria)
 
+    Con streaming=True un .json se lee y se escribe registro a registro
+    (memoria constante) y rows es un RegistrosJson sobre la salida; el
+    camino con DataFrame queda para .xlsx o streaming=False.
+
     Estructura de salida (list[dict]):
       idnumber, username, password, firstname, lastname, phone1, email,
       profile_field_departamento, profile_field_municipio, profile_field_modalidad,
@@ -388,6 +560,22 @@ def generar_csv_con_informacionj(reporte_excel):
             print("⚠️ La ruta del reporte no existe o no es válida.")
             return None, []
 
+        out_dir = "output"
+        base = os.path.splitext(os.path.basename(reporte_excel))[0]
+        out_path = os.path.join(out_dir, f"{base}_modificado.json")
+
+        if streaming and reporte_excel.lower().endswith(".json"):
+            registros = RegistrosJson(reporte_excel)
+            if _faltan_columnas_1003(registros):
+                print("⚠️ Algunas columnas necesarias están ausentes en el archivo de entrada.")
+                return None, []
+            rows = escribir_json_stream(iterar_filas_moodle(registros), out_path)
+            if rows.total:
+                print(f"✅ Archivo JSON generado correctamente: {out_path}")
+            else:
+                print("⚠️ No hay registros aprobados para exportar.")
+            return out_path, rows
+
         # Cargar origen en DataFrame
         if reporte_excel.lower().endswith(".xlsx"):
             df = pd.read_excel(reporte_excel)
@@ -402,63 +590,13 @@ def generar_csv_con_informacionj(reporte_excel):
             print("⚠️ Formato no soportado. Usa .xlsx o .json como entrada.")
             return None, []
 
-        # Verificar columnas requeridas
-        required_columns = [
-            'documento_numero', 'nombres', 'apellidos', 'telefono_celular',
-            'correo_electronico', 'departamento', 'municipio',
-            'modalidad_formacion', 'programa_interes', 'inscripcion_aprobada'
-        ]
-        if not all(col in df.columns for col in required_columns):
-            print("⚠️ Algunas columnas necesarias están ausentes en el archivo de entrada.")
+        rows = construir_filas_moodle(df)
+        if rows is None:
             return None, []
 
-        # Filtrar aprobados
-        df_aprobados = df[df['inscripcion_aprobada'] == 'APROBADO'].copy()
-        if df_aprobados.empty:
-            print("⚠️ No hay registros aprobados para exportar.")
-            # Aun así creamos un JSON vacío para mantener flujo estable
-            out_dir = "output"
-            os.makedirs(out_dir, exist_ok=True)
-            base = os.path.splitext(os.path.basename(reporte_excel))[0]
-            out_path = os.path.join(out_dir, f"{base}_modificado.json")
-            with open(out_path, "w", encoding="utf-8") as f:
-                json.dump([], f, ensure_ascii=False, indent=2)
-            return out_path, []
-
-        # Mapeo de programa_interes
-        mapa_programa = {
-            'INTELIGENCIA ARTIFICIAL': 'Inteligencia Artificial',
-            'ANÁLISIS DE DATOS': 'Analisis_datos',
-            'PROGRAMACIÓN': 'Programacion',
-            'CIBERSEGURIDAD': 'Ciberseguridad1',
-            'ARQUITECTURA EN LA NUBE': 'Arquitectura_Nube',
-            'BLOCKCHAIN': 'Blockchain'
-        }
-
-        # Construir estructura de salida
-        df_nuevo = pd.DataFrame({
-            'idnumber': df_aprobados['documento_numero'].astype(str),
-            'username': df_aprobados['documento_numero'].astype(str),
-            'password': df_aprobados['documento_numero'].astype(str),
-            'firstname': df_aprobados['nombres'],
-            'lastname': df_aprobados['apellidos'],
-            'phone1': df_aprobados['telefono_celular'],
-            'email': df_aprobados['correo_electronico'],
-            'profile_field_departamento': df_aprobados['departamento'],
-            'profile_field_municipio': df_aprobados['municipio'],
-            'profile_field_modalidad': df_aprobados['modalidad_formacion'],
-            'group1': df_aprobados['programa_interes'].astype(str).str.upper().map(mapa_programa).fillna(df_aprobados['programa_interes']),
-            'course1': 'Prueba de Inicio Talento Tech',
-            'role1': 5
-        })
-
-        # Guardar como JSON
-        out_dir = "output"
+        # Guardar como JSON (aun vacío, para mantener flujo estable)
         os.makedirs(out_dir, exist_ok=True)
-        base = os.path.splitext(os.path.basename(reporte_excel))[0]
-        out_path = os.path.join(out_dir, f"{base}_modificado.json")
 
-        rows = df_nuevo.to_dict(orient="records")
         # Sobrescribir si existe (idempotente)
         if os.path.exists(out_path):
             try:
@@ -469,7 +607,8 @@ def generar_csv_con_informacionj(reporte_excel):
         with open(out_path, "w", encoding="utf-8") as f:
             json.dump(rows, f, ensure_ascii=False, indent=2)
 
-        print(f"✅ Archivo JSON generado correctamente: {out_path}")
+        if rows:
+            print(f"✅ Archivo JSON generado correctamente: {out_path}")
         return out_path, rows
 
     except Exception as e:
@@ -480,55 +619,23 @@ def generar_csv_con_informacionj(reporte_excel):
 
 import os
 import json
-def comparar_documentos_y_generar_faltantesj(
-    usuarios_path: str = "output/reporte_1003_modificado.json",
-    salida_path: str = "output/usuarios_faltantes_nivelacion.json",
-    modo: str = "preload",            # "preload" (rápido: trae todos los usernames de PG) o "batch"
-    batch_size: int = 5000,           # usado en modo "batch"
+def filtrar_usuarios_faltantes(
+    usuarios_rows: list,
+    modo: str = "preload",
+    batch_size: int = 5000,
     show_progress: bool = True
 ):
     """
-    Compara un JSON (~50k registros) contra Postgres para hallar 'faltantes' sin hacer 50k queries.
-    - modo="preload":  1 query a PG para traer todos los usernames -> compara en memoria (recomendado).
-    - modo="batch":    procesa los idnumber en lotes y consulta PG con WHERE username = ANY(%s).
-
-    Escribe los faltantes en salida_path y muestra % de avance.
+    Núcleo en memoria de comparar_documentos_y_generar_faltantesj:
+    recibe list[dict] (con 'idnumber') y devuelve los que NO están en Postgres,
+    o None si hubo error.
     """
-    import os, json, math, time
-    import pandas as pd
-
-    def _norm_id(x):
-        if x is None:
-            return ""
-        s = str(x).strip()
-        # Normaliza números que vienen como "123.0" o con comas
-        if s.endswith(".0"):
-            s = s[:-2]
-        s = s.replace(",", "")
-        return s
+    import math, time
 
-    try:
-        # ---- Cargar usuarios (1003_modificado) ----
-        if not os.path.exists(usuarios_path):
-            print(f"❌ Error: No existe {usuarios_path}")
-            return None
-
-        with open(usuarios_path, "r", encoding="utf-8-sig") as f:
-            usuarios_data = json.load(f)
-
-        # Normalizar a list[dict]
-        if isinstance(usuarios_data, dict):
-            usuarios_rows = usuarios_data.get("rows") or usuarios_data.get("data") or usuarios_data.get("items") or []
-        else:
-            usuarios_rows = usuarios_data
-
-        if not isinstance(usuarios_rows, list) or not usuarios_rows:
-            print("⚠️ El archivo de usuarios está vacío.")
-            os.makedirs(os.path.dirname(salida_path) or ".", exist_ok=True)
-            with open(salida_path, "w", encoding="utf-8") as f:
-                json.dump([], f, ensure_ascii=False, indent=2)
-            return salida_path
+    if not usuarios_rows:
+        return []
 
+    try:
         # Verificar clave mínima
         if "idnumber" not in usuarios_rows[0]:
             print("❌ El JSON de usuarios no contiene la clave 'idnumber'.")
@@ -536,17 +643,18 @@ def comparar_documentos_y_generar_faltantesj(
 
         total = len(usuarios_rows)
         print(f"🗂️ Registros en JSON: {total}")
+        # Clave canónica por fila (Int64 para documentos numéricos): "123", 123 y "123.0" coinciden
+        claves = claves_documento([u.get("idnumber") for u in usuarios_rows])
 
         # ===========================
         #   MODO PRELOAD (rápido)
         # ===========================
         if modo.lower() == "preload":
             print("⚡ Modo: PRELOAD - cargando usernames existentes desde Postgres en una sola consulta...")
-            exist_set = set()
             try:
                 with nivelacion_db._get_conn() as conn, conn.cursor() as cur:
                     cur.execute("SELECT username FROM usuarios_nivelacion;")
-                    exist_set = {row[0] for row in cur.fetchall()}
+                    exist_set = ConjuntoDocumentos(row[0] for row in cur.fetchall())
                 print(f"📥 Usernames ya existentes en BD: {len(exist_set)}")
             except Exception as e:
                 print(f"❌ Error cargando usernames desde Postgres: {e}")
@@ -556,9 +664,10 @@ def comparar_documentos_y_generar_faltantesj(
             last_print = time.time()
             every = max(500, total // 100)  # imprime aprox. 100 veces como máximo
 
-            for i, usuario in enumerate(usuarios_rows, 1):
-                username = _norm_id(usuario.get("idnumber"))
-                if username and (username not in exist_set):
+            # Con documento y ausentes de la BD (int64 vs. int64, sin objetos por fila)
+            faltan = (claves.numero.notna() | claves.texto.notna()).to_numpy() & ~exist_set.contiene(claves)
+            for i, (usuario, falta) in enumerate(zip(usuarios_rows, faltan), 1):
+                if falta:
                     usuarios_faltantes.append(usuario)
 
                 # Progreso
@@ -572,21 +681,13 @@ def comparar_documentos_y_generar_faltantesj(
         # ===========================
         else:
             print(f"⚙️ Modo: BATCH (tamaño de lote = {batch_size})")
-            # Extrae y normaliza todos los idnumber (evita duplicados para reducir consultas)
-            all_ids = []
-            for u in usuarios_rows:
-                uid = _norm_id(u.get("idnumber"))
-                if uid:
-                    all_ids.append(uid)
-
-            # Mapa id -> objetos (soportando posibles repetidos por seguridad)
+            # Mapa clave -> objetos (soportando posibles repetidos por seguridad)
             bucket = {}
-            for u in usuarios_rows:
-                uid = _norm_id(u.get("idnumber"))
-                if uid:
+            for u, uid in zip(usuarios_rows, claves.escalares()):
+                if uid is not None:
                     bucket.setdefault(uid, []).append(u)
 
-            unique_ids = list(set(all_ids))
+            unique_ids = list(bucket)
             print(f"🔎 Ids únicos a verificar: {len(unique_ids)}")
 
             from psycopg import OperationalError, InterfaceError
@@ -599,9 +700,12 @@ def comparar_documentos_y_generar_faltantesj(
                 existing = set()
                 with nivelacion_db._get_conn() as conn, conn.cursor() as cur:
                     # Consulta por arreglo (evita armar IN enorme y escapa bien)
-                    cur.execute("SELECT username FROM usuarios_nivelacion WHERE username = ANY(%s);", (id_list,))
+                    cur.execute(
+                        "SELECT username FROM usuarios_nivelacion WHERE username = ANY(%s);",
+                        ([texto_clave(k) for k in id_list],),
+                    )
                     for row in cur.fetchall():
-                        existing.add(row[0])
+                        existing.add(clave_documento(row[0]))
                 return existing
 
             processed = 0
@@ -638,12 +742,61 @@ def comparar_documentos_y_generar_faltantesj(
             for mid in missing_ids:
                 usuarios_faltantes.extend(bucket.get(mid, []))
 
+        print(f"✅ {len(usuarios_faltantes)} usuarios faltantes encontrados")
+        return usuarios_faltantes
+
+    except Exception as e:
+        print(f"❌ Error inesperado: {e}")
+        return None
+
+
+def comparar_documentos_y_generar_faltantesj(
+    usuarios_path: str = "output/reporte_1003_modificado.json",
+    salida_path: str = "output/usuarios_faltantes_nivelacion.json",
+    modo: str = "preload",            # "preload" (rápido: trae todos los usernames de PG) o "batch"
+    batch_size: int = 5000,           # usado en modo "batch"
+    show_progress: bool = True
+):
+    """
+    Compara un JSON (~50k registros) contra Postgres para hallar 'faltantes' sin hacer 50k queries.
+    - modo="preload":  1 query a PG para traer todos los usernames -> compara en memoria (recomendado).
+    - modo="batch":    procesa los idnumber en lotes y consulta PG con WHERE username = ANY(%s).
+
+    Escribe los faltantes en salida_path y muestra % de avance.
+    """
+    import os, json
+
+    try:
+        # ---- Cargar usuarios (1003_modificado) ----
+        if not os.path.exists(usuarios_path):
+            print(f"❌ Error: No existe {usuarios_path}")
+            return None
+
+        with open(usuarios_path, "r", encoding="utf-8-sig") as f:
+            usuarios_data = json.load(f)
+
+        # Normalizar a list[dict]
+        if isinstance(usuarios_data, dict):
+            usuarios_rows = usuarios_data.get("rows") or usuarios_data.get("data") or usuarios_data.get("items") or []
+        else:
+            usuarios_rows = usuarios_data
+
+        if not isinstance(usuarios_rows, list) or not usuarios_rows:
+            print("⚠️ El archivo de usuarios está vacío.")
+            os.makedirs(os.path.dirname(salida_path) or ".", exist_ok=True)
+            with open(salida_path, "w", encoding="utf-8") as f:
+                json.dump([], f, ensure_ascii=False, indent=2)
+            return salida_path
+
+        usuarios_faltantes = filtrar_usuarios_faltantes(usuarios_rows, modo, batch_size, show_progress)
+        if usuarios_faltantes is None:
+            return None
+
         # ---- Guardar salida JSON ----
         os.makedirs(os.path.dirname(salida_path) or ".", exist_ok=True)
         with open(salida_path, "w", encoding="utf-8") as f:
             json.dump(usuarios_faltantes, f, ensure_ascii=False, indent=2)
 
-        print(f"✅ {len(usuarios_faltantes)} usuarios faltantes encontrados")
         print(f"📁 Archivo generado: {salida_path}")
         return salida_path
 
@@ -666,46 +819,134 @@ from dotenv import load_dotenv
 import requests
 
 
-def verificar_usuarios_individualmentej(
-    faltantes_path: str = "output/usuarios_faltantes_nivelacion.json",
-    resultados_path: str = "output/verificacion_individual_moodle.json",
-    no_matriculados_path: str = "output/usuarios_no_matriculados.json"
+from .concurrencia import MOODLE_HILOS, MOODLE_TASA, LimitadorTasa, con_reintentos, mapa_concurrente
+
+# Usernames por solicitud a core_user_get_users_by_field
+MOODLE_LOTE_CONSULTA = int(os.getenv("MOODLE_LOTE_CONSULTA", "200"))
+
+
+def buscar_usuarios_moodle(
+    session, moodle_url, moodle_token, usernames, tamano_lote=MOODLE_LOTE_CONSULTA, timeout=30,
+    limitador=None, max_workers=1,
 ):
     """
-    Verifica usuarios faltantes en Moodle uno por uno y genera:
-      - output/verificacion_individual_moodle.json (reporte completo)
-      - output/usuarios_no_matriculados.json (subset)
-      - Actualiza la BASE DE DATOS con los usuarios matriculados
+    Resuelve muchos usernames con core_user_get_users_by_field enviando
+    values[0..n] en cada solicitud (tamano_lote por llamada). Los lotes se
+    consultan en paralelo (max_workers) respetando el limitador de tasa.
+    Retorna (encontrados, sin_resolver): {clave_documento(username):
+    usuario_moodle} solo con los que existen (claves en minúscula, como guarda
+    Moodle los username) y el set de claves cuyo lote falló (error HTTP,
+    excepción de Moodle, timeout): de esas no se sabe si existen.
     """
-    try:
-        # 1) Cargar usuarios faltantes (JSON)
-        if not os.path.exists(faltantes_path):
-            print(f"❌ No existe {faltantes_path}")
-            return
-
-        with open(faltantes_path, "r", encoding="utf-8") as f:
-            faltantes_data = json.load(f)
-
-        if isinstance(faltantes_data, dict):
-            faltantes_rows = faltantes_data.get("rows") or faltantes_data.get("data") or faltantes_data.get("items") or []
-        else:
-            faltantes_rows = faltantes_data
+    encontrados = {}
+    # Una consulta por clave canónica: "123", 123 y "123.0" son el mismo usuario
+    pendientes = list(dict.fromkeys(u for u in textos_documento(usernames, minusculas=True) if u))
+    tamano_lote = max(1, int(tamano_lote))
+
+    def _consultar_lote(inicio):
+        lote = pendientes[inicio:inicio + tamano_lote]
+        data = {
+            'wstoken': moodle_token,
+            'wsfunction': 'core_user_get_users_by_field',
+            'moodlewsrestformat': 'json',
+            'field': 'username',
+        }
+        for j, username in enumerate(lote):
+            data[f'values[{j}]'] = username
+        try:
+            response = con_reintentos(lambda: session.post(moodle_url, data=data, timeout=timeout), limitador)
+            usuarios = response.json()
+        except Exception as e:
+            print(f"⚠️ Error consultando lote {inicio // tamano_lote + 1} de usuarios en Moodle: {e}")
+            return None
+        if not isinstance(usuarios, list):
+            print(f"⚠️ Respuesta inesperada de Moodle en lote {inicio // tamano_lote + 1}: {str(usuarios)[:200]}")
+            return None
+        return usuarios
+
+    inicios = range(0, len(pendientes), tamano_lote)
+    lotes = mapa_concurrente(_consultar_lote, inicios, max_workers)
+    sin_resolver = set()
+    for inicio, usuarios in zip(inicios, lotes):
+        if usuarios is None:
+            sin_resolver.update(
+                clave_documento(u, minusculas=True) for u in pendientes[inicio:inicio + tamano_lote]
+            )
+            continue
+        for usuario in usuarios:
+            clave = clave_documento(usuario.get('username'), minusculas=True)
+            if clave is not None:
+                encontrados[clave] = usuario
+    return encontrados, sin_resolver
+
+
+# Usuarios por página al descargar el roster con core_enrol_get_enrolled_users
+MOODLE_PAGINA_ROSTER = int(os.getenv("MOODLE_PAGINA_ROSTER", "1000"))
+
+
+def cargar_roster_curso(
+    session, moodle_url, moodle_token, course_id, tamano_pagina=MOODLE_PAGINA_ROSTER, timeout=60, limitador=None,
+):
+    """
+    Descarga una vez los matriculados activos del curso
+    (core_enrol_get_enrolled_users paginado con limitfrom/limitnumber,
+    onlyactive=1 y solo id,username).
+    Retorna (usernames, ids): ConjuntoDocumentos de los usernames (en
+    minúscula) y frozenset de ids, o None si Moodle no responde como se espera.
+    """
+    usernames, ids = [], set()
+    tamano_pagina = max(1, int(tamano_pagina))
+    desde = 0
+    while True:
+        data = {
+            'wstoken': moodle_token,
+            'wsfunction': 'core_enrol_get_enrolled_users',
+            'moodlewsrestformat': 'json',
+            'courseid': course_id,
+            'options[0][name]': 'limitfrom',
+            'options[0][value]': desde,
+            'options[1][name]': 'limitnumber',
+            'options[1][value]': tamano_pagina,
+            'options[2][name]': 'userfields',
+            'options[2][value]': 'id,username',
+            # Como core_enrol_get_users_courses: suspendidas/vencidas no cuentan
+            'options[3][name]': 'onlyactive',
+            'options[3][value]': 1,
+        }
+        try:
+            response = con_reintentos(lambda: session.post(moodle_url, data=data, timeout=timeout), limitador)
+            pagina = response.json()
+        except Exception as e:
+            print(f"⚠️ Error descargando roster del curso {course_id}: {e}")
+            return None
+        if not isinstance(pagina, list):
+            print(f"⚠️ Respuesta inesperada de Moodle para el roster: {str(pagina)[:200]}")
+            return None
+        for usuario in pagina:
+            usernames.append(usuario.get('username'))
+            if usuario.get('id') is not None:
+                ids.add(int(usuario['id']))
+        if len(pagina) < tamano_pagina:
+            return ConjuntoDocumentos(usernames, minusculas=True), frozenset(ids)
+        desde += tamano_pagina
 
-        if not isinstance(faltantes_rows, list):
-            print("❌ Formato inválido en faltantes (se esperaba list[dict]).")
-            return
 
-        df_faltantes = pd.DataFrame(faltantes_rows)
-        if df_faltantes.empty or "idnumber" not in df_faltantes.columns:
-            print("⚠️ 'faltantes' vacío o sin columna 'idnumber'.")
-            # Crear archivos vacíos para mantener flujo
-            os.makedirs(os.path.dirname(resultados_path), exist_ok=True)
-            with open(resultados_path, "w", encoding="utf-8") as f:
-                json.dump([], f, ensure_ascii=False, indent=2)
-            with open(no_matriculados_path, "w", encoding="utf-8") as f:
-                json.dump([], f, ensure_ascii=False, indent=2)
-            return
+def verificar_usuarios_en_moodle(faltantes_rows, tamano_lote=MOODLE_LOTE_CONSULTA, max_workers=MOODLE_HILOS, tasa=MOODLE_TASA):
+    """
+    Núcleo en memoria de verificar_usuarios_individualmentej.
+    - Entrada: list[dict] de usuarios faltantes (con 'idnumber').
+    - tamano_lote: usernames por solicitud a Moodle (MOODLE_LOTE_CONSULTA).
+    - max_workers / tasa: hilos y solicitudes por segundo hacia Moodle
+      (MOODLE_HILOS / MOODLE_TASA). Los resultados conservan el orden de entrada.
+    - Retorna (resultados, no_matriculados) como list[dict], o None si falta
+      configuración de Moodle. Los ya matriculados se registran en la BD.
+    """
+    df_faltantes = pd.DataFrame(faltantes_rows)
+    if df_faltantes.empty or "idnumber" not in df_faltantes.columns:
+        print("⚠️ 'faltantes' vacío o sin columna 'idnumber'.")
+        return [], []
 
+    try:
         # 2) Configuración Moodle
         load_dotenv()
         MOODLE_URL = os.getenv("MOODLE_URL")
@@ -714,42 +955,19 @@ def verificar_usuarios_individualmentej(
 
         if not MOODLE_URL or not MOODLE_TOKEN:
             print("❌ Faltan MOODLE_URL/MOODLE_TOKEN en el .env")
-            return
+            return None
 
         session = requests.Session()
+        adaptador = requests.adapters.HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        session.mount("http://", adaptador)
+        session.mount("https://", adaptador)
+        limitador = LimitadorTasa(tasa)
 
-        def usuario_matriculado_en_curso(documento: str) -> bool:
+        def usuario_matriculado_en_curso(user_id) -> bool:
             """
-            Verifica si el usuario está matriculado en el curso ID 5
+            Verifica si el usuario (ya resuelto a su id de Moodle) está matriculado en el curso ID 5
             """
-            params = {
-                'wstoken': MOODLE_TOKEN,
-                'wsfunction': 'core_enrol_get_users_courses',
-                'userid': 0,
-                'moodlewsrestformat': 'json'
-            }
-            
             try:
-                # Primero obtener el userid del usuario
-                params_user = {
-                    'wstoken': MOODLE_TOKEN,
-                    'wsfunction': 'core_user_get_users_by_field',
-                    'field': 'username',
-                    'values[0]': documento,
-                    'moodlewsrestformat': 'json'
-                }
-                
-                user_response = session.get(MOODLE_URL, params=params_user, timeout=10)
-                users = user_response.json()
-                
-                if not isinstance(users, list) or len(users) == 0:
-                    return False
-                
-                user_id = users[0].get('id')
-                if not user_id:
-                    return False
-                
-                # Verificar en qué cursos está matriculado
                 params_courses = {
                     'wstoken': MOODLE_TOKEN,
                     'wsfunction': 'core_enrol_get_users_courses',
@@ -757,7 +975,9 @@ def verificar_usuarios_individualmentej(
                     'moodlewsrestformat': 'json'
                 }
                 
-                courses_response = session.get(MOODLE_URL, params=params_courses, timeout=10)
+                courses_response = con_reintentos(
+                    lambda: session.get(MOODLE_URL, params=params_courses, timeout=10), limitador
+                )
                 user_courses = courses_response.json()
                 
                 if isinstance(user_courses, list):
@@ -768,24 +988,51 @@ def verificar_usuarios_individualmentej(
                 return False
                 
             except Exception as e:
-                print(f"Error verificando {documento}: {str(e)}")
+                print(f"Error verificando usuario {user_id}: {str(e)}")
                 return False
 
-        # 3) Verificar cada usuario
         total_usuarios = len(df_faltantes)
-        print(f"\n🔍 Verificando {total_usuarios} usuarios individualmente...")
+        documentos = df_faltantes['idnumber'].astype(str).tolist()
+        # Claves canónicas (en minúscula, como los username de Moodle) para las búsquedas
+        claves = claves_documento(df_faltantes['idnumber'], minusculas=True)
+        print(f"\n🔍 Verificando {total_usuarios} usuarios...")
+
+        # 3) Roster del curso una sola vez: la pertenencia se responde localmente
+        roster = cargar_roster_curso(session, MOODLE_URL, MOODLE_TOKEN, COURSE_ID, limitador=limitador)
+        if roster is not None:
+            usernames_curso, _ids_curso = roster
+            print(f"📋 Roster del curso {COURSE_ID}: {len(usernames_curso)} matriculados")
+            # Pertenencia vectorizada (int64 contra int64) en lugar de una búsqueda por fila
+            estados = usernames_curso.contiene(claves).tolist()
+        else:
+            # Sin roster: resolver usernames en bloque y consultar cursos solo de los existentes
+            print(f"⚠️ No se pudo cargar el roster; verificando por usuario (lotes de {tamano_lote})...")
+            usuarios_moodle, sin_resolver = buscar_usuarios_moodle(
+                session, MOODLE_URL, MOODLE_TOKEN, df_faltantes['idnumber'], tamano_lote=tamano_lote,
+                limitador=limitador, max_workers=max_workers,
+            )
+            print(f"👥 {len(usuarios_moodle)} de {total_usuarios} usuarios ya existen en Moodle")
+            if sin_resolver:
+                # Pasan como no matriculados; la matrícula los resuelve uno a uno
+                print(f"⚠️ {len(sin_resolver)} usuario(s) sin resolver por errores de Moodle")
+
+            def esta_matriculado(clave):
+                # Quien no existe en Moodle no puede estar matriculado: sin más solicitudes
+                usuario = usuarios_moodle.get(clave)
+                return bool(usuario and usuario.get('id') and usuario_matriculado_en_curso(usuario['id']))
+
+            # En paralelo (limitado por tasa); el orden de entrada se conserva
+            estados = mapa_concurrente(esta_matriculado, claves.escalares(), max_workers)
 
         resultados = []
-        for i, row in df_faltantes.iterrows():
-            documento = str(row['idnumber'])
-            matriculado = usuario_matriculado_en_curso(documento)
+        for i, (documento, matriculado) in enumerate(zip(documentos, estados)):
             resultados.append({
                 "idnumber": documento,
-                "en_moodle": bool(matriculado),
+                "en_moodle": matriculado,
                 "fecha_verificacion": datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             })
 
-            if (i + 1) % 10 == 0 or (i + 1) == total_usuarios:
+            if (i + 1) % 1000 == 0 or (i + 1) == total_usuarios:
                 status = "✅" if matriculado else "❌"
                 print(f"Progreso: {i+1}/{total_usuarios} | {status} {documento}")
 
@@ -796,27 +1043,67 @@ def verificar_usuarios_individualmentej(
         df_matriculados = df_faltantes[matriculados_mask].copy() if 'df_faltantes' in locals() else pd.DataFrame()
         df_no_matriculados = df_faltantes[~matriculados_mask].copy() if 'df_faltantes' in locals() else pd.DataFrame()
 
-        # 5) Guardar salidas como JSON
-        os.makedirs(os.path.dirname(resultados_path), exist_ok=True)
-
-        with open(resultados_path, "w", encoding="utf-8") as f:
-            json.dump(df_resultados.to_dict(orient="records"), f, ensure_ascii=False, indent=2)
-        print(f"📊 Reporte completo guardado en {resultados_path}")
-
-        with open(no_matriculados_path, "w", encoding="utf-8") as f:
-            json.dump(df_no_matriculados.to_dict(orient="records"), f, ensure_ascii=False, indent=2)
-        print(f"✅ {len(df_no_matriculados)} usuarios NO matriculados guardados en {no_matriculados_path}")
-
         # 6) ✅ ACTUALIZAR BASE DE DATOS (en lugar del JSON maestro)
         if not df_matriculados.empty:
-            for _, row in df_matriculados.iterrows():
-                username = str(row['idnumber']).strip()
+            # Texto canónico: es lo que compara filtrar_usuarios_faltantes
+            for username in textos_documento(df_matriculados['idnumber']):
                 if username:
                     # Agregar a base de datos como "verificado"
                     nivelacion_db.agregar_usuario(username, "verificado")
                     print(f"✅ Usuario {username} verificado y registrado en BD")
 
         print("✅ Verificación completada y base de datos actualizada")
+        return df_resultados.to_dict(orient="records"), df_no_matriculados.to_dict(orient="records")
+
+    except Exception as e:
+        print(f"❌ Error inesperado en verificación: {str(e)}")
+        return None
+
+
+def verificar_usuarios_individualmentej(
+    faltantes_path: str = "output/usuarios_faltantes_nivelacion.json",
+    resultados_path: str = "output/verificacion_individual_moodle.json",
+    no_matriculados_path: str = "output/usuarios_no_matriculados.json"
+):
+    """
+    Verifica usuarios faltantes en Moodle uno por uno y genera:
+      - output/verificacion_individual_moodle.json (reporte completo)
+      - output/usuarios_no_matriculados.json (subset)
+      - Actualiza la BASE DE DATOS con los usuarios matriculados
+    """
+    try:
+        # 1) Cargar usuarios faltantes (JSON)
+        if not os.path.exists(faltantes_path):
+            print(f"❌ No existe {faltantes_path}")
+            return
+
+        with open(faltantes_path, "r", encoding="utf-8") as f:
+            faltantes_data = json.load(f)
+
+        if isinstance(faltantes_data, dict):
+            faltantes_rows = faltantes_data.get("rows") or faltantes_data.get("data") or faltantes_data.get("items") or []
+        else:
+            faltantes_rows = faltantes_data
+
+        if not isinstance(faltantes_rows, list):
+            print("❌ Formato inválido en faltantes (se esperaba list[dict]).")
+            return
+
+        verificacion = verificar_usuarios_en_moodle(faltantes_rows)
+        if verificacion is None:
+            return
+        resultados, no_matriculados = verificacion
+
+        # Guardar salidas como JSON (vacías si no hubo nada que verificar)
+        os.makedirs(os.path.dirname(resultados_path), exist_ok=True)
+
+        with open(resultados_path, "w", encoding="utf-8") as f:
+            json.dump(resultados, f, ensure_ascii=False, indent=2)
+        print(f"📊 Reporte completo guardado en {resultados_path}")
+
+        with open(no_matriculados_path, "w", encoding="utf-8") as f:
+            json.dump(no_matriculados, f, ensure_ascii=False, indent=2)
+        print(f"✅ {len(no_matriculados)} usuarios NO matriculados guardados en {no_matriculados_path}")
 
     except Exception as e:
         print(f"❌ Error inesperado en verificación: {str(e)}")
@@ -862,13 +1149,12 @@ def asignar_lote(df: pd.DataFrame):
 
     work = df.copy()
 
-    # Normalizaciones
-    work['profile_field_modalidad'] = work['profile_field_modalidad'].apply(
-        lambda x: str(x).strip().upper() if pd.notna(x) else ''
-    )
-    work['profile_field_departamento'] = work['profile_field_departamento'].apply(
-        lambda x: str(x).strip().upper() if pd.notna(x) else ''
-    )
+    # Normalizaciones (vectorizadas): nulos -> '', resto str().strip().upper()
+    def _norm_col(serie):
+        return serie.where(serie.notna(), '').astype(str).str.strip().str.upper().astype(object)
+
+    work['profile_field_modalidad'] = _norm_col(work['profile_field_modalidad'])
+    work['profile_field_departamento'] = _norm_col(work['profile_field_departamento'])
 
     # Si quieres quitar acentos para comparar (útil si la fuente a veces viene sin acentos):
     # def _norm_up(s):
@@ -881,24 +1167,24 @@ def asignar_lote(df: pd.DataFrame):
     modalidades_validas = {'VIRTUAL', 'PRESENCIAL'}
     departamentos_validos = {'ANTIOQUIA', 'CALDAS', 'CHOCÓ', 'QUINDÍO', 'RISARALDA'}
 
-    motivos = []
-    invalid_mask = pd.Series(False, index=work.index)
-
     mask_modalidad = ~work['profile_field_modalidad'].isin(modalidades_validas)
-    invalid_mask = invalid_mask | mask_modalidad
-
     mask_departamento = ~work['profile_field_departamento'].isin(departamentos_validos)
-    invalid_mask = invalid_mask | mask_departamento
-
-    for i, row in work.iterrows():
-        m = []
-        if mask_modalidad.loc[i]:
-            m.append(f"Modalidad inválida: {row.get('profile_field_modalidad', '')}")
-        if mask_departamento.loc[i]:
-            m.append(f"Departamento no permitido: {row.get('profile_field_departamento', '')}")
-        motivos.append(" | ".join(m) if m else "")
-
-    work['motivo_rechazo'] = motivos
+    invalid_mask = mask_modalidad | mask_departamento
+
+    # Motivo de rechazo armado por columnas (sin iterrows)
+    motivo_modalidad = ("Modalidad inválida: " + work['profile_field_modalidad']).to_numpy(dtype=object)
+    motivo_departamento = ("Departamento no permitido: " + work['profile_field_departamento']).to_numpy(dtype=object)
+    mm_ = mask_modalidad.to_numpy()
+    md_ = mask_departamento.to_numpy()
+    work['motivo_rechazo'] = pd.Series(
+        np.select(
+            [mm_ & md_, mm_, md_],
+            [motivo_modalidad + " | " + motivo_departamento, motivo_modalidad, motivo_departamento],
+            default="",
+        ),
+        index=work.index,
+        dtype=object,
+    )
 
     df_invalid = work[invalid_mask].copy()
     df_valid = work[~invalid_mask].copy()
@@ -906,8 +1192,7 @@ def asignar_lote(df: pd.DataFrame):
     # Asignación de lote (round-robin)
     df_valid = df_valid.reset_index(drop=True)
     if not df_valid.empty:
-        lotes = ['Lote 1' if (i % 2 == 0) else 'Lote 2' for i in range(len(df_valid))]
-        df_valid['profile_field_lote'] = lotes
+        df_valid['profile_field_lote'] = np.where(np.arange(len(df_valid)) % 2 == 0, 'Lote 1', 'Lote 2').astype(object)
     else:
         df_valid['profile_field_lote'] = pd.Series(dtype=object)
 
@@ -924,6 +1209,73 @@ def asignar_lote(df: pd.DataFrame):
 
     return df_valid, df_invalid
 
+def procesar_filas_lotes(rows, moodle_manager=None):
+    """
+    Núcleo en memoria de procesar_archivoj: valida columnas mínimas, asigna
+    lotes y registra los rechazados (si hay moodle_manager).
+    Retorna (valid_rows, invalid_rows) como list[dict], o (None, None) si falla.
+    """
+    try:
+        if not isinstance(rows, list) or (rows and not isinstance(rows[0], dict)):
+            print("❌ Formato inválido: se esperaba una lista de objetos (list[dict]).")
+            return None, None
+        if not rows:
+            print("ℹ️ No hay usuarios para asignar a lotes.")
+            return [], []
+
+        df = pd.DataFrame(rows)
+        print("Columnas del archivo cargado:")
+        print(list(df.columns))
+
+        required = {'profile_field_modalidad', 'profile_field_departamento'}
+        if not required.issubset(set(df.columns)):
+            print("❌ El archivo no contiene las columnas requeridas: "
+                  "'profile_field_modalidad' y 'profile_field_departamento'.")
+            return None, None
+
+        df_valid, df_invalid = asignar_lote(df)
+
+        valid_rows = df_valid.to_dict(orient="records") if not df_valid.empty else []
+        invalid_rows = df_invalid.to_dict(orient="records") if not df_invalid.empty else []
+
+        if invalid_rows and moodle_manager:
+            print("\nRegistrando usuarios rechazados en Matriculados Fallidos...")
+            for row in invalid_rows:
+                modalidad = (row.get('profile_field_modalidad') or '').strip().upper()
+                departamento = (row.get('profile_field_departamento') or '').strip().upper()
+
+                motivo = "Rechazado - "
+                if modalidad not in ['VIRTUAL', 'PRESENCIAL']:
+                    motivo += f"Modalidad inválida: {row.get('profile_field_modalidad', '')}"
+                elif departamento not in ['ANTIOQUIA', 'CALDAS', 'CHOCÓ', 'QUINDÍO', 'RISARALDA']:
+                    motivo += f"Departamento no permitido: {row.get('profile_field_departamento', '')}"
+                else:
+                    motivo += "Razón desconocida"
+
+                user_data = {
+                    'username': row.get('username', ''),
+                    'firstname': row.get('firstname', ''),
+                    'lastname': row.get('lastname', ''),
+                    'email': row.get('email', ''),
+                    'phone1': row.get('phone1', ''),
+                    'idnumber': row.get('idnumber', ''),
+                    'group1': row.get('group1', ''),
+                    'password': 'No aplica'
+                }
+                moodle_manager.registrar_resultado(
+                    row=user_data,
+                    tipo="fallido",
+                    motivo=motivo,
+                    grupo=row.get('group1', '')
+                )
+
+        return valid_rows, invalid_rows
+
+    except Exception as e:
+        print(f"❌ Error al procesar el archivo: {e}")
+        return None, None
+
+
 def procesar_archivoj(
     ruta_archivo: str,
     moodle_manager=None,
@@ -944,22 +1296,10 @@ def procesar_archivoj(
         # --- AQUÍ EL CAMBIO CLAVE: loader tolerante a BOM ---
         rows = _load_json_rows(ruta_archivo)
 
-        if not isinstance(rows, list) or (rows and not isinstance(rows[0], dict)):
-            print("❌ Formato inválido: se esperaba una lista de objetos (list[dict]).")
-            return None, None
-
-        df = pd.DataFrame(rows)
-        print("Columnas del archivo cargado:")
-        print(list(df.columns))
-
-        required = {'profile_field_modalidad', 'profile_field_departamento'}
-        if not required.issubset(set(df.columns)):
-            print("❌ El archivo no contiene las columnas requeridas: "
-                  "'profile_field_modalidad' y 'profile_field_departamento'.")
+        valid_rows, invalid_rows = procesar_filas_lotes(rows, moodle_manager)
+        if valid_rows is None:
             return None, None
 
-        df_valid, df_invalid = asignar_lote(df)
-
         output_dir = os.path.dirname(salida_valid) or "output"
         os.makedirs(output_dir, exist_ok=True)
 
@@ -972,46 +1312,13 @@ def procesar_archivoj(
             with open(path, "w", encoding="utf-8") as f:
                 json.dump(payload, f, ensure_ascii=False, indent=2)
 
-        valid_rows = df_valid.to_dict(orient="records") if not df_valid.empty else []
         _dump_json(salida_valid, valid_rows)
         print(f"✅ Archivo de filas válidas guardado como '{salida_valid}'.")
 
-        invalid_rows = df_invalid.to_dict(orient="records") if not df_invalid.empty else []
+        _dump_json(salida_invalid, invalid_rows)
         if invalid_rows:
-            _dump_json(salida_invalid, invalid_rows)
             print(f"⚠️ Archivo de filas inválidas guardado como '{salida_invalid}'.")
-            if moodle_manager:
-                print("\nRegistrando usuarios rechazados en Matriculados Fallidos...")
-                for row in invalid_rows:
-                    modalidad = (row.get('profile_field_modalidad') or '').strip().upper()
-                    departamento = (row.get('profile_field_departamento') or '').strip().upper()
-
-                    motivo = "Rechazado - "
-                    if modalidad not in ['VIRTUAL', 'PRESENCIAL']:
-                        motivo += f"Modalidad inválida: {row.get('profile_field_modalidad', '')}"
-                    elif departamento not in ['ANTIOQUIA', 'CALDAS', 'CHOCÓ', 'QUINDÍO', 'RISARALDA']:
-                        motivo += f"Departamento no permitido: {row.get('profile_field_departamento', '')}"
-                    else:
-                        motivo += "Razón desconocida"
-
-                    user_data = {
-                        'username': row.get('username', ''),
-                        'firstname': row.get('firstname', ''),
-                        'lastname': row.get('lastname', ''),
-                        'email': row.get('email', ''),
-                        'phone1': row.get('phone1', ''),
-                        'idnumber': row.get('idnumber', ''),
-                        'group1': row.get('group1', ''),
-                        'password': 'No aplica'
-                    }
-                    moodle_manager.registrar_resultado(
-                        row=user_data,
-                        tipo="fallido",
-                        motivo=motivo,
-                        grupo=row.get('group1', '')
-                    )
         else:
-            _dump_json(salida_invalid, [])
             print("ℹ️ No hubo filas inválidas. Se creó un JSON vacío de descartados.")
 
         return salida_valid, salida_invalid
@@ -1032,6 +1339,17 @@ from datetime import datetime
 from urllib.parse import urljoin
 from dotenv import load_dotenv
 
+from collections import OrderedDict
+
+from .sheets import ReporteroSheets
+from .outbox import DESTINO_DB, DESTINO_SHEETS, BandejaSalida, DrenadorBandeja
+
+# Usuarios por solicitud a core_user_create_users
+MOODLE_LOTE_CREACION = int(os.getenv("MOODLE_LOTE_CREACION", "100"))
+# Filas por ventana de matrícula (enrol_manual_enrol_users / core_group_add_group_members)
+MOODLE_LOTE_MATRICULA = int(os.getenv("MOODLE_LOTE_MATRICULA", "100"))
+
+
 class MoodleManager:
     def __init__(self):
         load_dotenv()
@@ -1044,11 +1362,43 @@ class MoodleManager:
         self.APPS_SCRIPT_URL = os.getenv('APPS_SCRIPT_WEBAPP_URL')
         self.SHEET_ID = os.getenv('GOOGLE_SHEET_ID')
         self.MAX_RETRIES = 3
+        self._reportero = None
+
+        # Bandeja de salida durable para Sheets y BD (SIGA_OUTBOX=false la desactiva)
+        self.USAR_BANDEJA = os.getenv('SIGA_OUTBOX', 'true').lower() in ('1', 'true', 'si', 'sí')
+        self._bandeja = None
+        self._drenador = None
+
+        # Grupos por curso {course_id: {nombre: id}}, cargados una vez por corrida
+        self._grupos = {}
+        self._grupos_ausentes = {}
+        self._grupos_fallidos = {}  # course_id -> nombres que no se pudieron crear en esta corrida
+        self.CREAR_GRUPOS = os.getenv('MOODLE_CREAR_GRUPOS', 'false').lower() in ('1', 'true', 'si', 'sí')
+
+        # Caché LRU username -> id de Moodle (None = no existe) para la corrida
+        self._usuarios = OrderedDict()
+        self.MAX_CACHE_USUARIOS = int(os.getenv('MOODLE_CACHE_USUARIOS', '50000'))
+
+    def _bandeja_salida(self):
+        """Bandeja local + drenador (api_siga/outbox.py), creados al primer uso."""
+        if self._bandeja is None:
+            self._bandeja = BandejaSalida()
+            self._drenador = DrenadorBandeja(
+                self._bandeja, self.APPS_SCRIPT_URL, self.SHEET_ID, db=nivelacion_db
+            )
+        return self._bandeja
 
     def registrar_exitoso_db(self, username):
         """
-        REEMPLAZA registrar_exitoso_csv - Ahora usa base de datos
+        REEMPLAZA registrar_exitoso_csv - Ahora usa base de datos.
+        Con la bandeja de salida activa solo se anota localmente y el drenador
+        lo lleva a Postgres en lote.
         """
+        if self.USAR_BANDEJA:
+            if not username:
+                return False
+            self._bandeja_salida().agregar(DESTINO_DB, "exitoso", {"username": username})
+            return True
         try:
             if not username:
                 return False
@@ -1088,76 +1438,188 @@ class MoodleManager:
         with open(path, 'w', encoding='utf-8') as f:
             json.dump(lista, f, ensure_ascii=False, indent=2)
 
-    def matricular_usuarios(self, json_file_path):
+    def matricular_usuarios(self, json_file_path, inicio=0, al_avanzar=None, tamano_lote=MOODLE_LOTE_MATRICULA):
         """
-        Versión actualizada sin ARCHIVO_EXITOSOS
+        Versión actualizada sin ARCHIVO_EXITOSOS.
+        Acepta la ruta del JSON o directamente la lista de filas (list[dict]).
+        - inicio: cantidad de registros ya procesados (reanudación); se saltan.
+        - al_avanzar(i): se llama al terminar cada registro (checkpoint).
+        - tamano_lote: filas por ventana; matrículas y grupos de cada ventana
+          van en una sola solicitud a Moodle (enrolments[0..n] / members[0..n]).
         """
         try:
-            usuarios = self._leer_json_lista(json_file_path)
+            if isinstance(json_file_path, list):
+                usuarios = json_file_path
+            else:
+                usuarios = self._leer_json_lista(json_file_path)
             print(f"\nTotal de usuarios a procesar: {len(usuarios)}")
-            
-            for i, row in enumerate(usuarios, 1):
-                try:
-                    username = row.get('username', '').strip()
-                    print(f"\n[{i}/{len(usuarios)}] Procesando usuario: {username}")
-                    
-                    # Verificar si el usuario ya existe
-                    user_id = None
-                    usuario_existente = self.usuario_existe(username)
-                    
-                    if usuario_existente:
-                        print("✅ Usuario ya existe, obteniendo ID...")
-                        user_id = self.obtener_id_usuario(username)
-                        if not user_id:
-                            self.registrar_resultado(row, "fallido", "Usuario existe pero no se pudo obtener ID")
-                            continue
-                    else:
-                        # Crear nuevo usuario
-                        try:
-                            user_id = self.crear_usuario(row)
-                            if not user_id:
-                                continue
-                        except Exception as e:
-                            error_msg = str(e)
-                            print(f"⚠️ Error al crear usuario: {error_msg}")
-                            self.registrar_resultado(row, "fallido", error_msg)
-                            continue
-                    
-                    # Matricular en curso principal (ID=5)
-                    if not self.matricular_en_curso(user_id, 5, 5):
-                        self.registrar_resultado(row, "fallido", "Error en matriculación")
-                        continue
-                        
-                    # Asignar a grupo/subgrupo si está especificado
-                    grupo = row.get('group1', '').strip()
-                    if grupo and not self.asignar_a_grupo(user_id, 5, grupo):
-                        self.registrar_resultado(row, "fallido", "Error al asignar grupo")
-                        continue
-                    
-                    # ✅ REGISTRAR ÉXITO EN BASE DE DATOS (no en JSON)
-                    if not self.registrar_exitoso_db(username):
-                        print("⚠️ No se pudo registrar en BD, pero el usuario fue procesado")
-                    
-                    # Registrar éxito en Google Sheets
-                    if not self.registrar_resultado(row, "exitoso", "Matriculación exitosa", grupo):
-                        print("⚠️ No se pudo registrar en Google Sheets")
-                    
-                except Exception as e:
-                    error_msg = f"Error inesperado: {str(e)}"
-                    print(f"⚠️ {error_msg}")
-                    self.registrar_resultado(row, "fallido", error_msg)
-                    continue
+            if inicio:
+                print(f"⏩ Reanudando desde el registro {inicio + 1}")
+
+            # Existentes resueltos en bloque y nuevos creados por lotes
+            errores_creacion = self._preparar_usuarios(usuarios[inicio:])
+
+            tamano_lote = max(1, int(tamano_lote))
+            for desde in range(inicio, len(usuarios), tamano_lote):
+                ventana = list(enumerate(usuarios[desde:desde + tamano_lote], desde + 1))
+                self._matricular_ventana(ventana, len(usuarios), errores_creacion, al_avanzar)
         
         except Exception as e:
             print(f"🚨 Error crítico: {str(e)}")
             raise
         finally:
+            self.cerrar_reportes()
             print("\n✅ Proceso completado. Revisa los registros en Google Sheets")
 
-    def obtener_id_usuario(self, username):
+    def _resolver_usuario(self, row, errores_creacion):
+        """Devuelve (user_id, motivo_fallo) para una fila; (None, None) = se omite sin registrar."""
+        username = row.get('username', '').strip()
+        if username in errores_creacion:
+            print(f"⚠️ Error al crear usuario: {errores_creacion[username]}")
+            return None, errores_creacion[username]
+        # Existencia e id salen de la misma consulta (caché de la corrida)
+        try:
+            user_id = self.resolver_usuario(username)
+        except Exception as e:
+            print(f"⚠️ No se pudo consultar el usuario en Moodle: {e}")
+            return None, f"Error consultando usuario en Moodle: {e}"
+        if user_id:
+            print(f"✅ Usuario disponible en Moodle (ID {user_id})")
+            return user_id, None
+        # Crear nuevo usuario
+        try:
+            user_id = self.crear_usuario(row)
+            if user_id:
+                self._recordar_usuario(username, user_id)
+            return user_id, None
+        except Exception as e:
+            error_msg = str(e)
+            print(f"⚠️ Error al crear usuario: {error_msg}")
+            return None, error_msg
+
+    def _matricular_ventana(self, ventana, total, errores_creacion, al_avanzar):
         """
-        Obtiene el ID de un usuario existente por su username
+        Procesa una ventana de filas [(i, row)]: resuelve usuarios, matricula y
+        asigna grupos en bloque, y al final registra (BD/Sheets) fila por fila
+        en orden, avisando a al_avanzar tras cada una.
         """
+        estado = {}  # i -> (user_id, motivo_fallo, grupo)
+        for i, row in ventana:
+            try:
+                username = row.get('username', '').strip()
+                print(f"\n[{i}/{total}] Procesando usuario: {username}")
+                user_id, motivo = self._resolver_usuario(row, errores_creacion)
+                estado[i] = (user_id, motivo, row.get('group1', '').strip())
+            except Exception as e:
+                estado[i] = (None, f"Error inesperado: {str(e)}", "")
+
+        # Matricular en curso principal (ID=5), toda la ventana en una solicitud
+        listos = [i for i, _ in ventana if estado[i][0]]
+        matriculas = self.matricular_en_curso_lote([(estado[i][0], 5, 5) for i in listos])
+        for i, ok in zip(listos, matriculas):
+            if not ok:
+                estado[i] = (estado[i][0], "Error en matriculación", estado[i][2])
+
+        # Asignar a grupo/subgrupo si está especificado
+        con_grupo = [i for i in listos if estado[i][1] is None and estado[i][2]]
+        asignaciones = self.asignar_a_grupos_lote([(estado[i][0], 5, estado[i][2]) for i in con_grupo])
+        for i, ok in zip(con_grupo, asignaciones):
+            if not ok:
+                estado[i] = (estado[i][0], "Error al asignar grupo", estado[i][2])
+
+        for i, row in ventana:
+            try:
+                user_id, motivo, grupo = estado[i]
+                if motivo:
+                    self.registrar_resultado(row, "fallido", motivo)
+                    continue
+                if not user_id:
+                    continue
+                username = row.get('username', '').strip()
+
+                # ✅ REGISTRAR ÉXITO EN BASE DE DATOS (no en JSON)
+                if not self.registrar_exitoso_db(username):
+                    print("⚠️ No se pudo registrar en BD, pero el usuario fue procesado")
+                
+                # Registrar éxito en Google Sheets
+                if not self.registrar_resultado(row, "exitoso", "Matriculación exitosa", grupo):
+                    print("⚠️ No se pudo registrar en Google Sheets")
+                
+            except Exception as e:
+                error_msg = f"Error inesperado: {str(e)}"
+                print(f"⚠️ {error_msg}")
+                self.registrar_resultado(row, "fallido", error_msg)
+                continue
+            finally:
+                if al_avanzar:
+                    al_avanzar(i)
+
+    def _preparar_usuarios(self, usuarios):
+        """
+        Antes del bucle de matrícula: precarga en la caché los usuarios que ya
+        existen y crea por lotes los que faltan. Retorna {username: motivo} de
+        los que no se pudieron crear.
+        """
+        usernames = [str(row.get('username') or '').strip() for row in usuarios]
+        self.precargar_usuarios(usernames)
+        # Solo los que Moodle confirmó que no existen (entrada None en la caché);
+        # los no resueltos van por resolver_usuario dentro del bucle
+        claves = [clave_documento(u, minusculas=True) for u in usernames]
+        nuevos = [
+            row for row, c in zip(usuarios, claves)
+            if c is not None and c in self._usuarios and self._usuarios[c] is None
+        ]
+        if not nuevos:
+            return {}
+        creados, fallidos = self.crear_usuarios_lote(nuevos)
+        for username, user_id in creados.items():
+            self._recordar_usuario(username, user_id)
+        return fallidos
+
+    def _recordar_usuario(self, username, user_id):
+        """Guarda clave_documento(username) -> id (None = no existe) en la caché LRU acotada."""
+        clave = clave_documento(username, minusculas=True)
+        if clave is None:
+            return
+        self._usuarios[clave] = user_id
+        self._usuarios.move_to_end(clave)
+        while len(self._usuarios) > self.MAX_CACHE_USUARIOS:
+            self._usuarios.popitem(last=False)
+
+    def precargar_usuarios(self, usernames):
+        """
+        Llena la caché en bloque (core_user_get_users_by_field por lotes). Los
+        usernames de un lote que falló no se guardan: quedan sin resolver.
+        """
+        pendientes = [
+            c for c in dict.fromkeys(claves_documento(usernames, minusculas=True).escalares())
+            if c is not None and c not in self._usuarios
+        ]
+        if not pendientes:
+            return
+        existentes, sin_resolver = buscar_usuarios_moodle(
+            self.session, urljoin(self.MOODLE_URL, 'webservice/rest/server.php'), self.MOODLE_TOKEN,
+            [texto_clave(c) for c in pendientes],
+        )
+        for u in pendientes:
+            if u in sin_resolver:
+                continue
+            datos = existentes.get(u)
+            self._recordar_usuario(u, datos.get('id') if datos else None)
+        print(f"👥 Caché de usuarios: {sum(1 for u in pendientes if existentes.get(u))}/{len(pendientes)} existen en Moodle")
+        if sin_resolver:
+            print(f"⚠️ {len(sin_resolver)} usuario(s) sin resolver (lote con error); se consultarán uno a uno")
+
+    def resolver_usuario(self, username):
+        """
+        Id de Moodle del username (None si no existe) con una sola consulta,
+        memorizada para el resto de la corrida. Si Moodle responde con error
+        se lanza RuntimeError y no se memoriza nada.
+        """
+        clave = clave_documento(username, minusculas=True)
+        if clave in self._usuarios:
+            self._usuarios.move_to_end(clave)
+            return self._usuarios[clave]
         params = {
             'wstoken': self.MOODLE_TOKEN,
             'wsfunction': 'core_user_get_users_by_field',
@@ -1171,9 +1633,19 @@ class MoodleManager:
             headers=self.headers
         )
         users = response.json()
-        if isinstance(users, list) and len(users) > 0 and 'id' in users[0]:
-            return users[0]['id']
-        return None
+        if not isinstance(users, list):
+            raise RuntimeError(f"Respuesta inesperada de Moodle para {username}: {str(users)[:200]}")
+        user_id = None
+        if len(users) > 0 and 'id' in users[0]:
+            user_id = users[0]['id']
+        self._recordar_usuario(username, user_id)
+        return user_id
+
+    def obtener_id_usuario(self, username):
+        """
+        Obtiene el ID de un usuario existente por su username
+        """
+        return self.resolver_usuario(username)
 
     def registrar_exitoso_csv(self, username):
         """
@@ -1205,99 +1677,98 @@ class MoodleManager:
             return False
 
     def registrar_resultado(self, row, tipo, motivo, grupo=""):
-        """Registrar resultado en Google Sheets con las columnas especificadas (sin cambios)."""
+        """
+        Registrar resultado en Google Sheets con las columnas especificadas.
+        La fila va a la bandeja de salida local (api_siga/outbox.py) o, si está
+        desactivada, al reportero en segundo plano (api_siga/sheets.py); en
+        ambos casos se envía en bloque con las demás del mismo tipo.
+        """
         fecha = datetime.now(ZoneInfo("America/Bogota")).strftime("%Y-%m-%d %H:%M:%S")
 
         datos = {
-            "sheet_id": self.SHEET_ID,
-            "tipo": tipo,
-            "datos": {
-                "Cédula": row.get('username', ''),
-                "Nombre Completo": f"{row.get('firstname', '')} {row.get('lastname', '')}",
-                "Email": row.get('email', ''),
-                "Examen": grupo or row.get('group1', ''),
-                "Celular": row.get('phone1', ''),
-                "Fecha": fecha,
-                "Observaciones": motivo
-            }
+            "Cédula": row.get('username', ''),
+            "Nombre Completo": f"{row.get('firstname', '')} {row.get('lastname', '')}",
+            "Email": row.get('email', ''),
+            "Examen": grupo or row.get('group1', ''),
+            "Celular": row.get('phone1', ''),
+            "Fecha": fecha,
+            "Observaciones": motivo
         }
-        
-        print(f"Enviando datos a Google Sheets: {json.dumps(datos, indent=2)}")  # Debug
-        
-        for attempt in range(self.MAX_RETRIES):
-            try:
-                response = requests.post(
-                    self.APPS_SCRIPT_URL,
-                    json=datos,
-                    headers={'Content-Type': 'application/json'},
-                    timeout=10
-                )
-                
-                print(f"Respuesta de Google Apps Script: {response.status_code} - {response.text}")  # Debug
-                
-                if response.status_code == 200:
-                    print(f"📝 Registrado en hoja de {tipo} (Intento {attempt + 1})")
-                    return True
-                else:
-                    print(f"⚠️ Error al registrar (Intento {attempt + 1}): {response.text}")
-                    
-            except requests.exceptions.RequestException as e:
-                print(f"⚠️ Error de conexión (Intento {attempt + 1}): {str(e)}")
-            
-            if attempt < self.MAX_RETRIES - 1:
-                time.sleep(2)
-        
-        print(f"❌ No se pudo registrar después de {self.MAX_RETRIES} intentos")
-        return False
+
+        if not self.APPS_SCRIPT_URL:
+            print("⚠️ Falta APPS_SCRIPT_WEBAPP_URL; resultado no registrado en Sheets")
+            return False
+        if self.USAR_BANDEJA:
+            self._bandeja_salida().agregar(DESTINO_SHEETS, tipo, datos)
+            return True
+        if self._reportero is None:
+            self._reportero = ReporteroSheets(self.APPS_SCRIPT_URL, self.SHEET_ID, max_reintentos=self.MAX_RETRIES)
+        self._reportero.encolar(tipo, datos)
+        return True
+
+    def cerrar_reportes(self):
+        """Espera a que el reportero / la bandeja de salida entreguen lo pendiente."""
+        if self._reportero is not None:
+            self._reportero.cerrar()
+            self._reportero = None
+        if self._bandeja is not None:
+            self._drenador.cerrar()
+            self._bandeja.cerrar()
+            self._bandeja = self._drenador = None
 
     # --- Resto de métodos SIN CAMBIOS ---
     def usuario_existe(self, username):
-        params = {
-            'wstoken': self.MOODLE_TOKEN,
-            'wsfunction': 'core_user_get_users_by_field',
-            'field': 'username',
-            'values[0]': username,
-            'moodlewsrestformat': 'json'
+        return self.resolver_usuario(username) is not None
+
+    CAMPOS_PERSONALIZADOS = {
+        'profile_field_departamento': 'departamento',
+        'profile_field_municipio': 'municipio',
+        'profile_field_modalidad': 'modalidad',
+        'profile_field_lote': 'lote'
+    }
+    CAMPOS_REQUERIDOS = ['username', 'password', 'firstname', 'lastname', 'email', 'idnumber', 'phone1']
+
+    def _datos_usuario(self, row, i):
+        """Campos users[i][...] de core_user_create_users para una fila (valida requeridos)."""
+        for campo in self.CAMPOS_REQUERIDOS:
+            if not str(row.get(campo) or '').strip():
+                error_msg = f"Campo requerido faltante: {campo}"
+                raise Exception(error_msg)
+
+        def _v(campo):
+            return str(row.get(campo) or '').strip()
+
+        user_data = {
+            f'users[{i}][username]': _v('username'),
+            f'users[{i}][password]': _v('password'),
+            f'users[{i}][firstname]': _v('firstname'),
+            f'users[{i}][lastname]': _v('lastname'),
+            f'users[{i}][email]': _v('email'),
+            f'users[{i}][auth]': 'manual',
+            f'users[{i}][idnumber]': _v('idnumber'),
+            f'users[{i}][phone1]': _v('phone1'),
         }
-        response = self.session.get(
-            urljoin(self.MOODLE_URL, 'webservice/rest/server.php'),
-            params=params,
-            headers=self.headers
-        )
-        users = response.json()
-        return isinstance(users, list) and len(users) > 0
+        for j, (csv_field, field_type) in enumerate(self.CAMPOS_PERSONALIZADOS.items()):
+            value = _v(csv_field)
+            if value:
+                user_data[f'users[{i}][customfields][{j}][type]'] = field_type
+                user_data[f'users[{i}][customfields][{j}][value]'] = value
+        return user_data
+
+    def _error_creacion(self, result):
+        error_msg = self.extraer_error_moodle(result)
+        if "invalid_parameter_exception" in error_msg.lower():
+            error_details = self.obtener_detalles_error_parametro(result)
+            error_msg = f"Error en parámetros: {error_details}"
+        return error_msg
 
     def crear_usuario(self, row):
-        campos_personalizados = {
-            'profile_field_departamento': 'departamento',
-            'profile_field_municipio': 'municipio', 
-            'profile_field_modalidad': 'modalidad',
-            'profile_field_lote': 'lote'
-        }
-        campos_requeridos = ['username', 'password', 'firstname', 'lastname', 'email', 'idnumber', 'phone1']
-        for campo in campos_requeridos:
-            if not row.get(campo, '').strip():
-                error_msg = f"Campo requerido faltante: {campo}"
-                raise Exception(error_msg)
-        
         user_data = {
             'wstoken': self.MOODLE_TOKEN,
             'wsfunction': 'core_user_create_users',
-            'users[0][username]': row['username'].strip(),
-            'users[0][password]': row['password'].strip(),
-            'users[0][firstname]': row['firstname'].strip(),
-            'users[0][lastname]': row['lastname'].strip(),
-            'users[0][email]': row['email'].strip(),
-            'users[0][auth]': 'manual',
-            'users[0][idnumber]': row['idnumber'].strip(),
-            'users[0][phone1]': row['phone1'].strip(),
-            'moodlewsrestformat': 'json'
+            'moodlewsrestformat': 'json',
+            **self._datos_usuario(row, 0),
         }
-        for i, (csv_field, field_type) in enumerate(campos_personalizados.items()):
-            value = row.get(csv_field, '').strip()
-            if value:
-                user_data[f'users[0][customfields][{i}][type]'] = field_type
-                user_data[f'users[0][customfields][{i}][value]'] = value
         
         print("Creando usuario...")
         response = self.session.post(
@@ -1309,11 +1780,70 @@ class MoodleManager:
         if isinstance(result, list) and result and 'id' in result[0]:
             print(f"✅ Usuario creado con ID: {result[0]['id']}")
             return result[0]['id']
-        error_msg = self.extraer_error_moodle(result)
-        if "invalid_parameter_exception" in error_msg.lower():
-            error_details = self.obtener_detalles_error_parametro(result)
-            error_msg = f"Error en parámetros: {error_details}"
-        raise Exception(error_msg)
+        raise Exception(self._error_creacion(result))
+
+    def crear_usuarios_lote(self, rows, tamano_lote=MOODLE_LOTE_CREACION):
+        """
+        Crea usuarios con core_user_create_users enviando hasta tamano_lote
+        por solicitud (users[0..n]). Moodle rechaza el lote entero si una fila
+        trae un parámetro inválido: en ese caso el lote se parte en mitades
+        hasta aislar la fila culpable.
+        Retorna (creados, fallidos): {username: id} y {username: motivo}.
+        """
+        creados, fallidos = {}, {}
+        validas = []
+        for row in rows:
+            username = str(row.get('username') or '').strip()
+            try:
+                self._datos_usuario(row, 0)
+                validas.append(row)
+            except Exception as e:
+                fallidos[username] = str(e)
+
+        def _enviar(lote):
+            data = {
+                'wstoken': self.MOODLE_TOKEN,
+                'wsfunction': 'core_user_create_users',
+                'moodlewsrestformat': 'json',
+            }
+            for i, row in enumerate(lote):
+                data.update(self._datos_usuario(row, i))
+            try:
+                response = self.session.post(
+                    urljoin(self.MOODLE_URL, 'webservice/rest/server.php'),
+                    data=data,
+                    headers=self.headers
+                )
+                result = response.json()
+            except Exception as e:
+                for row in lote:
+                    fallidos[str(row['username']).strip()] = f"Error de conexión creando usuarios: {e}"
+                return
+
+            if isinstance(result, list) and all(isinstance(r, dict) and 'id' in r for r in result):
+                for r in result:
+                    creados[str(r.get('username', '')).strip()] = r['id']
+                # Moodle devuelve el username en minúscula: mapear al original
+                for row in lote:
+                    original = str(row['username']).strip()
+                    if original not in creados and original.lower() in creados:
+                        creados[original] = creados[original.lower()]
+                return
+
+            error_msg = self._error_creacion(result)
+            if len(lote) > 1 and "invalid_parameter_exception" in self.extraer_error_moodle(result).lower():
+                mitad = len(lote) // 2
+                _enviar(lote[:mitad])
+                _enviar(lote[mitad:])
+                return
+            for row in lote:
+                fallidos[str(row['username']).strip()] = error_msg
+
+        tamano_lote = max(1, int(tamano_lote))
+        for inicio in range(0, len(validas), tamano_lote):
+            _enviar(validas[inicio:inicio + tamano_lote])
+        print(f"👤 Creación por lotes: {len(creados)} creados, {len(fallidos)} fallidos")
+        return creados, fallidos
     
     def obtener_detalles_error_parametro(self, response):
         try:
@@ -1374,6 +1904,70 @@ class MoodleManager:
         print(f"❌ Error en matriculación:", json.dumps(result, indent=2))
         return False
 
+    def _enviar_lote_ws(self, wsfunction, clave, elementos):
+        """
+        Envía elementos como clave[0..n][campo] en una sola solicitud. Estas
+        funciones responden null si todo salió bien. Si Moodle rechaza el lote
+        por invalid_parameter_exception se parte en mitades para saber qué
+        elementos fallan; cualquier otro error (token, permisos, acceso al
+        web service) es global y falla el lote completo.
+        Retorna una lista de bool alineada con 'elementos'.
+        """
+        if not elementos:
+            return []
+        data = {'wstoken': self.MOODLE_TOKEN, 'wsfunction': wsfunction, 'moodlewsrestformat': 'json'}
+        for i, elemento in enumerate(elementos):
+            for campo, valor in elemento.items():
+                data[f'{clave}[{i}][{campo}]'] = valor
+        try:
+            response = self.session.post(
+                urljoin(self.MOODLE_URL, 'webservice/rest/server.php'),
+                data=data,
+                headers=self.headers
+            )
+            result = response.json()
+        except Exception as e:
+            print(f"❌ Error de conexión en {wsfunction}: {e}")
+            return [False] * len(elementos)
+        if result is None:
+            return [True] * len(elementos)
+        error = self.extraer_error_moodle(result)
+        if len(elementos) == 1 or "invalid_parameter_exception" not in error.lower():
+            print(f"❌ Error en {wsfunction} ({len(elementos)} elemento(s)): {error}")
+            return [False] * len(elementos)
+        mitad = len(elementos) // 2
+        return (self._enviar_lote_ws(wsfunction, clave, elementos[:mitad])
+                + self._enviar_lote_ws(wsfunction, clave, elementos[mitad:]))
+
+    def matricular_en_curso_lote(self, matriculas):
+        """matriculas: [(user_id, course_id, role_id)]. Retorna list[bool] en el mismo orden."""
+        if not matriculas:
+            return []
+        print(f"Matriculando {len(matriculas)} usuario(s) en bloque...")
+        resultado = self._enviar_lote_ws('enrol_manual_enrol_users', 'enrolments', [
+            {'roleid': role_id, 'userid': user_id, 'courseid': course_id, 'suspend': 0}
+            for user_id, course_id, role_id in matriculas
+        ])
+        print(f"✅ Matriculados {sum(resultado)}/{len(resultado)}")
+        return resultado
+
+    def asignar_a_grupos_lote(self, asignaciones):
+        """asignaciones: [(user_id, course_id, group_name)]. Retorna list[bool] en el mismo orden."""
+        resultado = [False] * len(asignaciones)
+        miembros, posiciones = [], []
+        for pos, (user_id, course_id, group_name) in enumerate(asignaciones):
+            group_id = self.obtener_id_grupo(course_id, group_name)
+            if not group_id:
+                print(f"⚠️ Grupo '{group_name}' no encontrado")
+                continue
+            miembros.append({'userid': user_id, 'groupid': group_id})
+            posiciones.append(pos)
+        if miembros:
+            print(f"Asignando {len(miembros)} miembro(s) a grupos en bloque...")
+        for pos, ok in zip(posiciones, self._enviar_lote_ws('core_group_add_group_members', 'members', miembros)):
+            resultado[pos] = ok
+        return resultado
+
     def asignar_a_grupo(self, user_id, course_id, group_name):
         group_id = self.obtener_id_grupo(course_id, group_name)
         if not group_id:
@@ -1399,7 +1993,8 @@ class MoodleManager:
         print(f"❌ Error al asignar al grupo:", json.dumps(result, indent=2))
         return False
 
-    def obtener_id_grupo(self, course_id, group_name):
+    def _cargar_grupos(self, course_id):
+        """Descarga los grupos del curso a la caché {nombre: id} de esta corrida."""
         params = {
             'wstoken': self.MOODLE_TOKEN,
             'wsfunction': 'core_group_get_course_groups',
@@ -1413,9 +2008,55 @@ class MoodleManager:
         )
         groups = response.json()
         if isinstance(groups, list):
-            for group in groups:
-                if group['name'] == group_name:
-                    return group['id']
+            self._grupos[course_id] = {group['name']: group['id'] for group in groups}
+            # Los ausentes se conservan entre recargas; solo salen los que ya existen
+            self._grupos_ausentes.setdefault(course_id, set()).difference_update(self._grupos[course_id])
+        return self._grupos.get(course_id, {})
+
+    def crear_grupo(self, course_id, group_name):
+        """Crea el grupo en el curso (core_group_create_groups) y lo agrega a la caché."""
+        data = {
+            'wstoken': self.MOODLE_TOKEN,
+            'wsfunction': 'core_group_create_groups',
+            'groups[0][courseid]': course_id,
+            'groups[0][name]': group_name,
+            'groups[0][description]': '',
+            'moodlewsrestformat': 'json'
+        }
+        response = self.session.post(
+            urljoin(self.MOODLE_URL, 'webservice/rest/server.php'),
+            data=data,
+            headers=self.headers
+        )
+        result = response.json()
+        if isinstance(result, list) and result and 'id' in result[0]:
+            print(f"➕ Grupo '{group_name}' creado (ID: {result[0]['id']})")
+            self._grupos.setdefault(course_id, {})[group_name] = result[0]['id']
+            self._grupos_ausentes.get(course_id, set()).discard(group_name)
+            return result[0]['id']
+        print(f"❌ No se pudo crear el grupo '{group_name}':", json.dumps(result, indent=2))
+        self._grupos_fallidos.setdefault(course_id, set()).add(group_name)
+        return None
+
+    def obtener_id_grupo(self, course_id, group_name, crear=None):
+        """
+        Busca el grupo en la caché de la corrida. Solo ante un nombre desconocido
+        se vuelve a descargar la lista (una vez por nombre); si sigue sin
+        existir y crear (o MOODLE_CREAR_GRUPOS) está activo, se crea (un
+        intento por nombre y corrida).
+        """
+        grupos = self._grupos.get(course_id)
+        if grupos is not None and group_name in grupos:
+            return grupos[group_name]
+        if group_name not in self._grupos_ausentes.get(course_id, set()):
+            grupos = self._cargar_grupos(course_id)
+            if group_name in grupos:
+                return grupos[group_name]
+            self._grupos_ausentes.setdefault(course_id, set()).add(group_name)
+        if crear is None:
+            crear = self.CREAR_GRUPOS
+        if crear and group_name not in self._grupos_fallidos.get(course_id, set()):
+            return self.crear_grupo(course_id, group_name)
         return None
 
 
@@ -1478,14 +2119,6 @@ def extraer_columnas_reporte_1003():
 import json
 import pandas as pd
 
-def _norm_doc(x):
-    if pd.isna(x):
-        return None
-    s = str(x).strip().replace(",", "")
-    if s.endswith(".0"):
-        s = s[:-2]
-    return s
-
 def _fmt_grupo(v):
     if pd.isna(v):
         return "Activar"
@@ -1498,7 +2131,149 @@ def _fmt_grupo(v):
     except:
         return s or "Activar"
 
-def combinar_reportes():
+# Qué fila del 992 gana cuando un documento aparece en varios periodos:
+# "reciente" (periodo más nuevo), "antiguo" o "primero" (orden del archivo)
+PRECEDENCIA_992 = os.getenv("PRECEDENCIA_992", "reciente")
+PRECEDENCIAS_992 = ("reciente", "antiguo", "primero")
+
+
+def _validar_precedencia(precedencia):
+    if precedencia not in PRECEDENCIAS_992:
+        raise ValueError(
+            f"Precedencia del 992 desconocida: {precedencia!r} (válidas: {', '.join(PRECEDENCIAS_992)})"
+        )
+
+
+def _clave_periodo(v):
+    """
+    Periodo comparable (año, n) a partir de la etiqueta '2025-5' o del código
+    crudo de SIGA '2025012710', que se traduce antes con MAPEO_PERIODOS_992
+    para que ambas formas den la misma clave. Códigos sin mapeo y valores
+    ilegibles -> None.
+    """
+    s = "" if v is None or (isinstance(v, float) and pd.isna(v)) else str(v).strip()
+    if s.endswith(".0"):
+        s = s[:-2]
+    s = MAPEO_PERIODOS_992.get(s, s)
+    anio, guion, n = s.partition("-")
+    if guion and anio.isdigit() and n.isdigit():
+        return (int(anio), int(n))
+    return None
+
+
+# Clave del documento en los DataFrames: doc_num (Int64) si es numérico, doc_txt si no
+COLUMNAS_CLAVE_DOC = ["doc_num", "doc_txt"]
+
+
+def deduplicar_992(df_992: pd.DataFrame, precedencia: str = PRECEDENCIA_992) -> pd.DataFrame:
+    """
+    Deja una sola fila por documento (doc_num/doc_txt) según la precedencia.
+    Sin la columna cod_periodo_academico se conserva la primera aparición.
+    Los empates (mismo periodo) conservan el orden original y un periodo
+    ilegible pierde siempre. Una precedencia desconocida lanza ValueError.
+    """
+    _validar_precedencia(precedencia)
+    df = df_992[df_992["doc_num"].notna() | df_992["doc_txt"].notna()]
+    if precedencia in ("reciente", "antiguo") and "cod_periodo_academico" in df.columns:
+        df = df.assign(_orden=df["cod_periodo_academico"].map(_clave_periodo))
+        df = df.sort_values(
+            "_orden", ascending=(precedencia == "antiguo"), kind="stable", na_position="last"
+        ).drop(columns="_orden")
+    return df.drop_duplicates(subset=COLUMNAS_CLAVE_DOC, keep="first")
+
+
+def _gana_992(nuevo, actual, precedencia):
+    """¿La fila con periodo 'nuevo' reemplaza a la guardada con 'actual'? (None pierde siempre)."""
+    _validar_precedencia(precedencia)
+    if precedencia == "primero" or nuevo is None:
+        return False
+    if actual is None:
+        return True
+    return nuevo > actual if precedencia == "reciente" else nuevo < actual
+
+
+def _exigir_columnas(r, columnas, nombre, n):
+    """El registro n debe ser un objeto con todas las columnas; si no, KeyError con el detalle."""
+    if not isinstance(r, dict):
+        raise KeyError(f"El registro {n} de {nombre} no es un objeto JSON")
+    for col in columnas:
+        if col not in r:
+            raise KeyError(f"Falta columna '{col}' en {nombre} (registro {n})")
+
+
+def _combinar_reportes_indice(src_1003, src_992, dst, precedencia):
+    """
+    Motor sin pandas: un dict {doc_key: (periodo, estado, grupo)} sobre el 992
+    (ya deduplicado con la misma precedencia) y el 1003 pasa por él registro a
+    registro, escribiéndose en 'dst' a medida que se combina. Cada registro se
+    valida al pasar; si a uno le falta una columna no queda archivo a medias.
+    """
+    registros_1003 = RegistrosJson(src_1003)
+    registros_992 = RegistrosJson(src_992)
+    columnas_1003 = ("documento_numero", "inscripcion_aprobada")
+    columnas_992 = ("documento_estudiante", "estado_en_ciclo", "grupo")
+    for registros, columnas, nombre in (
+        (registros_1003, columnas_1003, "reporte_1003"),
+        (registros_992, columnas_992, "reporte_992"),
+    ):
+        # Reporte vacío: mismo aviso que el motor pandas (sin columnas)
+        if next(iter(registros), None) is None:
+            print(f"⚠️ Falta columna '{columnas[0]}' en {nombre}")
+            return None
+
+    def _filas():
+        for n, r in enumerate(registros_1003, 1):
+            _exigir_columnas(r, columnas_1003, "reporte_1003", n)
+            _, estado, grupo = indice.get(clave_documento(r["documento_numero"]), (None, None, None))
+            yield {
+                "documento_numero": r["documento_numero"],
+                "inscripcion_aprobada": r["inscripcion_aprobada"],
+                "estado_en_ciclo": "Activar" if estado is None else estado,
+                "grupo": _fmt_grupo(grupo),
+            }
+
+    try:
+        indice = {}
+        for n, r in enumerate(registros_992, 1):
+            _exigir_columnas(r, columnas_992, "reporte_992", n)
+            doc_key = clave_documento(r["documento_estudiante"])
+            if doc_key is None:
+                continue
+            periodo = _clave_periodo(r.get("cod_periodo_academico"))
+            actual = indice.get(doc_key)
+            if actual is None or _gana_992(periodo, actual[0], precedencia):
+                indice[doc_key] = (periodo, r["estado_en_ciclo"], r["grupo"])
+        print(f"🧹 992 indexado ({precedencia}): {len(indice)} documentos")
+        return escribir_json_stream(_filas(), dst)
+    except KeyError as e:
+        print(f"⚠️ {e.args[0]}")
+        return None
+
+
+def combinar_reportes(precedencia: str = PRECEDENCIA_992, motor: str = "indice"):
+    """
+    reporte_1003 + reporte_992_completo -> reporte_1003_combinado.json.
+    El 992 se reduce antes a una fila por documento (ver deduplicar_992), así
+    el combinado tiene exactamente una fila por registro del 1003.
+    motor="indice" (por defecto) combina en streaming con un dict;
+    motor="pandas" conserva la versión con DataFrames y pd.merge.
+    Una precedencia desconocida lanza ValueError antes de leer nada.
+    """
+    _validar_precedencia(precedencia)
+    if motor == "indice":
+        try:
+            res = _combinar_reportes_indice(
+                "output/reporte_1003.json", "output/reporte_992_completo.json",
+                "output/reporte_1003_combinado.json", precedencia,
+            )
+            if res is not None:
+                print("✅ Archivo 'output/reporte_1003_combinado.json' creado correctamente.")
+        except FileNotFoundError as e:
+            print(f"❌ Archivo no encontrado: {e}")
+        except Exception as e:
+            print(f"❌ Error: {e}")
+        return
+
     try:
         # Leer archivos desde JSON
         rows_1003 = _leer_json_lista("output/reporte_1003.json")
@@ -1510,6 +2285,7 @@ def combinar_reportes():
         # Validar columnas
         columnas_1003 = ["documento_numero", "inscripcion_aprobada"]
         columnas_992  = ["documento_estudiante", "estado_en_ciclo", "grupo"]
+        extra_992 = ["cod_periodo_academico"] if "cod_periodo_academico" in df_992.columns else []
         for col in columnas_1003:
             if col not in df_1003.columns:
                 print(f"⚠️ Falta columna '{col}' en reporte_1003")
@@ -1521,18 +2297,21 @@ def combinar_reportes():
 
         # Normalizar claves
         df_1003 = df_1003[columnas_1003].copy()
-        df_1003["doc_key"] = df_1003["documento_numero"].apply(_norm_doc)
+        df_1003["doc_num"], df_1003["doc_txt"] = claves_documento(df_1003["documento_numero"])
 
-        df_992 = df_992[columnas_992].copy()
-        df_992["doc_key"] = df_992["documento_estudiante"].apply(_norm_doc)
+        df_992 = df_992[columnas_992 + extra_992].copy()
+        df_992["doc_num"], df_992["doc_txt"] = claves_documento(df_992["documento_estudiante"])
+        total_992 = len(df_992)
+        df_992 = deduplicar_992(df_992, precedencia)
+        print(f"🧹 992 deduplicado ({precedencia}): {total_992} -> {len(df_992)} filas")
 
         # Merge tipo BUSCARV
         df_final = pd.merge(
             df_1003,
-            df_992[["doc_key", "estado_en_ciclo", "grupo"]],
-            on="doc_key",
+            df_992[COLUMNAS_CLAVE_DOC + ["estado_en_ciclo", "grupo"]],
+            on=COLUMNAS_CLAVE_DOC,
             how="left"
-        ).drop(columns=["doc_key"])
+        ).drop(columns=COLUMNAS_CLAVE_DOC)
 
         # Rellenos y formato
         df_final["estado_en_ciclo"] = df_final["estado_en_ciclo"].fillna("Activar")
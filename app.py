@@ -1,11 +1,15 @@
 # app.py
 # -*- coding: utf-8 -*-
-import os, json, logging
+import os, json, logging, asyncio
 from datetime import datetime, timezone
 from fastapi import FastAPI, Header, HTTPException, Query, BackgroundTasks
 from fastapi.responses import PlainTextResponse, JSONResponse
 from dotenv import load_dotenv
 from siga_runner import run_option2, run_option5
+from api_siga.aio import AsyncApiSigaClient
+from api_siga.auth import obtener_proveedor_auth
+from api_siga.cache import Cache992
+from api_siga.services import AsyncSigaServices, PeriodoFallidoError, PROYECCIONES_PIPELINE
 
 load_dotenv()
 API_KEY = os.getenv("SECRET_KEY")  # usa SECRET_KEY en Render
@@ -23,6 +27,21 @@ def _check_key(x_api_key: str | None):
     if API_KEY and x_api_key != API_KEY:
         raise HTTPException(status_code=401, detail="Unauthorized")
 
+# Servicios SIGA asíncronos: un solo pool de conexiones para todas las peticiones
+_siga_async: AsyncSigaServices | None = None
+
+def _servicios_async() -> AsyncSigaServices:
+    global _siga_async
+    if _siga_async is None:
+        cliente = AsyncApiSigaClient.desde_proveedor(obtener_proveedor_auth())
+        _siga_async = AsyncSigaServices(cliente, cache_992=Cache992(), proyecciones=PROYECCIONES_PIPELINE)
+    return _siga_async
+
+@app.on_event("shutdown")
+async def _cerrar_siga_async():
+    if _siga_async is not None:
+        await _siga_async.client.aclose()
+
 @app.get("/health")
 def health():
     return {"status": "ok"}
@@ -32,13 +51,17 @@ def status():
     return LAST
 
 @app.post("/run/option2")
-def run_opt2(background_tasks: BackgroundTasks, x_api_key: str | None = Header(default=None)):
+def run_opt2(
+    background_tasks: BackgroundTasks,
+    full: bool = Query(False, description="Procesar todo el 1003 (ignora el snapshot anterior)"),
+    x_api_key: str | None = Header(default=None),
+):
     _check_key(x_api_key)
     def task():
         LAST["opt2_started"] = datetime.now(timezone.utc).isoformat()
         LAST["opt2_error"] = None
         try:
-            run_option2()
+            run_option2(completo=full)
         except Exception as e:
             LAST["opt2_error"] = str(e)
             logger.exception("Option2: ERROR")
@@ -77,6 +100,41 @@ def run_opt5(
         status_code=202,
     )
 
+@app.post("/cache/992/invalidar")
+def invalidar_cache_992_endpoint(
+    periodo_992: str | None = Query(None, description="Periodos separados por coma; vacío = todos"),
+    x_api_key: str | None = Header(default=None),
+):
+    _check_key(x_api_key)
+    from api_siga.cache import invalidar_cache_992
+    codigos = [c.strip() for c in str(periodo_992 or "").split(",") if c.strip()]
+    eliminados = invalidar_cache_992(codigos or None)
+    return {"ok": True, "periodos": codigos or "todos", "eliminados": eliminados}
+
+@app.get("/reporte_992_completo")
+async def get_reporte_992_completo(
+    periodo_992: str = Query(..., description="Los 6 períodos separados por coma"),
+    solo_pendientes_matricula: bool = Query(False),
+    x_api_key: str | None = Header(default=None),
+):
+    """Consulta el 992 completo sin ocupar un worker del threadpool mientras SIGA responde."""
+    _check_key(x_api_key)
+    codigos = [c.strip() for c in str(periodo_992).split(",") if c.strip()]
+    services = _servicios_async()
+    token, token_autenticacion = await asyncio.to_thread(services.client.auth.tokens)
+    try:
+        _, registros = await services.consultar_reporte_992_completo(
+            token, token_autenticacion, codigos,
+            solo_pendientes_matricula=solo_pendientes_matricula,
+            # Solo responde los registros: output/reporte_992_completo.json es de run_option5
+            guardar=False,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except PeriodoFallidoError as e:
+        raise HTTPException(status_code=502, detail={"periodos_fallidos": e.fallos})
+    return {"reporte_992_completo": registros}
+
 @app.get("/reporte_1003_combinado")
 def get_reporte_1003_combinado(x_api_key: str | None = Header(default=None)):
     _check_key(x_api_key)
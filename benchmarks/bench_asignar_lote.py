@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark de asignar_lote: implementación fila a fila original vs. la
+vectorizada de api_siga/utils.py, sobre filas sintéticas.
+
+Uso (desde la raíz del repo; no necesita Postgres ni DATABASE_URL):
+    python benchmarks/bench_asignar_lote.py [n_filas]
+"""
+import os
+import random
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from api_siga.utils import asignar_lote  # noqa: E402
+
+
+def asignar_lote_original(df: pd.DataFrame):
+    """Copia de la versión con .apply + iterrows, como referencia."""
+    work = df.copy()
+    work['profile_field_modalidad'] = work['profile_field_modalidad'].apply(
+        lambda x: str(x).strip().upper() if pd.notna(x) else ''
+    )
+    work['profile_field_departamento'] = work['profile_field_departamento'].apply(
+        lambda x: str(x).strip().upper() if pd.notna(x) else ''
+    )
+    modalidades_validas = {'VIRTUAL', 'PRESENCIAL'}
+    departamentos_validos = {'ANTIOQUIA', 'CALDAS', 'CHOCÓ', 'QUINDÍO', 'RISARALDA'}
+
+    motivos = []
+    mask_modalidad = ~work['profile_field_modalidad'].isin(modalidades_validas)
+    mask_departamento = ~work['profile_field_departamento'].isin(departamentos_validos)
+    invalid_mask = mask_modalidad | mask_departamento
+    for i, row in work.iterrows():
+        m = []
+        if mask_modalidad.loc[i]:
+            m.append(f"Modalidad inválida: {row.get('profile_field_modalidad', '')}")
+        if mask_departamento.loc[i]:
+            m.append(f"Departamento no permitido: {row.get('profile_field_departamento', '')}")
+        motivos.append(" | ".join(m) if m else "")
+    work['motivo_rechazo'] = motivos
+
+    df_invalid = work[invalid_mask].copy()
+    df_valid = work[~invalid_mask].copy().reset_index(drop=True)
+    if not df_valid.empty:
+        df_valid['profile_field_lote'] = ['Lote 1' if (i % 2 == 0) else 'Lote 2' for i in range(len(df_valid))]
+    else:
+        df_valid['profile_field_lote'] = pd.Series(dtype=object)
+    if 'profile_field_lote' not in df_invalid.columns:
+        df_invalid['profile_field_lote'] = ""
+    new_cols = [c for c in ['profile_field_lote'] if c not in df.columns]
+    df_valid = df_valid[[*df.columns, *[c for c in new_cols if c in df_valid.columns]]]
+    df_invalid = df_invalid[[*df.columns, 'motivo_rechazo', 'profile_field_lote']]
+    return df_valid, df_invalid
+
+
+def filas_sinteticas(n: int, semilla: int = 7) -> pd.DataFrame:
+    rnd = random.Random(semilla)
+    modalidades = ['Virtual', ' PRESENCIAL ', 'virtual', 'Mixta', None, '', 'presencial']
+    departamentos = ['Antioquia', 'CALDAS', 'Chocó', 'quindío', 'Risaralda ', 'Valle', None, 'Bogotá', 57]
+    return pd.DataFrame({
+        'username': [str(10_000_000 + i) for i in range(n)],
+        'firstname': ['Nombre'] * n,
+        'profile_field_modalidad': [rnd.choice(modalidades) for _ in range(n)],
+        'profile_field_departamento': [rnd.choice(departamentos) for _ in range(n)],
+    })
+
+
+def _medir(fn, df, repeticiones=3):
+    mejor = float('inf')
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        resultado = fn(df)
+        mejor = min(mejor, time.perf_counter() - inicio)
+    return mejor, resultado
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    df = filas_sinteticas(n)
+
+    t_original, (valid_o, invalid_o) = _medir(asignar_lote_original, df, repeticiones=1)
+    t_vector, (valid_v, invalid_v) = _medir(asignar_lote, df)
+
+    # Misma salida que la versión original (valores, columnas y orden)
+    assert valid_o.to_dict(orient="records") == valid_v.to_dict(orient="records")
+    assert invalid_o.to_dict(orient="records") == invalid_v.to_dict(orient="records")
+    assert list(invalid_o.index) == list(invalid_v.index)
+
+    print(f"asignar_lote sobre {n:,} filas ({len(valid_v):,} válidas, {len(invalid_v):,} rechazadas)")
+    print(f"  original (apply + iterrows): {t_original:8.3f} s")
+    print(f"  vectorizada:                 {t_vector:8.3f} s")
+    print(f"  aceleración:                 {t_original / t_vector:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
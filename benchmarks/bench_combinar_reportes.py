@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark de combinar_reportes: motor "pandas" (DataFrames + pd.merge) vs.
+motor "indice" (dict sobre el 992 y el 1003 en streaming), con reportes
+sintéticos. Mide tiempo y pico de memoria (tracemalloc) de cada motor.
+
+Uso (desde la raíz del repo; no necesita Postgres ni DATABASE_URL):
+    python benchmarks/bench_combinar_reportes.py [n_filas_1003]
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from api_siga.utils import combinar_reportes  # noqa: E402
+
+
+def reportes_sinteticos(n: int, semilla: int = 7):
+    """1003 con n documentos y 992 con varias filas por documento (periodos distintos)."""
+    rnd = random.Random(semilla)
+    r1003 = [
+        {
+            "documento_numero": rnd.choice([str(1_000_000 + i), 1_000_000 + i, f"{1_000_000 + i}.0"]),
+            "inscripcion_aprobada": rnd.choice(["SI", "NO"]),
+        }
+        for i in range(n)
+    ]
+    periodos = ["2024-1", "2024-2", "2025-1", "2025-2", None, "sin periodo"]
+    estados = ["Activo", "Inactivo", "Graduado", None]
+    grupos = [1, 2.0, "3", " G4 ", "", None]
+    r992 = []
+    for i in range(n):
+        if rnd.random() < 0.2:
+            continue  # documentos del 1003 sin fila en el 992
+        for _ in range(rnd.randint(1, 3)):
+            r992.append({
+                "documento_estudiante": rnd.choice([str(1_000_000 + i), f"{1_000_000 + i:,}"]),
+                "estado_en_ciclo": rnd.choice(estados),
+                "grupo": rnd.choice(grupos),
+                "cod_periodo_academico": rnd.choice(periodos),
+            })
+    return r1003, r992
+
+
+def _correr(motor, medir_memoria=False):
+    if medir_memoria:
+        tracemalloc.start()
+    inicio = time.perf_counter()
+    combinar_reportes(motor=motor)
+    tiempo = time.perf_counter() - inicio
+    pico = 0
+    if medir_memoria:
+        pico = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    with open("output/reporte_1003_combinado.json", "r", encoding="utf-8") as f:
+        return tiempo, pico, json.load(f)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    r1003, r992 = reportes_sinteticos(n)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # combinar_reportes trabaja con rutas relativas a output/
+        os.chdir(tmp)
+        os.makedirs("output")
+        with open("output/reporte_1003.json", "w", encoding="utf-8") as f:
+            json.dump(r1003, f)
+        with open("output/reporte_992_completo.json", "w", encoding="utf-8") as f:
+            json.dump(r992, f)
+        del r1003, r992
+
+        t_pandas, _, salida_pandas = _correr("pandas")
+        t_indice, _, salida_indice = _correr("indice")
+        # Misma salida que el motor pandas (valores y orden)
+        assert salida_pandas == salida_indice
+        total = len(salida_indice)
+        del salida_pandas, salida_indice
+
+        _, mem_pandas, _ = _correr("pandas", medir_memoria=True)
+        _, mem_indice, _ = _correr("indice", medir_memoria=True)
+
+    print(f"combinar_reportes sobre {total:,} filas del 1003")
+    print(f"  pandas (merge):  {t_pandas:8.3f} s   pico {mem_pandas / 2**20:8.1f} MiB")
+    print(f"  índice (dict):   {t_indice:8.3f} s   pico {mem_indice / 2**20:8.1f} MiB")
+    print(f"  aceleración:     {t_pandas / t_indice:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,5 @@
-import os
-from dotenv import load_dotenv
-from api_siga import ApiSigaClient
-from api_siga.services import SigaServices
+from api_siga.auth import obtener_proveedor_auth
+from api_siga.services import SigaServices, PROYECCIONES_PIPELINE
 from api_siga.utils import (
     MoodleManager,
     extraer_columnas_reporte_1003,      # JSON
@@ -35,48 +33,20 @@ def main():
             guardar_json(resultado, "reporte_622")
 
         elif opcion == "2":
-            load_dotenv()
-            BASE_URL = os.getenv("BASE_URL")
-            CLIENT_ID = os.getenv("CLIENT_ID")
-            SECRETO = os.getenv("SECRETO")
-            USERNAME = os.getenv("USERNAME_PRUEBA")
-            PASSWORD = os.getenv("PASSWORD_PRUEBA")
-
-            cliente = ApiSigaClient(BASE_URL, CLIENT_ID, SECRETO)
-            access_token = cliente.generar_token()
-
-            if not access_token:
-                print("❌ No se pudo obtener el token de acceso.")
-                return
-
-            # Autenticación (con MultipartEncoder ya funcionando)
-            from requests_toolbelt.multipart.encoder import MultipartEncoder
-            import requests
-
-            url_autenticar = f"{BASE_URL}/talentotech2/autenticar"
-            headers = {"auth_token": access_token}
-            data = MultipartEncoder(fields={"username": USERNAME, "password": PASSWORD})
-            headers["Content-Type"] = data.content_type
-
+            # Proveedor único de auth: tokens compartidos (archivo + lock) y renovados
             try:
-                response = requests.post(url_autenticar, headers=headers, data=data)
-                response.raise_for_status()
-                auth_response = response.json()
+                proveedor = obtener_proveedor_auth()
+                access_token, token_autenticacion = proveedor.tokens()
             except Exception as e:
                 print("❌ Error al autenticar:", e)
                 return
-
-            if auth_response.get("RESPUESTA") != "1":
-                print("❌ Error al autenticar:", auth_response)
-                return
-
-            token_autenticacion = auth_response.get("TOKEN")
             print("✅ Autenticación correcta.")
 
-            services = SigaServices(cliente)
+            services = SigaServices(proveedor.cliente, proyecciones=PROYECCIONES_PIPELINE)
             # Flujo 100% JSON
-            resultado = services.consultar_reporte_1003(access_token, token_autenticacion)
-            guardar_json(resultado, "reporte_1003")
+            resultado = services.consultar_reporte_1003(
+                access_token, token_autenticacion, destino="output/reporte_1003.json"
+            )
 
             generar_csv_con_informacionj("output/reporte_1003.json")
             comparar_documentos_y_generar_faltantesj()
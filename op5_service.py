@@ -12,10 +12,11 @@ from typing import List, Dict, Any, Optional
 from dotenv import load_dotenv
 from fastapi import FastAPI, Header, HTTPException
 
-from api_siga import ApiSigaClient
-from api_siga.services import SigaServices
+from api_siga.services import SigaServices, PROYECCIONES_PIPELINE
+from api_siga.cache import Cache992
+from api_siga.auth import obtener_proveedor_auth
+from api_siga.pipeline import Paso, ejecutar_grafo
 from api_siga.utils import (
-    guardar_json,
     extraer_columnas_reporte_1003,
     combinar_reportes,  # <-- genera el "reporte_1003_combinado.json" final
 )
@@ -32,45 +33,13 @@ def _ensure_output_dir() -> None:
     os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 def _get_tokens():
-    """Igual a tu opción 2: carga .env, genera token y autentica en SIGA."""
+    """Tokens cacheados por el proveedor único de auth (ver api_siga/auth.py)."""
     load_dotenv()
     _ensure_output_dir()
 
-    BASE_URL  = os.getenv("BASE_URL")
-    CLIENT_ID = os.getenv("CLIENT_ID")
-    SECRETO   = os.getenv("SECRETO")
-    USERNAME  = os.getenv("USERNAME_PRUEBA")
-    PASSWORD  = os.getenv("PASSWORD_PRUEBA")
-
-    if not all([BASE_URL, CLIENT_ID, SECRETO, USERNAME, PASSWORD]):
-        raise RuntimeError(
-            "Faltan variables de entorno requeridas: "
-            "BASE_URL, CLIENT_ID, SECRETO, USERNAME_PRUEBA, PASSWORD_PRUEBA"
-        )
-
-    from requests_toolbelt.multipart.encoder import MultipartEncoder
-    import requests
-
-    logger.info("Auth: generando access_token…")
-    cliente = ApiSigaClient(BASE_URL, CLIENT_ID, SECRETO)
-    access_token = cliente.generar_token()
-    if not access_token:
-        raise RuntimeError("No se pudo obtener el token de acceso.")
-
-    logger.info("Auth: autenticando en SIGA…")
-    url_autenticar = f"{BASE_URL}/talentotech2/autenticar"
-    headers = {"auth_token": access_token}
-    data = MultipartEncoder(fields={"username": USERNAME, "password": PASSWORD})
-    headers["Content-Type"] = data.content_type
-
-    resp = requests.post(url_autenticar, headers=headers, data=data, timeout=120)
-    resp.raise_for_status()
-    auth_response = resp.json()
-    if auth_response.get("RESPUESTA") != "1":
-        raise RuntimeError(f"Error al autenticar: {auth_response}")
-
-    token_autenticacion = auth_response.get("TOKEN")
-    services = SigaServices(cliente)
+    proveedor = obtener_proveedor_auth()
+    access_token, token_autenticacion = proveedor.tokens()
+    services = SigaServices(proveedor.cliente, cache_992=Cache992(), proyecciones=PROYECCIONES_PIPELINE)
     logger.info("Auth OK (op5)")
     return services, access_token, token_autenticacion
 
@@ -80,12 +49,12 @@ def run_option5(
     outfile_path: str = os.path.join(OUTPUT_DIR, "reporte_1003_combinado.json"),
 ) -> Dict[str, Any]:
     """
-    Flujo combinado (similar a tu opción 5 actual):
-    1) Consulta 1003 -> output/reporte_1003.json
-    2) extraer_columnas_reporte_1003()  (si lo requieres como en tu main)
-    3) Consulta 992 completo con periodos
-    4) combinar_reportes() -> genera output/reporte_1003_combinado.json
-    5) Devuelve dict {'ok': True, 'reporte_1003_combinado': [...]}
+    Flujo combinado (similar a tu opción 5 actual), como grafo de pasos:
+    1) Consulta 1003 -> output/reporte_1003.json   } en paralelo
+    3) Consulta 992 completo con periodos            }
+    2) extraer_columnas_reporte_1003() tras el 1003 (no crítico)
+    4) combinar_reportes() cuando 1003 y 992 terminan -> output/reporte_1003_combinado.json
+    5) Devuelve dict {'ok': True, 'reporte_1003_combinado': [...], 'tiempos': {...}}
     """
     logger.info("Option5: START")
     _ensure_output_dir()
@@ -97,30 +66,41 @@ def run_option5(
     # 1) Tokens
     services, access_token, token_autenticacion = _get_tokens()
 
-    # 2) 1003
-    logger.info("Option5: consultando reporte 1003…")
-    res_1003 = services.consultar_reporte_1003(access_token, token_autenticacion)
-    guardar_json(res_1003, "reporte_1003")  # -> output/reporte_1003.json
-
-    # (Opcional) si necesitas dejar el 1003 "limpio" como en tu main
-    try:
-        extraer_columnas_reporte_1003()
-    except Exception as e:
-        logger.warning(f"extraer_columnas_reporte_1003() falló (continuo igual). Detalle: {e}")
-
-    # 3) 992 completo
-    logger.info("Option5: consultando reporte 992 completo…")
-    _ = services.consultar_reporte_992_completo(
-        token=access_token,
-        token_autenticacion=token_autenticacion,
-        cod_periodos=codigos,
-        solo_pendientes_matricula=False,
-        outfile_path=os.path.join(OUTPUT_DIR, "reporte_992_completo.json"),
-    )
-
-    # 4) Combinar 1003 + 992
-    logger.info("Option5: combinando reportes (1003 + 992)…")
-    combinar_reportes()  # Debe generar output/reporte_1003_combinado.json
+    # 2) 1003 y 992 completo en paralelo; combinar cuando ambos estén listos
+    def _paso_1003():
+        logger.info("Option5: consultando reporte 1003…")
+        # Streaming directo a disco: el cuerpo no se carga entero en memoria
+        res_1003 = services.consultar_reporte_1003(
+            access_token, token_autenticacion, destino="output/reporte_1003.json"
+        )
+        if res_1003 is None:
+            # Paso crítico: sin 1003 no se combina un output/reporte_1003.json viejo
+            raise RuntimeError("No se pudo descargar el reporte 1003.")
+        if not res_1003:
+            logger.warning("Reporte 1003 sin datos válidos.")
+
+    def _paso_992():
+        logger.info("Option5: consultando reporte 992 completo…")
+        services.consultar_reporte_992_completo(
+            token=access_token,
+            token_autenticacion=token_autenticacion,
+            cod_periodos=codigos,
+            solo_pendientes_matricula=False,
+            outfile_path=os.path.join(OUTPUT_DIR, "reporte_992_completo.json"),
+        )
+
+    def _paso_combinar():
+        logger.info("Option5: combinando reportes (1003 + 992)…")
+        combinar_reportes()  # Debe generar output/reporte_1003_combinado.json
+
+    _, tiempos = ejecutar_grafo([
+        Paso("reporte_1003", _paso_1003),
+        Paso("reporte_992", _paso_992),
+        # (Opcional) dejar el 1003 "limpio" como en tu main; si falla, continuo igual
+        Paso("extraer_columnas_1003", extraer_columnas_reporte_1003, depende_de=["reporte_1003"], critico=False),
+        Paso("combinar", _paso_combinar, depende_de=["reporte_1003", "reporte_992"]),
+    ])
+    logger.info(f"Option5: tiempos por paso {tiempos}")
 
     # 5) Cargar y responder
     if os.path.exists(outfile_path):
@@ -137,7 +117,7 @@ def run_option5(
         logger.warning("Option5: archivo combinado no encontrado; devolviendo vacío.")
         payload = []
 
-    return {"ok": True, "step": "option5", "reporte_1003_combinado": payload}
+    return {"ok": True, "step": "option5", "reporte_1003_combinado": payload, "tiempos": tiempos}
 
 # ------------------ FastAPI para Render ------------------
 app = FastAPI(title="API SIGA - Opción 5")
@@ -3,24 +3,26 @@ import os
 import logging
 from dotenv import load_dotenv
 
-from api_siga import ApiSigaClient
-from api_siga.services import SigaServices
+from api_siga.services import SigaServices, PROYECCIONES_PIPELINE
+from api_siga.cache import Cache992
+from api_siga.auth import obtener_proveedor_auth
+from api_siga.pipeline import EscritorArtefactos
+from api_siga.incremental import IndiceSnapshot1003
+from api_siga.checkpoint import DiarioCheckpoint
 from api_siga.utils import (
     MoodleManager,
-    guardar_json,
     generar_csv_con_informacionj,
     comparar_documentos_y_generar_faltantesj,
     verificar_usuarios_individualmentej,
     procesar_archivoj,
+    construir_filas_moodle,
+    filtrar_usuarios_faltantes,
+    verificar_usuarios_en_moodle,
+    procesar_filas_lotes,
     extraer_columnas_reporte_1003,
     combinar_reportes,
 )
 
-import requests
-from requests_toolbelt.multipart.encoder import MultipartEncoder  # <- IMPORT CORRECTO
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-
 logger = logging.getLogger("siga")
 
 
@@ -28,64 +30,18 @@ def _ensure_output_dir() -> None:
     os.makedirs("output", exist_ok=True)
 
 
-def _session_with_retries() -> requests.Session:
-    s = requests.Session()
-    retries = Retry(
-        total=5,
-        connect=5,
-        read=5,
-        backoff_factor=1.0,
-        status_forcelist=[429, 500, 502, 503, 504],
-        allowed_methods=frozenset(["GET", "POST"]),
-        raise_on_status=False,
-    )
-    s.mount("http://", HTTPAdapter(max_retries=retries))
-    s.mount("https://", HTTPAdapter(max_retries=retries))
-    return s
-
-
 def _get_tokens():
+    """Tokens cacheados por el proveedor único de auth (ver api_siga/auth.py)."""
     load_dotenv()
     _ensure_output_dir()
 
-    BASE_URL = os.getenv("BASE_URL")
-    CLIENT_ID = os.getenv("CLIENT_ID")
-    SECRETO = os.getenv("SECRETO")
-    USERNAME = os.getenv("USERNAME_PRUEBA")
-    PASSWORD = os.getenv("PASSWORD_PRUEBA")
-
-    if not all([BASE_URL, CLIENT_ID, SECRETO, USERNAME, PASSWORD]):
-        raise RuntimeError(
-            "Faltan variables de entorno requeridas: "
-            "BASE_URL, CLIENT_ID, SECRETO, USERNAME_PRUEBA, PASSWORD_PRUEBA"
-        )
-
-    logger.info("Auth: generando access_token…")
-    cliente = ApiSigaClient(BASE_URL, CLIENT_ID, SECRETO)
-    access_token = cliente.generar_token()
-    if not access_token:
-        raise RuntimeError("No se pudo obtener el token de acceso.")
-
-    logger.info("Auth: autenticando en SIGA…")
-    url_autenticar = f"{BASE_URL}/talentotech2/autenticar"
-    headers = {"auth_token": access_token}
-    data = MultipartEncoder(fields={"username": USERNAME, "password": PASSWORD})
-    headers["Content-Type"] = data.content_type
-
-    session = _session_with_retries()
-    resp = session.post(url_autenticar, headers=headers, data=data, timeout=120)
-    resp.raise_for_status()
-    auth_response = resp.json()
-    if auth_response.get("RESPUESTA") != "1":
-        raise RuntimeError(f"Error al autenticar: {auth_response}")
-
-    token_autenticacion = auth_response.get("TOKEN")
-    services = SigaServices(cliente)
-    logger.info("Auth OK")
+    proveedor = obtener_proveedor_auth()
+    access_token, token_autenticacion = proveedor.tokens()
+    services = SigaServices(proveedor.cliente, cache_992=Cache992(), proyecciones=PROYECCIONES_PIPELINE)
     return services, access_token, token_autenticacion
 
 
-def run_option2() -> dict:
+def run_option2(en_memoria: bool = True, artefactos: bool = True, completo: bool = False) -> dict:
     """
     Flujo JSON:
     1) Consulta 1003 -> guarda output/reporte_1003.json
@@ -94,16 +50,60 @@ def run_option2() -> dict:
     4) Verificación individual -> genera usuarios_no_matriculados.json
     5) Asigna lotes -> resultado_lotes.json
     6) Matricula en Moodle desde resultado_lotes.json
+
+    Con en_memoria=True las etapas 2-6 se pasan las filas directamente; los
+    JSON intermedios solo se escriben (en segundo plano) si artefactos=True.
+    en_memoria=False conserva el encadenamiento por archivos.
+
+    En modo en memoria solo pasan de la etapa 2 los documentos nuevos o
+    modificados desde la última corrida exitosa (api_siga/incremental.py);
+    completo=True procesa toda la población del 1003.
     """
     logger.info("Option2: START")
     _ensure_output_dir()
 
     services, access_token, token_autenticacion = _get_tokens()
 
-    logger.info("Option2: consultando reporte 1003…")
-    res_1003 = services.consultar_reporte_1003(access_token, token_autenticacion)
-    guardar_json(res_1003, "reporte_1003")  # -> output/reporte_1003.json
+    def _descargar_1003():
+        logger.info("Option2: consultando reporte 1003…")
+        # Streaming directo a disco: el cuerpo no se carga entero en memoria
+        res = services.consultar_reporte_1003(
+            access_token, token_autenticacion, destino="output/reporte_1003.json"
+        )
+        if res is None:
+            raise RuntimeError("No se pudo descargar el reporte 1003.")
+        if not res:
+            logger.warning("Reporte 1003 sin datos válidos.")
+        return res
+
+    if en_memoria:
+        # Diario de checkpoints: una corrida cortada retoma desde la última
+        # etapa terminada y el último usuario matriculado
+        diario = DiarioCheckpoint()
+        res_1003 = diario.etapa("reporte_1003", {"soloactivos": True}, _descargar_1003)
+        _etapas_option2_en_memoria(res_1003, artefactos, completo, diario)
+        diario.limpiar()
+    else:
+        _descargar_1003()
+        _etapas_option2_por_archivos()
+
+    logger.info("Option2: DONE")
+    return {
+        "ok": True,
+        "step": "option2",
+        "outputs": [
+            "output/reporte_1003.json",
+            "output/reporte_1003_modificado.json",
+            "output/usuarios_faltantes_nivelacion.json",
+            "output/verificacion_individual_moodle.json",
+            "output/usuarios_no_matriculados.json",
+            "output/resultado_lotes.json",
+            "output/resultado_lotes_descartados.json",
+        ],
+    }
+
 
+def _etapas_option2_por_archivos() -> None:
     logger.info("Option2: generando estructura Moodle (JSON)…")
     generar_csv_con_informacionj("output/reporte_1003.json")  # crea *_modificado.json
 
@@ -121,30 +121,75 @@ def run_option2() -> dict:
     # La versión JSON mantiene el mismo nombre si así la dejaste:
     mm.matricular_usuarios("output/resultado_lotes.json")
 
-    logger.info("Option2: DONE")
-    return {
-        "ok": True,
-        "step": "option2",
-        "outputs": [
-            "output/reporte_1003.json",
-            "output/reporte_1003_modificado.json",
-            "output/usuarios_faltantes_nivelacion.json",
-            "output/verificacion_individual_moodle.json",
-            "output/usuarios_no_matriculados.json",
-            "output/resultado_lotes.json",
-            "output/resultado_lotes_descartados.json",
-        ],
-    }
+
+def _etapas_option2_en_memoria(registros_1003, artefactos: bool, completo: bool = False, diario=None) -> None:
+    escritor = EscritorArtefactos(activo=artefactos)
+    indice = IndiceSnapshot1003()
+    diario = diario or DiarioCheckpoint()
+
+    def _exigir(resultado, mensaje):
+        if resultado is None:
+            raise RuntimeError(mensaje)
+        return resultado
+
+    def _lotes(filas):
+        validos, descartados = procesar_filas_lotes(filas, moodle_manager=None)
+        return [_exigir(validos, "No se pudieron asignar lotes."), descartados]
+
+    try:
+        logger.info("Option2: generando estructura Moodle (memoria)…")
+        filas_moodle = diario.etapa("filas_moodle", registros_1003, lambda: _exigir(
+            construir_filas_moodle(registros_1003), "No se pudo generar la estructura Moodle del reporte 1003."
+        ))
+        escritor.programar("output/reporte_1003_modificado.json", filas_moodle)
+
+        # Solo lo nuevo o modificado desde la última corrida exitosa
+        filas_moodle = indice.filtrar_cambios(filas_moodle, completo=completo)
+
+        logger.info("Option2: comparando y generando faltantes (memoria)…")
+        faltantes = diario.etapa("faltantes", filas_moodle, lambda: _exigir(
+            filtrar_usuarios_faltantes(filas_moodle), "No se pudo comparar contra la base de datos."
+        ))
+        escritor.programar("output/usuarios_faltantes_nivelacion.json", faltantes)
+
+        logger.info("Option2: verificación individual (memoria)…")
+        resultados, no_matriculados = diario.etapa("verificacion", faltantes, lambda: list(_exigir(
+            verificar_usuarios_en_moodle(faltantes), "No se pudo verificar usuarios en Moodle."
+        )))
+        escritor.programar("output/verificacion_individual_moodle.json", resultados)
+        escritor.programar("output/usuarios_no_matriculados.json", no_matriculados)
+
+        logger.info("Option2: asignando lotes (memoria)…")
+        validos, descartados = diario.etapa("lotes", no_matriculados, lambda: _lotes(no_matriculados))
+        escritor.programar("output/resultado_lotes.json", validos)
+        escritor.programar("output/resultado_lotes_descartados.json", descartados)
+
+        logger.info("Option2: matriculando en Moodle (memoria)…")
+        mm = MoodleManager()
+        hechos = diario.progreso("matricula", validos)
+        mm.matricular_usuarios(validos, inicio=hechos, al_avanzar=lambda i: diario.avanzar("matricula", i))
+
+        # La corrida terminó: la próxima parte de este snapshot, salvo los
+        # documentos que siguen sin estar en Postgres (descartados por lote,
+        # matrículas fallidas o sin confirmar): esos se reintentan
+        pendientes = filtrar_usuarios_faltantes(filas_moodle, show_progress=False)
+        if pendientes is None:
+            logger.warning("Option2: no se pudo revisar la BD; el snapshot 1003 no se actualiza.")
+        else:
+            indice.confirmar(descartar=[fila.get("idnumber") for fila in pendientes])
+    finally:
+        escritor.cerrar()
+
+
 # siga_runner.py
 # -*- coding: utf-8 -*-
 import os, json, logging
 from typing import List, Dict, Any, Optional
 from dotenv import load_dotenv
 
-from api_siga import ApiSigaClient
 from api_siga.services import SigaServices
+from api_siga.pipeline import Paso, ejecutar_grafo
 from api_siga.utils import (
-    guardar_json,
     extraer_columnas_reporte_1003,
     combinar_reportes,
 )
@@ -156,52 +201,17 @@ OUTPUT_DIR = "output"
 def _ensure_output_dir() -> None:
     os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-def _get_tokens():
-    load_dotenv()
-    _ensure_output_dir()
-
-    BASE_URL  = os.getenv("BASE_URL")
-    CLIENT_ID = os.getenv("CLIENT_ID")
-    SECRETO   = os.getenv("SECRETO")
-    USERNAME  = os.getenv("USERNAME_PRUEBA")
-    PASSWORD  = os.getenv("PASSWORD_PRUEBA")
-    if not all([BASE_URL, CLIENT_ID, SECRETO, USERNAME, PASSWORD]):
-        raise RuntimeError("Faltan variables de entorno: BASE_URL, CLIENT_ID, SECRETO, USERNAME_PRUEBA, PASSWORD_PRUEBA")
-
-    from requests_toolbelt.multipart.encoder import MultipartEncoder
-    import requests
-
-    cliente = ApiSigaClient(BASE_URL, CLIENT_ID, SECRETO)
-    access_token = cliente.generar_token()
-    if not access_token:
-        raise RuntimeError("No se pudo obtener el token de acceso.")
-
-    url_aut = f"{BASE_URL}/talentotech2/autenticar"
-    headers = {"auth_token": access_token}
-    data = MultipartEncoder(fields={"username": USERNAME, "password": PASSWORD})
-    headers["Content-Type"] = data.content_type
-
-    resp = requests.post(url_aut, headers=headers, data=data, timeout=120)
-    resp.raise_for_status()
-    j = resp.json()
-    if j.get("RESPUESTA") != "1":
-        raise RuntimeError(f"Error al autenticar: {j}")
-
-    token_autenticacion = j.get("TOKEN")
-    services = SigaServices(cliente)
-    return services, access_token, token_autenticacion
-
 def run_option5(
     codigos: Optional[List[str]] = None,
     solo_pendientes_matricula: bool = False,
     outfile_path: str = os.path.join(OUTPUT_DIR, "reporte_1003_combinado.json"),
 ) -> Dict[str, Any]:
     """
-    1) 1003 -> output/reporte_1003.json
-    2) (opcional) extraer_columnas_reporte_1003()
-    3) 992 completo con periodos 'codigos'
-    4) combinar_reportes() -> output/reporte_1003_combinado.json
-    5) return {'reporte_1003_combinado': [...]}
+    Grafo de pasos (los independientes corren en paralelo):
+      1003 ──┬── extraer_columnas_1003 (no crítico)
+             └──────────────┐
+      992 completo ─────────┴── combinar -> output/reporte_1003_combinado.json
+    Devuelve {'reporte_1003_combinado': [...], 'tiempos': {paso: segundos}}.
     """
     _ensure_output_dir()
     if not codigos:
@@ -209,28 +219,36 @@ def run_option5(
 
     services, access_token, token_autenticacion = _get_tokens()
 
-    # 1003
-    res_1003 = services.consultar_reporte_1003(access_token, token_autenticacion)
-    guardar_json(res_1003, "reporte_1003")
-    try:
-        extraer_columnas_reporte_1003()
-    except Exception as e:
-        logger.warning(f"extraer_columnas_reporte_1003() no crítico: {e}")
-
-    # 992 completo
-    _ = services.consultar_reporte_992_completo(
-        token=access_token,
-        token_autenticacion=token_autenticacion,
-        cod_periodos=codigos,
-        solo_pendientes_matricula=solo_pendientes_matricula,
-        outfile_path=os.path.join(OUTPUT_DIR, "reporte_992_completo.json"),
-    )
+    def _paso_1003():
+        # Streaming directo a disco: el cuerpo no se carga entero en memoria
+        res_1003 = services.consultar_reporte_1003(
+            access_token, token_autenticacion, destino="output/reporte_1003.json"
+        )
+        if res_1003 is None:
+            # Paso crítico: sin 1003 no se combina un output/reporte_1003.json viejo
+            raise RuntimeError("No se pudo descargar el reporte 1003.")
+        if not res_1003:
+            logger.warning("Reporte 1003 sin datos válidos.")
+        return res_1003
+
+    def _paso_992():
+        return services.consultar_reporte_992_completo(
+            token=access_token,
+            token_autenticacion=token_autenticacion,
+            cod_periodos=codigos,
+            solo_pendientes_matricula=solo_pendientes_matricula,
+            outfile_path=os.path.join(OUTPUT_DIR, "reporte_992_completo.json"),
+        )
 
-    # combinar
-    combinar_reportes()
+    _, tiempos = ejecutar_grafo([
+        Paso("reporte_1003", _paso_1003),
+        Paso("reporte_992", _paso_992),
+        Paso("extraer_columnas_1003", extraer_columnas_reporte_1003, depende_de=["reporte_1003"], critico=False),
+        Paso("combinar", combinar_reportes, depende_de=["reporte_1003", "reporte_992"]),
+    ])
+    logger.info(f"Option5: tiempos por paso {tiempos}")
 
     # preparar respuesta
-        # preparar respuesta
     payload = []
     try:
         if os.path.exists(outfile_path):
@@ -264,4 +282,4 @@ def run_option5(
         payload = []
 
     logger.info(f"Option5: DONE. Registros combinados: {len(payload)}")
-    return {"ok": True, "step": "option5", "reporte_1003_combinado": payload}
+    return {"ok": True, "step": "option5", "reporte_1003_combinado": payload, "tiempos": tiempos}
@@ -4,17 +4,22 @@ from siga_runner import run_option2, run_option5
 
 def main():
     if len(sys.argv) < 2:
-        print("Uso: python tasks.py [option2|option5] [periodo_992]")
+        print("Uso: python tasks.py [option2 [--full]|option5|invalidar_cache_992] [periodo_992 ...]")
         raise SystemExit(1)
 
     opt = sys.argv[1]
     if opt == "option2":
-        print(run_option2())
+        # --full ignora el índice del último snapshot y procesa todo el 1003
+        print(run_option2(completo="--full" in sys.argv[2:]))
     elif opt == "option5":
         if len(sys.argv) < 3:
             print("Falta periodo_992. Ej: python tasks.py option5 2025011112")
             raise SystemExit(1)
         print(run_option5(int(sys.argv[2])))
+    elif opt == "invalidar_cache_992":
+        # Sin periodos -> invalida toda la caché del 992
+        from api_siga.cache import invalidar_cache_992
+        invalidar_cache_992(sys.argv[2:] or None)
     else:
         print("Opción inválida.")
         raise SystemExit(1)